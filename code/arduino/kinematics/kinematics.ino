@@ -23,6 +23,20 @@ const int CLAMP_CLOSE_ANGLE = 180;
 //TODO : define funny action's servo values
 const int FUNNY_SET = 100;
 const int FUNNY_RESET = 10;
+//Status request: the action of the servo byte, the answer is one byte
+const byte STATUS_COMMAND = 15;
+const byte STATUS_REACHED = 0;
+const byte STATUS_MOVING = 1;
+const byte STATUS_STALLED = 2;
+const int SERVO_COUNT = 4;
+//The PWM servos have no feedback, their time to move is estimated
+const unsigned long SERVO_MS_PER_DEGREE = 4;
+//Dynamixel position tolerance before being considered as stalled
+const int DYNAMIXEL_TOLERANCE = 10;
+//A new dynamixel goal is moving for at least this time, the dynamixel
+//may not report it is moving right after the move command
+const unsigned long DYNAMIXEL_START_MS = 300;
+
 Servo servo_clamp;
 Servo servo_push;
 Servo servo_funny;
@@ -31,10 +45,23 @@ Servo servo_funny;
 int servo = 5;
 int action = 5;
 
+//Status of each servo, updated by the loop and the received commands
+volatile byte statuses[SERVO_COUNT] = {STATUS_REACHED, STATUS_REACHED, STATUS_REACHED, STATUS_REACHED};
+volatile byte status_servo = 0;
+int servo_angles[SERVO_COUNT] = {0, 0, 0, 0};
+unsigned long moving_until[SERVO_COUNT] = {0, 0, 0, 0};
+int dynamixel_goal = ANGLE_DYNAMIXEL_VERTICAL;
+unsigned long dynamixel_started = 0;
+
+//False between a status command and its request: the read of the
+//Raspberry Pi first writes the register byte, which isn't a command
+volatile bool command_processed = true;
+
 void setup() {
     //Join I2C bus as slave
     Wire.begin(SLAVE_ADDRESS);
     Wire.onReceive(receive_data);
+    Wire.onRequest(send_status);
 
     //Set the actual baudrate et ctrl pin (input) for the dynamixel
     pinMode(DYNAMIXEL_CTRL_PIN, INPUT);
@@ -46,30 +73,40 @@ void setup() {
     servo_funny.attach(SERVO_FUNNY_PIN);
 
     //Default servos positions
-    change_servo_angle(&servo_clamp, CLAMP_OPEN_ANGLE);
+    change_servo_angle(0, &servo_clamp, CLAMP_OPEN_ANGLE);
     move_dynamixel_angle(ANGLE_DYNAMIXEL_VERTICAL);
-    change_servo_angle(&servo_push, PUSH_BACK);
-    change_servo_angle(&servo_funny, FUNNY_RESET);
+    change_servo_angle(2, &servo_push, PUSH_BACK);
+    change_servo_angle(3, &servo_funny, FUNNY_RESET);
 }
 
 void loop() {
     delay(100);
     process_action(servo, action);
+    update_statuses();
 }
 
 void receive_data(int byte_count) {
-  bool command_processed = true;
-
   //Reading I2C command
   while(Wire.available()){
     if (command_processed == true) {
       byte dataReceived = Wire.read();
 
-      servo = dataReceived >> 4;
-      action = dataReceived & 0x0F;
-      command_processed = false;
+      if ((dataReceived & 0x0F) == STATUS_COMMAND) {
+        //Only select the servo of the next status request
+        status_servo = dataReceived >> 4;
+        command_processed = false;
+      }
+      else {
+        servo = dataReceived >> 4;
+        action = dataReceived & 0x0F;
+        //Moving until the loop processes the action
+        if (servo < SERVO_COUNT) {
+          statuses[servo] = STATUS_MOVING;
+        }
+      }
     }
     else {
+      //Discard the register byte of the status request
       Wire.read();
     }
   }
@@ -79,10 +116,10 @@ void process_action(byte servo, byte action) {
   switch (servo) {
     case 0 :
       if (action == 0) {
-        change_servo_angle(&servo_clamp, CLAMP_OPEN_ANGLE);
+        change_servo_angle(0, &servo_clamp, CLAMP_OPEN_ANGLE);
       }
       else if (action == 1) {
-        change_servo_angle(&servo_clamp, CLAMP_CLOSE_ANGLE);
+        change_servo_angle(0, &servo_clamp, CLAMP_CLOSE_ANGLE);
       }
       break;
     case 1 :
@@ -95,18 +132,18 @@ void process_action(byte servo, byte action) {
       break;
     case 2:
       if (action == 0) {
-        change_servo_angle(&servo_push, PUSH_BACK);
+        change_servo_angle(2, &servo_push, PUSH_BACK);
       }
       else if (action == 1) {
-        change_servo_angle(&servo_push, PUSH_OUT);
+        change_servo_angle(2, &servo_push, PUSH_OUT);
       }
       break;
     case 3:
       if (action == 0) {
-        change_servo_angle(&servo_funny, FUNNY_RESET);
+        change_servo_angle(3, &servo_funny, FUNNY_RESET);
       }
       else if (action == 1) {
-        change_servo_angle(&servo_funny, FUNNY_SET);
+        change_servo_angle(3, &servo_funny, FUNNY_SET);
       }
    default :
      break;
@@ -114,11 +151,53 @@ void process_action(byte servo, byte action) {
 }
 
 //Use a specifique servo and give it an angle
-void change_servo_angle(Servo *servo, int angle) {
+void change_servo_angle(byte index, Servo *servo, int angle) {
+  if (servo_angles[index] != angle) {
+    moving_until[index] = millis() + abs(angle - servo_angles[index]) * SERVO_MS_PER_DEGREE;
+    servo_angles[index] = angle;
+  }
   servo->write(angle);
 }
 
+//The dynamixel is read here and not in the I2C interrupt
+void update_statuses() {
+  for (byte i = 0; i < SERVO_COUNT; i++) {
+    if (i == 1) {
+      if (Dynamixel.moving(DYNAMIXEL_ADDRESS) || millis() - dynamixel_started < DYNAMIXEL_START_MS) {
+        statuses[i] = STATUS_MOVING;
+      }
+      else if (abs(Dynamixel.readPosition(DYNAMIXEL_ADDRESS) - dynamixel_goal) > DYNAMIXEL_TOLERANCE) {
+        statuses[i] = STATUS_STALLED;
+      }
+      else {
+        statuses[i] = STATUS_REACHED;
+      }
+    }
+    else if ((long)(millis() - moving_until[i]) < 0) {
+      statuses[i] = STATUS_MOVING;
+    }
+    else {
+      statuses[i] = STATUS_REACHED;
+    }
+  }
+}
+
+void send_status() {
+  if (status_servo < SERVO_COUNT) {
+    Wire.write(statuses[status_servo]);
+  }
+  else {
+    Wire.write(STATUS_REACHED);
+  }
+  command_processed = true;
+}
+
 void move_dynamixel_angle(int angle) {
+  //The loop repeats the last action, only a new goal restarts the timer
+  if (angle != dynamixel_goal) {
+    dynamixel_started = millis();
+  }
+  dynamixel_goal = angle;
   Dynamixel.ledStatus(DYNAMIXEL_ADDRESS,ON);
   Dynamixel.move(DYNAMIXEL_ADDRESS, angle);
   Dynamixel.ledStatus(DYNAMIXEL_ADDRESS,OFF);
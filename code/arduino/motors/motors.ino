@@ -13,8 +13,23 @@ const byte SLAVE_ADDRESS = 0x05;
 
 // I2C variables
 byte command = 0;
-int data = -1;
 bool command_received = false;
+// Values of the command, only the Arc command has more than one value.
+const int MAX_VALUES = 3;
+int values[MAX_VALUES];
+int values_received = 0;
+
+// Wide commands have the WIDE_FLAG bit set in the command byte and carry
+// a 16 bits signed value in tenth of unit, split in 3 bytes of 2, 7 and 7
+// bits with the MSB set so that no byte is null.
+// Commands without the flag are decoded as before (one unsigned byte).
+// Arc is only available as a wide command.
+const byte WIDE_FLAG = 0x40;
+const int WIDE_DATA_BYTES = 3;
+const int WIDE_RESOLUTION = 10;
+bool wide = false;
+int wide_bytes_received = 0;
+unsigned int wide_data = 0;
 
 // I2C commands
 enum Commands {
@@ -27,7 +42,9 @@ enum Commands {
     GetDistanceDone,
     IsDone,
     IsStopped,
-    Resume
+    Resume,
+    Arc,
+    Status
 };
 
 // Encoder wheel pins
@@ -93,27 +110,50 @@ void receive_i2c_data(int byteCount) {
         if (dataReceived == 0) continue;
 
         if (! command_received) {
-            command = dataReceived;
+            command = dataReceived & ~WIDE_FLAG;
+            wide = dataReceived & WIDE_FLAG;
             command_received = true;
+        } else if (wide) {
+            wide_data = (wide_data << 7) | (dataReceived & 0x7F);
+            wide_bytes_received++;
+            if (wide_bytes_received == WIDE_DATA_BYTES) {
+                add_value((int16_t) wide_data);
+                wide_bytes_received = 0;
+                wide_data = 0;
+            }
         } else {
-            data = dataReceived;
+            add_value(dataReceived);
         }
     }
-    if ((data != -1) || !has_command_data(command)) {
+    if (command_received && values_received >= get_command_values(command)) {
         execute_action();
     }
 }
 
-bool has_command_data(int command) {
+void add_value(int value) {
+    if (values_received < MAX_VALUES) {
+        values[values_received++] = value;
+    }
+}
+
+// Convert back a wide value in tenth of unit to the unit.
+long scale_data(long value) {
+    return wide ? value / WIDE_RESOLUTION : value;
+}
+
+// Number of values following the command.
+int get_command_values(int command) {
     switch (command) {
         case Forward:
         case Backward:
         case TurnLeft:
         case TurnRight:
         case SetSpeed:
-            return true;
+            return 1;
+        case Arc:
+            return 3;
     }
-    return false;
+    return 0;
 }
 
 void execute_action() {
@@ -139,29 +179,46 @@ void execute_action() {
             }
             reset_distance_already_done();
             break;
+
+        // Values: straight distance, arc length (cm) and arc angle (degrees,
+        // positive to the right).
+        case Arc:
+            delete regulation;
+            regulation = new ArcRegulation(&motor_left, &motor_right,
+                    scale_data(Motor::convert_cm_to_imp(values[0])),
+                    scale_data(Motor::convert_angle_to_imp(values[2])));
+            if (motor_speed) {
+                regulation->set_max_speed(motor_speed);
+            }
+            reset_distance_already_done();
+            break;
     }
 
     // Execute the command.
     switch(command) {
         case Forward:
-            regulation->set_setpoint(Motor::convert_cm_to_imp(data));
+            regulation->set_setpoint(scale_data(Motor::convert_cm_to_imp(values[0])));
             break;
 
         case Backward:
-            regulation->set_setpoint(-Motor::convert_cm_to_imp(data));
+            regulation->set_setpoint(-scale_data(Motor::convert_cm_to_imp(values[0])));
             break;
 
         case TurnRight:
-            regulation->set_setpoint(Motor::convert_angle_to_imp(data));
+            regulation->set_setpoint(scale_data(Motor::convert_angle_to_imp(values[0])));
             break;
 
         case TurnLeft:
-            regulation->set_setpoint(-Motor::convert_angle_to_imp(data));
+            regulation->set_setpoint(-scale_data(Motor::convert_angle_to_imp(values[0])));
+            break;
+
+        case Arc:
+            regulation->set_setpoint(scale_data(Motor::convert_cm_to_imp(values[0] + values[1])));
             break;
 
         case SetSpeed:
-            regulation->set_max_speed(data);
-            motor_speed = data;
+            regulation->set_max_speed(scale_data(values[0]));
+            motor_speed = scale_data(values[0]);
             break;
 
         case Stop:
@@ -174,8 +231,11 @@ void execute_action() {
     }
 
     // Reset I2C data.
-    data = -1;
     command_received = false;
+    values_received = 0;
+    wide = false;
+    wide_bytes_received = 0;
+    wide_data = 0;
 }
 
 void send_i2c_data() {
@@ -184,15 +244,29 @@ void send_i2c_data() {
         // Required to define a new variable in a switch-case.
         // http://stackoverflow.com/a/2392693
         {
-            byte buf[2]= { (byte) motor_left.get_encoder_distance(),
-                (byte) motor_right.get_encoder_distance() };
+            byte buf[2];
+            get_distance_done(buf);
+            Wire.write(buf, 2);
+            break;
+        }
 
-            for (int i = 0; i < 2; i++) {
-                buf[i] = buf[i] - distance_already_done[i];
-                distance_already_done[i] = distance_already_done[i] + buf[i];
+        // Everything needed while polling the regulation in one read:
+        // [flags (1: done, 2: stopped), left, right,
+        //  lead error (2 bytes), rotation error (2 bytes)].
+        case Status:
+        {
+            byte buf[7] = { 1, 0, 0, 0, 0, 0, 0 };
+            if (regulation) {
+                buf[0] = regulation->is_finished() | (regulation->is_stopped() << 1);
+                int lead_error = regulation->get_last_lead_error();
+                int rot_error = regulation->get_last_rotation_error();
+                buf[3] = lead_error >> 8;
+                buf[4] = lead_error & 0xFF;
+                buf[5] = rot_error >> 8;
+                buf[6] = rot_error & 0xFF;
             }
-
-            Wire.write(buf, 2);
+            get_distance_done(buf + 1);
+            Wire.write(buf, 7);
             break;
         }
 
@@ -222,6 +296,17 @@ void encoder_pulse_left() {
     motor_left.count_encoder_pulse((direction == 0) ? 1 : -1);
 }
 
+// Distance done by each wheel since the last request.
+void get_distance_done(byte *buf) {
+    buf[0] = (byte) motor_left.get_encoder_distance();
+    buf[1] = (byte) motor_right.get_encoder_distance();
+
+    for (int i = 0; i < 2; i++) {
+        buf[i] = buf[i] - distance_already_done[i];
+        distance_already_done[i] = distance_already_done[i] + buf[i];
+    }
+}
+
 void reset_distance_already_done() {
     for (int i = 0; i < 2; i++) {
         distance_already_done[i] = 0;
@@ -28,6 +28,8 @@ void Regulation::tune() {
     // Calculate the error coming from the wheel encoder.
     float lead_error = get_lead_error();
     float rot_error = get_rotation_error();
+    last_lead_error = lead_error;
+    last_rot_error = rot_error;
 
     if (is_finished(lead_error, rot_error)) return;
 
@@ -66,6 +68,14 @@ bool Regulation::is_stopped() const {
     return stopped;
 }
 
+int Regulation::get_last_lead_error() const {
+    return last_lead_error;
+}
+
+int Regulation::get_last_rotation_error() const {
+    return last_rot_error;
+}
+
 bool Regulation::is_finished() const {
     return finished;
 }
@@ -77,6 +87,8 @@ void Regulation::reset() {
     maxspeed = get_maxspeed();
     sum_errors_lead = 0;
     sum_errors_rot = 0;
+    last_lead_error = 0;
+    last_rot_error = 0;
     setpoint = 0;
     finished = true;
 
@@ -226,3 +238,24 @@ RotationRegulation::RotationRegulation(Motor *left, Motor *right): Regulation(le
 float RotationRegulation::get_rotation_error() {
     return setpoint + Regulation::get_rotation_error();
 }
+
+ArcRegulation::ArcRegulation(Motor *left, Motor *right, long straight, long rotation):
+        Regulation(left, right), straight(straight), rotation(rotation) { }
+
+float ArcRegulation::get_lead_error() {
+    return setpoint + Regulation::get_lead_error();
+}
+
+// The rotation setpoint follows the lead progress along the arc so that
+// the robot keeps moving through the corner.
+float ArcRegulation::get_rotation_error() {
+    float lead_done = - Regulation::get_lead_error();
+    float arc = setpoint - straight;
+    float ratio = (arc > 0) ? (lead_done - straight) / arc : 1;
+    ratio = constrain(ratio, 0, 1);
+    return rotation * ratio + Regulation::get_rotation_error();
+}
+
+int ArcRegulation::get_maxspeed() {
+    return MAXSPEED;
+}
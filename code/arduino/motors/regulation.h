@@ -14,6 +14,9 @@ class Regulation {
         void stop();
         bool is_stopped() const;
         bool is_finished() const;
+        // Errors of the last tune() in impulsions.
+        int get_last_lead_error() const;
+        int get_last_rotation_error() const;
 
     protected:
         int setpoint;
@@ -47,6 +50,7 @@ class Regulation {
         int maxspeed;
         float sum_errors_lead, sum_errors_rot;
         bool finished, stopped;
+        float last_lead_error, last_rot_error;
 
         void reset();
         bool is_finished(float lead_err, float rot_err);
@@ -77,4 +81,20 @@ class RotationRegulation : public Regulation {
         float get_rotation_error();
 };
 
+// Lead regulation going straight for "straight" impulsions, then turning
+// of "rotation" impulsions along the rest of the lead setpoint (an arc).
+class ArcRegulation : public Regulation {
+    public:
+        ArcRegulation(Motor *left, Motor *right, long straight, long rotation);
+
+    private:
+        static const int MAXSPEED = 80;
+
+        long straight, rotation;
+
+        float get_lead_error();
+        float get_rotation_error();
+        int get_maxspeed();
+};
+
 #endif
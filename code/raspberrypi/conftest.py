@@ -0,0 +1,3 @@
+# test_regul.py is a benchmark of the real robot run as a script, not a
+# test module: it needs the I2C bus.
+collect_ignore = ['test_regul.py']
@@ -0,0 +1,174 @@
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+import networkx as nx
+
+from .map_generator import build_graph
+
+ROBOT_DIAGONAL = 17.8
+ROBOT_DIMENSION = {'length': 32.5, 'width': 19.2}
+OBSTACLES_DIMENSION = 50
+DIRECTIONS = ['front', 'left', 'right', 'back']
+
+
+class Corpus:
+    """
+    Fixed-seed random queries on the graph map, so that two runs of the
+    benchmark measure the same work.
+    """
+
+    def __init__(self, graph, size, seed=0):
+        rand = random.Random(seed)
+        nodes = sorted(graph._graph.nodes())
+        positions = [graph._graph.node[n]['pos'] for n in nodes]
+
+        self.points = []
+        for _ in range(size):
+            # Points in the free space: near a node of the map.
+            p = rand.choice(positions)
+            self.points.append({
+                'point': [p[0] + rand.uniform(-5, 5), p[1] + rand.uniform(-5, 5)],
+                'angle': rand.uniform(0, 360),
+            })
+
+        self.pairs = [(self.points[i], self.points[(i + 1) % size]) for i in range(size)]
+        self.obstacles = [(self.points[i], rand.choice(DIRECTIONS), rand.uniform(5, 40))
+                          for i in range(size)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def measure(callback, queries, alloc_queries, graph, expect_path=True):
+    """
+    Measure the latency of callback for each query, then the memory
+    allocations on the first alloc_queries ones (tracemalloc slows down the
+    code so both are measured separately).
+
+    Only NetworkXNoPath counts as a failure, anything else is a bug and is
+    raised. Without obstacles every query should have a path: with
+    expect_path, a failure stops the run once measured. The plan cache is
+    cleared before tracing, or the allocations would only be cache hits.
+    """
+    latencies = []
+    failures = 0
+    for query in queries:
+        start = time.perf_counter()
+        try:
+            callback(*query)
+        except nx.NetworkXNoPath:
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+
+    if expect_path and failures:
+        raise Exception('{} of {} queries found no path.'.format(failures, len(queries)))
+
+    graph.clear_plan_cache()
+    tracemalloc.start()
+    blocks = 0
+    peak = 0
+    for query in queries[:alloc_queries]:
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            callback(*query)
+        except nx.NetworkXNoPath:
+            pass
+        after = tracemalloc.take_snapshot()
+        blocks += sum(max(s.count_diff, 0) for s in after.compare_to(before, 'lineno'))
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return {
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'failures': failures,
+        'allocations': blocks / max(min(alloc_queries, len(queries)), 1),
+        'peak_memory': peak,
+    }
+
+
+def check_restored(graph, nodes, edges):
+    """
+    Raise if the obstacles were not all removed: the graph would shrink or
+    the removed elements pile up over the queries and the timings would be
+    meaningless.
+    """
+    cache = graph._obstacles_cache
+    if cache['nodes'] or cache['edges'] or \
+            len(graph._graph.nodes()) != nodes or len(graph._graph.edges()) != edges:
+        raise Exception('reset_obstacles did not restore the graph.')
+
+
+def run(size, seed, alloc_queries):
+    results = {}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    graph = build_graph(ROBOT_DIAGONAL, cache=True)
+    results['build_graph'] = {
+        'p50': time.perf_counter() - start,
+        'p99': time.perf_counter() - start,
+        'failures': 0,
+        'memory': tracemalloc.get_traced_memory()[0],
+    }
+    tracemalloc.stop()
+
+    corpus = Corpus(graph, size, seed)
+    nodes = len(graph._graph.nodes())
+    edges = len(graph._graph.edges())
+
+    results['get_neirest_node_pos'] = measure(
+        graph.get_neirest_node_pos,
+        [(start['point'], target['point']) for start, target in corpus.pairs],
+        alloc_queries, graph)
+
+    results['get_path'] = measure(graph.get_path, corpus.pairs, alloc_queries, graph)
+
+    def add_and_reset(robot_pos, direction, distance):
+        graph.add_obstacle(robot_pos, ROBOT_DIMENSION, OBSTACLES_DIMENSION,
+                           direction, distance)
+        graph.reset_obstacles()
+    results['add_obstacle'] = measure(add_and_reset, corpus.obstacles, alloc_queries, graph)
+    check_restored(graph, nodes, edges)
+
+    def get_path_with_obstacle(obstacle, pair):
+        graph.add_obstacle(obstacle[0], ROBOT_DIMENSION, OBSTACLES_DIMENSION,
+                           obstacle[1], obstacle[2])
+        try:
+            graph.get_path(*pair)
+        finally:
+            graph.reset_obstacles()
+    # A 50 cm obstacle can cover the target or close a passage of the
+    # table: those queries have no path, they are counted but expected.
+    results['get_path_with_obstacle'] = measure(
+        get_path_with_obstacle, list(zip(corpus.obstacles, corpus.pairs)), alloc_queries,
+        graph, expect_path=False)
+    check_restored(graph, nodes, edges)
+
+    return results
+
+
+if __name__ == '__main__':
+    # Run from the raspberrypi directory: python -m graphmap.benchmark
+    parser = argparse.ArgumentParser(description='Benchmark the graph map.')
+    parser.add_argument('--size', type=int, default=2000, help='number of queries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--alloc', type=int, default=100,
+                        help='number of queries traced for the allocations')
+    parser.add_argument('--output', default='graphmap_results.json')
+    args = parser.parse_args()
+
+    results = run(args.size, args.seed, args.alloc)
+    for name, result in sorted(results.items()):
+        print('{:24} p50 {:8.3f} ms  p99 {:8.3f} ms  {} failures'.format(
+            name, result['p50'] * 1000, result['p99'] * 1000, result['failures']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'size': args.size, 'seed': args.seed, 'results': results},
+                  f, indent=4, sort_keys=True)
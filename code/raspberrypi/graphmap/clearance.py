@@ -0,0 +1,152 @@
+import math
+import unittest
+
+import numpy as np
+
+
+class ClearanceField:
+    """
+    Distance from a robot center position to the nearest obstacle of the
+    map. The obstacles are the ones of Mesh, already inflated by the robot
+    radius, and the borders of the free space: the clearance is 0 on the
+    border of the mesh and grows towards the middle of the free space.
+    """
+    # Distance in cm between the samples of a segment.
+    STEP = 1
+    # Number of points computed at once, to bound the memory.
+    CHUNK = 4096
+
+    def __init__(self, lower, upper):
+        """lower, upper: corners of the free space rectangle."""
+        self._lower = lower
+        self._upper = upper
+        self._circles = []
+        self._rectangles = []
+
+    def add_circle(self, center, radius):
+        self._circles.append((center[0], center[1], radius))
+
+    def add_rectangle(self, p1, p2):
+        self._rectangles.append((min(p1[0], p2[0]), min(p1[1], p2[1]),
+                                 max(p1[0], p2[0]), max(p1[1], p2[1])))
+
+    def distance(self, points):
+        """Clearance of each (x, y) point of an (n, 2) array."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return np.concatenate([self.__distance(points[i:i + self.CHUNK])
+                               for i in range(0, len(points), self.CHUNK)] or [np.zeros(0)])
+
+    def segment_distance(self, starts, ends):
+        """Lowest clearance along each segment between starts[i] and ends[i]."""
+        starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+        ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+        if len(starts) == 0:
+            return np.zeros(0)
+
+        # Every segment gets samples at most STEP apart, its ends included.
+        lengths = np.hypot(*(ends - starts).T)
+        counts = np.ceil(lengths / self.STEP).astype(int) + 1
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        segment = np.repeat(np.arange(len(starts)), counts)
+        t = (np.arange(counts.sum()) - offsets[segment]) / np.maximum(counts[segment] - 1, 1)
+        points = starts[segment] + t[:, None] * (ends - starts)[segment]
+        return np.minimum.reduceat(self.distance(points), offsets)
+
+    def __distance(self, points):
+        x = points[:, 0]
+        y = points[:, 1]
+        result = np.minimum.reduce([x - self._lower[0], y - self._lower[1],
+                                    self._upper[0] - x, self._upper[1] - y])
+
+        if self._circles:
+            circles = np.array(self._circles)
+            dist = np.hypot(x[:, None] - circles[:, 0], y[:, None] - circles[:, 1]) - circles[:, 2]
+            result = np.minimum(result, dist.min(axis=1))
+
+        if self._rectangles:
+            rectangles = np.array(self._rectangles)
+            dx = np.maximum(np.maximum(rectangles[:, 0] - x[:, None], x[:, None] - rectangles[:, 2]), 0)
+            dy = np.maximum(np.maximum(rectangles[:, 1] - y[:, None], y[:, None] - rectangles[:, 3]), 0)
+            result = np.minimum(result, np.hypot(dx, dy).min(axis=1))
+
+        return np.maximum(result, 0)
+
+
+def leaning_rectangles(p, height, width, angle, accuracy=10):
+    """
+    Cut a leaning rectangle in accuracy straight rectangles, see
+    Mesh.add_leaning_rectangle_obstacle. Return their (p1, p2) corners.
+    """
+    rectangles = []
+    height_chunck_size = height / accuracy
+    radian_angle = math.radians(angle)
+    for chunck in range(accuracy):
+        pos = chunck * height_chunck_size + height_chunck_size / 2
+        # Get the center of the little rectangle.
+        center = (p[0] + pos * math.cos(radian_angle), p[1] + pos * math.sin(radian_angle))
+        rectangles.append(((center[0] + width / 2, center[1] + height_chunck_size / 2),
+                           (center[0] - width / 2, center[1] - height_chunck_size / 2)))
+    return rectangles
+
+
+class MapObstacles:
+    """
+    The obstacles methods of Mesh without the meshing stack: only fills
+    the ClearanceField of the obstacles inflated by robot_radius, the same
+    as Mesh.clearance. With a zero robot_radius, the distance is the one
+    to the table elements themselves.
+    """
+
+    def __init__(self, dimension, robot_radius):
+        self.robot_radius = robot_radius
+        self._width = dimension[0]
+        self.clearance = ClearanceField((robot_radius, robot_radius),
+                                        (dimension[0] - robot_radius, dimension[1] - robot_radius))
+
+    def add_circle_obstacle(self, p, radius, mirror=False, accuracy=10):
+        self.clearance.add_circle(p, radius + self.robot_radius)
+        # Replicate the circle on the other edge of the map.
+        if mirror:
+            self.clearance.add_circle((self._width - p[0], p[1]), radius + self.robot_radius)
+
+    def add_rectangle_obstacle(self, p1, p2, mirror=False):
+        r = self.robot_radius
+        self.clearance.add_rectangle((p1[0] - r, p1[1] - r), (p2[0] + r, p2[1] + r))
+        if mirror:
+            self.clearance.add_rectangle((self._width - p1[0] + r, p1[1] - r),
+                                         (self._width - p2[0] - r, p2[1] + r))
+
+    def add_leaning_rectangle_obstacle(self, p, height, width, angle, mirror=False, accuracy=10):
+        for p1, p2 in leaning_rectangles(p, height, width, angle, accuracy):
+            self.add_rectangle_obstacle(p1, p2, mirror)
+
+
+class TestClearanceField(unittest.TestCase):
+
+    def test_distance(self):
+        field = ClearanceField((10, 10), (290, 190))
+        field.add_circle((150, 100), 20)
+        field.add_rectangle((60, 50), (40, 30))
+
+        distances = field.distance([(150, 130), (150, 100), (20, 100), (50, 60), (70, 60)])
+        np.testing.assert_allclose(distances, [10, 0, 10, 10, np.hypot(10, 10)])
+        self.assertEqual(field.distance([(5, 100)])[0], 0)
+
+        distances = field.segment_distance([(100, 100), (100, 150), (20, 100)],
+                                           [(200, 100), (200, 150), (20, 100)])
+        np.testing.assert_allclose(distances, [0, 30, 10])
+
+    def test_map_obstacles(self):
+        obstacles = MapObstacles((300, 200), 10)
+        obstacles.add_circle_obstacle((50, 100), 10, mirror=True)
+        obstacles.add_rectangle_obstacle((100, 0), (110, 20), mirror=True)
+        field = obstacles.clearance
+
+        # Inflated by the robot radius, mirrored on the other half.
+        np.testing.assert_allclose(field.distance([(50, 140), (250, 140), (150, 150)]),
+                                   [20, 20, 40])
+        np.testing.assert_allclose(field.distance([(105, 50), (195, 50)]), [20, 20])
+
+
+if __name__ == '__main__':
+    unittest.main()
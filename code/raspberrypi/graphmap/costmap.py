@@ -0,0 +1,223 @@
+import math
+import time
+import unittest
+
+import numpy as np
+
+
+class Costmap:
+    """
+    Occupancy grid of the table updated by the range sensors rays: the
+    cells before a hit are free, the cell of the hit is occupied. Each cell
+    keeps the log-odds of being occupied so a single wrong measure doesn't
+    block the map. The cost of a cell is the highest occupancy probability
+    of the occupied cells nearer than the robot radius (inflation), so the
+    cost of a path of the robot center is read in a single cell per point.
+
+    The positions are in cm, the grid is indexed [y, x].
+
+    The grid can be shared with another process reading it while this one
+    writes it: a sequence counter before the grid is odd during the writes,
+    the reader copies the grid until the counter is even and unchanged.
+    """
+    DIMENSION = (300, 200)
+    # Size of a cell in cm.
+    RESOLUTION = 2
+    # Log-odds added by a hit and by a ray going through a cell.
+    HIT = 0.85
+    MISS = -0.4
+    LOG_ODDS_MIN = -2
+    LOG_ODDS_MAX = 3.5
+    # Cells above this probability are obstacles.
+    OCCUPIED = 0.65
+
+    def __init__(self, robot_radius, dimension=DIMENSION, resolution=RESOLUTION, buffer=None):
+        """
+        buffer: memory of the sequence counter and the grid (e.g. a shared
+        memory to read it from another process), see share().
+        """
+        self.robot_radius = robot_radius
+        self.dimension = dimension
+        self.resolution = resolution
+        self._shape = (int(math.ceil(dimension[1] / resolution)),
+                       int(math.ceil(dimension[0] / resolution)))
+        if buffer is None:
+            self._sequence = np.zeros(1, dtype=np.uint64)
+            self._log_odds = np.zeros(self._shape, dtype=np.float32)
+        else:
+            self.__map(buffer)
+
+        # Offsets of the cells in the robot radius.
+        radius = int(math.ceil(robot_radius / resolution))
+        dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        inside = dx**2 + dy**2 <= (robot_radius / resolution)**2
+        self._kernel = list(zip(dy[inside].tolist(), dx[inside].tolist()))
+        self._costs = None
+
+    def clear(self):
+        self._sequence[0] += 1
+        self._log_odds.fill(0)
+        self._sequence[0] += 1
+        self._costs = None
+
+    def size(self):
+        """Size in bytes of the shared memory."""
+        return self._sequence.nbytes + self._log_odds.nbytes
+
+    def share(self, buffer):
+        """Move the sequence counter and the grid to buffer, at least size() bytes."""
+        sequence, log_odds = self._sequence, self._log_odds
+        self.__map(buffer)
+        self._sequence[:] = sequence
+        self._log_odds[:] = log_odds
+
+    def invalidate(self):
+        """The grid was updated by another process, recompute the costs."""
+        self._costs = None
+
+    def update_rays(self, origins, angles, distances, max_range):
+        """
+        Add a sweep of rays. origins are the (x, y) positions of the sensors,
+        angles their X-axis relative (counterclockwise) direction in degrees
+        and distances the measured ranges, 0 or max_range when nothing is seen.
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        angles = np.radians(np.asarray(angles, dtype=float))
+        distances = np.asarray(distances, dtype=float)
+        directions = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+        hit = (distances > 0) & (distances < max_range)
+        lengths = np.where(hit, distances, max_range)
+
+        # Free space: points every half cell until one cell before the hit.
+        steps = np.arange(0, max_range, self.resolution / 2)
+        free = steps[None, :] < lengths[:, None] - self.resolution
+        points = origins[:, None, :] + steps[None, :, None] * directions[:, None, :]
+        free_cells = self.__flat_cells(points[free])
+
+        hit_points = origins[hit] + lengths[hit][:, None] * directions[hit]
+        hit_cells = self.__flat_cells(hit_points)
+
+        # A cell is updated once by sweep, a hit wins over a free ray.
+        free_cells = np.setdiff1d(free_cells, hit_cells)
+        flat = self._log_odds.reshape(-1)
+        self._sequence[0] += 1
+        flat[free_cells] += self.MISS
+        flat[hit_cells] += self.HIT
+        np.clip(self._log_odds, self.LOG_ODDS_MIN, self.LOG_ODDS_MAX, out=self._log_odds)
+        self._sequence[0] += 1
+        self._costs = None
+
+    def occupancy(self):
+        """Occupancy probability of each cell."""
+        return 1 / (1 + np.exp(-self.__snapshot()))
+
+    def costs(self):
+        """Inflated cost of each cell in [0; 1]."""
+        if self._costs is None:
+            occupancy = self.occupancy()
+            grid = np.where(occupancy > self.OCCUPIED, occupancy, 0).astype(np.float32)
+            self._costs = self.__dilate(grid)
+        return self._costs
+
+    def sample(self, points):
+        """Cost at each (x, y) point, an array of shape (..., 2)."""
+        points = np.asarray(points, dtype=float)
+        ix = np.clip((points[..., 0] // self.resolution).astype(int), 0, self._shape[1] - 1)
+        iy = np.clip((points[..., 1] // self.resolution).astype(int), 0, self._shape[0] - 1)
+        return self.costs()[iy, ix]
+
+    def sample_segments(self, starts, ends):
+        """Highest cost along each segment between starts[i] and ends[i]."""
+        starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+        ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        longest = np.max(np.hypot(*(ends - starts).T))
+        samples = max(2, int(longest / (self.resolution / 2)) + 2)
+        t = np.linspace(0, 1, samples)
+        points = starts[:, None, :] + t[None, :, None] * (ends - starts)[:, None, :]
+        return self.sample(points).max(axis=1)
+
+    def __map(self, buffer):
+        self._sequence = np.ndarray(1, dtype=np.uint64, buffer=buffer)
+        self._log_odds = np.ndarray(self._shape, dtype=np.float32, buffer=buffer,
+                                    offset=self._sequence.nbytes)
+
+    def __snapshot(self):
+        """Copy of the grid, never in the middle of a write of another process."""
+        while True:
+            sequence = int(self._sequence[0])
+            if sequence % 2 == 0:
+                log_odds = self._log_odds.copy()
+                if int(self._sequence[0]) == sequence:
+                    return log_odds
+            time.sleep(0)
+
+    def __flat_cells(self, points):
+        """Unique flat indices of the cells of the points inside the table."""
+        ix = np.floor(points[:, 0] / self.resolution).astype(int)
+        iy = np.floor(points[:, 1] / self.resolution).astype(int)
+        inside = (ix >= 0) & (ix < self._shape[1]) & (iy >= 0) & (iy < self._shape[0])
+        return np.unique(iy[inside] * self._shape[1] + ix[inside])
+
+    def __dilate(self, grid):
+        """Maximum of the grid on the kernel around each cell."""
+        result = grid.copy()
+        ny, nx = grid.shape
+        for dy, dx in self._kernel:
+            if dy == 0 and dx == 0:
+                continue
+            target = result[max(dy, 0):ny + min(dy, 0), max(dx, 0):nx + min(dx, 0)]
+            source = grid[max(-dy, 0):ny + min(-dy, 0), max(-dx, 0):nx + min(-dx, 0)]
+            np.maximum(target, source, out=target)
+        return result
+
+
+class TestCostmap(unittest.TestCase):
+
+    def test_rays(self):
+        costmap = Costmap(10)
+        for i in range(3):
+            costmap.update_rays([(100, 100), (100, 100)], [0, 90], [50, 0], 80)
+
+        # The hit is inflated by the robot radius.
+        self.assertGreater(costmap.sample([150, 100]), Costmap.OCCUPIED)
+        self.assertGreater(costmap.sample([142, 100]), Costmap.OCCUPIED)
+        self.assertEqual(costmap.sample([120, 100]), 0)
+        self.assertEqual(costmap.sample([100, 170]), 0)
+
+        costs = costmap.sample_segments([(145, 80), (100, 120)], [(145, 120), (100, 160)])
+        self.assertGreater(costs[0], Costmap.OCCUPIED)
+        self.assertEqual(costs[1], 0)
+
+        # The free rays clear the obstacle once it is gone.
+        for i in range(10):
+            costmap.update_rays([(100, 100)], [0], [0], 80)
+        self.assertEqual(costmap.sample([150, 100]), 0)
+
+    def test_share(self):
+        import threading
+
+        writer = Costmap(10)
+        writer.update_rays([(100, 100)], [0], [50], 80)
+        buffer = bytearray(writer.size())
+        writer.share(buffer)
+        reader = Costmap(10, buffer=buffer)
+        self.assertGreater(reader.occupancy()[50, 75], 0.5)
+
+        # A write in progress is waited for.
+        def finish_write():
+            writer._log_odds.fill(0)
+            writer._sequence[0] += 1
+        writer._sequence[0] += 1
+        timer = threading.Timer(0.05, finish_write)
+        timer.start()
+        occupancy = reader.occupancy()
+        timer.join()
+        self.assertEqual(occupancy[50, 75], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import math
+import threading
+import unittest
+
+import networkx as nx
+
+
+class DetourSpeculator:
+    """
+    Look for the detours of the likely obstacle events of a segment while
+    the robot drives it, so that the robot goes on without planning delay
+    when an obstacle stops it.
+
+    Robot.__move_callback adds the obstacle relative to the position at the
+    start of the segment, so the obstacles of an event only depend on its
+    direction. The robot stops somewhere on the segment, so the routes are
+    searched from start poses every STEP cm (ANGLE_STEP degrees for a
+    turn), on a fork of the graph map in a background thread. get() takes
+    the route of the nearest start pose and converts it from the real
+    position, unless the current obstacles block it.
+
+    The graph map must not be modified between start() and cancel().
+    """
+    STEP = 10
+    ANGLE_STEP = 30
+    MAX_POSES = 8
+    # A route is only used nearer than this distance in cm of its start.
+    TOLERANCE = 10
+
+    def __init__(self, graph_map, robot_dim, obstacle_dim, directions):
+        """
+        directions: (direction, distance) of the events, with the same
+        direction names as GraphMap.add_obstacle and the distance the
+        obstacle is expected at (the trigger limit of the sensors).
+        """
+        self._graph_map = graph_map
+        self._robot_dim = robot_dim
+        self._obstacle_dim = obstacle_dim
+        self._directions = directions
+        # Held by the worker while it copies the graph map.
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cancel = threading.Event()
+        self._target = None
+        self._routes = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def start(self, segment_start, action, target, fastest=False, arcs=False):
+        """
+        Look for the detours of the segment starting at segment_start, with
+        the fastest and arcs options of GraphMap.get_path.
+        """
+        self.cancel()
+        self._cancel = threading.Event()
+        self._target = target
+        self._routes = {}
+        self._thread = threading.Thread(target=self.__run, name='detours', daemon=True, args=(
+            self._cancel, self._routes, segment_start, self.__poses(segment_start, action),
+            self.__directions(action), target, fastest, arcs))
+        self._lock.acquire()
+        self._thread.start()
+
+    def cancel(self):
+        """
+        Stop the search. Only waits for the end of the copy of the graph
+        map, so the graph map can be modified afterwards.
+        """
+        self._cancel.set()
+        with self._lock:
+            pass
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def get(self, direction, robot_pos, target, arcs=False):
+        """
+        Return the instructions of the detour for an obstacle in the given
+        direction, or None if there is none ready.
+        """
+        self.cancel()
+        best = None
+        if target == self._target:
+            for pose, route in list(self._routes.get(direction, [])):
+                dist = math.hypot(robot_pos['point'][0] - pose['point'][0],
+                                  robot_pos['point'][1] - pose['point'][1])
+                turn = abs((robot_pos['angle'] - pose['angle'] + 180) % 360 - 180)
+                if dist <= self.TOLERANCE and turn <= self.ANGLE_STEP and \
+                        (best is None or (dist, turn) < best[0]):
+                    best = ((dist, turn), route)
+
+        instructions = None
+        if best is not None:
+            instructions = self._graph_map.get_path_from_route(robot_pos, target, best[1], arcs)
+        self.stats['misses' if instructions is None else 'hits'] += 1
+        return instructions
+
+    def __run(self, cancel, routes, segment_start, poses, directions, target, fastest, arcs):
+        try:
+            graph_map = self._graph_map.fork()
+        finally:
+            self._lock.release()
+
+        for direction, distance in directions:
+            graph_map.reset_obstacles()
+            graph_map.add_obstacle(segment_start, self._robot_dim, self._obstacle_dim,
+                                   direction, distance)
+            for pose in poses:
+                if cancel.is_set():
+                    return
+                try:
+                    route = graph_map.get_route(pose, target, fastest, arcs)
+                except nx.NetworkXNoPath:
+                    continue
+                routes.setdefault(direction, []).append((pose, route))
+
+    def __poses(self, segment_start, action):
+        """Start poses where the robot could stop during the action."""
+        point = segment_start['point']
+        angle = segment_start['angle']
+        if action['action'] == 'turn':
+            # Positive to the right.
+            sign = -1 if action['value'] > 0 else 1
+            count = min(self.MAX_POSES, int(abs(action['value']) // self.ANGLE_STEP) + 1)
+            return [{'point': point, 'angle': (angle + sign * i * self.ANGLE_STEP) % 360}
+                    for i in range(count)]
+
+        # Only the straight part of an arc.
+        length = action['straight'] if action['action'] == 'arc' else action['value']
+        sign = 1 if length >= 0 else -1
+        count = min(self.MAX_POSES, int(abs(length) // self.STEP) + 1)
+        return [{'point': (point[0] + sign * i * self.STEP * math.cos(math.radians(angle)),
+                           point[1] + sign * i * self.STEP * math.sin(math.radians(angle))),
+                 'angle': angle} for i in range(count)]
+
+    def __directions(self, action):
+        """The directions of the events, the most likely first."""
+        if action['action'] == 'turn':
+            return self._directions
+        forward = action['straight' if action['action'] == 'arc' else 'value'] >= 0
+        ahead = 'front' if forward else 'back'
+        behind = 'back' if forward else 'front'
+        return sorted([d for d in self._directions if d[0] != behind],
+                      key=lambda d: d[0] != ahead)
+
+
+class TestDetourSpeculator(unittest.TestCase):
+
+    class GraphMap:
+        """Graph map routing through the obstacle direction."""
+
+        def __init__(self):
+            self.direction = None
+
+        def fork(self):
+            return TestDetourSpeculator.GraphMap()
+
+        def reset_obstacles(self):
+            self.direction = None
+
+        def add_obstacle(self, robot_pos, robot_dim, obstacle_dim, direction, distance):
+            self.direction = direction
+
+        def get_route(self, robot_pos, target, fastest, arcs):
+            return [self.direction, robot_pos['point'][0]]
+
+        def get_path_from_route(self, robot_pos, target, route, arcs):
+            return [{'action': 'move', 'value': route}]
+
+    def test_detours(self):
+        speculator = DetourSpeculator(self.GraphMap(), {}, 50,
+                                      [('front', 10), ('left', 10), ('right', 10), ('back', 5)])
+        target = {'point': (200, 100), 'angle': 0}
+        speculator.start({'point': (0, 0), 'angle': 0}, {'action': 'move', 'value': 45}, target)
+        speculator.join()
+
+        instructions = speculator.get('left', {'point': (22, 1), 'angle': 2}, target)
+        self.assertEqual(instructions[0]['value'], ['left', 20])
+        # Moving forward, nothing comes from the back.
+        self.assertIsNone(speculator.get('back', {'point': (22, 1), 'angle': 2}, target))
+        self.assertIsNone(speculator.get('front', {'point': (70, 0), 'angle': 0}, target))
+        self.assertIsNone(speculator.get('front', {'point': (0, 0), 'angle': 0}, {'point': (0, 0)}))
+        self.assertEqual(speculator.stats, {'hits': 1, 'misses': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,72 +1,267 @@
+import collections
+import copy
+import heapq
+import itertools
 import math
 import os.path
 import operator
 import pprint
+import threading
+import unittest
 
 import networkx as nx
 
+from telemetry import Event, telemetry
+from tracing import traced
+from .trajectory import TrajectoryCompiler
 from .utils import GraphUtils
 
 class GraphMap:
     CACHE_PATH = 'graphmap.data'
-    def __init__(self, nodes, triangles, cache=True):
+    # Size in cm of the cells of the spatial index.
+    INDEX_CELL_SIZE = 20
+    # The start and target must be nearer than this distance in cm of a node.
+    MAX_NODE_DISTANCE = 100
+    # Number of nodes linked to the start and the target, at most
+    # CANDIDATES_MARGIN cm farther than the nearest one (the virtual edges
+    # don't know the table borders).
+    CANDIDATES = 5
+    CANDIDATES_MARGIN = 20
+    # Cost in cm of one degree of heading change to join the start or target.
+    HEADING_WEIGHT = 0.2
+    # Node ids of the start and target, only added to the graph by display.
+    START_NODE_ID = 1000
+    END_NODE_ID = 1001
+    # Key of the target in the search.
+    TARGET = -1
+    # Heading resolution in degrees of the fastest path search states.
+    HEADING_RESOLUTION = 5
+    # With a costmap, an edge costs its weight * (1 + COSTMAP_WEIGHT * cost)
+    # and is removed above the COSTMAP_LETHAL cost.
+    COSTMAP_WEIGHT = 4
+    COSTMAP_LETHAL = 0.9
+    # Number of paths kept by the plan cache. The start point is rounded
+    # to PLAN_POINT_RESOLUTION cm and its angle to PLAN_ANGLE_RESOLUTION
+    # degrees, so the cached instructions may be that far from the exact
+    # ones. The costmap costs are rounded to 1 / PLAN_COST_STEPS.
+    PLAN_CACHE_SIZE = 64
+    PLAN_POINT_RESOLUTION = 1
+    PLAN_ANGLE_RESOLUTION = 2
+    PLAN_COST_STEPS = 10
+    # The weight of an edge is its length * (1 + CLEARANCE_WEIGHT * (1 -
+    # clearance / SAFE_CLEARANCE)) when it passes nearer than SAFE_CLEARANCE
+    # cm of an obstacle, so the paths keep away from the walls when the
+    # detour is short.
+    SAFE_CLEARANCE = 15
+    CLEARANCE_WEIGHT = 1
+
+    def __init__(self, nodes, triangles, cache=True, graph=None, clearance=None):
         """
         nodes represent the (x, y) address of nodes in the graph.
         triangles give the 3 positions in nodes array to form a triangle.
+        graph: an already built graph (e.g. by the planner process), used
+        instead of the cache and the mesh.
+        clearance: the ClearanceField of the map obstacles, to store the
+        clearance of the nodes and edges of the graph, whatever its source
+        (the cache may have been built without it).
         """
         self._cache = cache
 
         # Remove nodes and edges to simulate obstacles.
         self._obstacles_cache = {'nodes': [], 'edges': []}
 
-        self._graph = None
-        if self._cache and os.path.exists(self.CACHE_PATH):
-            self._graph = self.__read_cache()
-        else:
-            self.__build_graph_from_mesh(nodes, triangles)
-
-    def get_path(self, robot_pos, target, display=False):
-        # Give ID to the start node and end node.
-        START_NODE_ID = 1000
-        END_NODE_ID = 1001
-
-        # Remove edge added to the process before looking for the shortest path.
-        # This could give unvalid result.
-        nodes = self._graph.nodes()
-        if START_NODE_ID in nodes and END_NODE_ID in nodes:
-            self._graph.remove_node(START_NODE_ID)
-            self._graph.remove_node(END_NODE_ID)
-
-        # Get the neirest node from the robot position and the target position.
-        # The direction is of start_node is the target (make sense) and vise-versa.
-        start_node = self.get_neirest_node_pos(robot_pos['point'], target['point'])
-        end_node = self.get_neirest_node_pos(target['point'], robot_pos['point'])
+        # Spatial index and route table built by warm_up().
+        self._index = None
+        self._routes = None
+        self._route_lengths = None
+        self._obstacles_active = False
+        # Bounding boxes of the obstacles, the virtual edges can't cross them.
+        self._obstacles_boxes = []
+        # Key of the removed nodes and edges, the boxes and the costmap
+        # weights, computed by the first get_path after a change.
+        self._obstacles_key = None
+        self._costmap_key = None
+
+        # LRU cache of the instructions of get_path.
+        self._plans = collections.OrderedDict()
+        self._plans_lock = threading.Lock()
+        self.plan_cache_stats = {'hits': 0, 'misses': 0}
 
-        path = nx.shortest_path(self._graph, source=start_node, target=end_node, weight='weight')
+        self._graph = graph
+        if self._graph is None and not (self._cache and os.path.exists(self.CACHE_PATH)):
+            self.__build_graph_from_mesh(nodes, triangles, clearance)
+        else:
+            if self._graph is None:
+                self._graph = self.__read_cache()
+            if clearance is not None:
+                self.__set_clearance(clearance)
 
-        self._graph.add_node(START_NODE_ID, pos=robot_pos['point'], color='green')
-        self._graph.add_node(END_NODE_ID, pos=target['point'], color='green')
+    @traced('graphmap.get_path')
+    def get_path(self, robot_pos, target, display=False, arcs=False, fastest=False):
+        """
+        Return the instructions to go from robot_pos to target. With arcs,
+        the path is fitted with straight lines and arcs by TrajectoryCompiler
+        and each instruction has an expected "duration". With fastest, the
+        path minimizes the time given by the TrajectoryCompiler speeds and
+        command overhead, turns (arcs with arcs) and the start and target
+        angles included, instead of the distance.
+
+        The robot and the target are linked to the CANDIDATES nearest nodes
+        around them by virtual edges, the search picks the best pair so the
+        path doesn't start with a hop behind the robot. The graph isn't
+        modified (except with display) so several threads can look for a
+        path at the same time.
+
+        The instructions are cached for the same rounded start position,
+        target and obstacles, see PLAN_CACHE_SIZE.
+        """
+        key = None
+        if not display:
+            key = self.__plan_key(robot_pos, target, arcs, fastest)
+            with self._plans_lock:
+                plan = self._plans.get(key)
+                if plan is not None:
+                    self._plans.move_to_end(key)
+                    self.plan_cache_stats['hits'] += 1
+                    return [dict(instruction) for instruction in plan]
+                self.plan_cache_stats['misses'] += 1
+
+        instructions = self.__compute_path(robot_pos, target, display, arcs, fastest)
+
+        if key is not None:
+            with self._plans_lock:
+                self._plans[key] = [dict(instruction) for instruction in instructions]
+                if len(self._plans) > self.PLAN_CACHE_SIZE:
+                    self._plans.popitem(last=False)
+        return instructions
+
+    def __compute_path(self, robot_pos, target, display, arcs, fastest):
+        path = self.get_route(robot_pos, target, fastest, arcs)
 
         # If we display the graph map, color the path that the robot should have taken.
         if display:
-            self._graph.add_edge(START_NODE_ID, path[0], color='green')
-            self._graph.add_edge(path[-1], END_NODE_ID, color='green')
-            for i in range(len(path) - 1):
-                self._graph.edge[path[i]][path[i+1]]['color'] = 'green'
+            self.__color_path(path, robot_pos, target)
+        return self.__route_to_instructions(robot_pos, target, path, arcs)
+
+    def get_route(self, robot_pos, target, fastest=False, arcs=False):
+        """Return the nodes of the path of get_path, without the instructions."""
+        start = self.__get_candidates(robot_pos, leaving=True)
+        goal = self.__get_candidates(target, leaving=False)
+        if not start or not goal:
+            raise nx.NetworkXNoPath('No node near {} or {}'.format(robot_pos['point'], target['point']))
+
+        if fastest:
+            return self.__search_fastest(robot_pos, target, start, goal, arcs)
+        elif self._routes is not None and not self._obstacles_active:
+            return self.__get_path_from_routes(start, goal)
+        return self.__search(start, goal)
+
+    def get_path_from_route(self, robot_pos, target, path, arcs=False):
+        """
+        Return the instructions to follow the nodes of a route computed
+        before (e.g. by another thread on a fork), or None if the current
+        obstacles block it.
+        """
+        for i, n in enumerate(path):
+            if n not in self._graph:
+                return None
+            if i > 0 and n not in self._graph.edge[path[i - 1]]:
+                return None
+        if path:
+            first = self._graph.node[path[0]]['pos']
+            last = self._graph.node[path[-1]]['pos']
+            if self.__distance_btw_points(robot_pos['point'], first) > self.MAX_NODE_DISTANCE or \
+                    not self.__is_visible(robot_pos['point'], first, from_start=True) or \
+                    not self.__is_visible(last, target['point']):
+                return None
+        return self.__route_to_instructions(robot_pos, target, path, arcs)
+
+    def fork(self):
+        """
+        Return a copy of the graph map with its own graph and obstacles, to
+        look for paths with other obstacles in another thread. The index
+        and the route table are shared.
+        """
+        graph_map = copy.copy(self)
+        graph_map._graph = self._graph.copy()
+        graph_map._obstacles_cache = copy.deepcopy(self._obstacles_cache)
+        graph_map._obstacles_boxes = list(self._obstacles_boxes)
+        graph_map._plans = collections.OrderedDict()
+        graph_map._plans_lock = threading.Lock()
+        graph_map.plan_cache_stats = {'hits': 0, 'misses': 0}
+        return graph_map
+
+    def __route_to_instructions(self, robot_pos, target, path, arcs):
+        points = [robot_pos['point']]
+        for p in [self._graph.node[n]['pos'] for n in path] + [target['point']]:
+            # The robot or the target can be on a node.
+            if self.__distance_btw_points(points[-1], p) > 0.05:
+                points.append(p)
+        if len(points) == 1:
+            points.append(target['point'])
+        if arcs:
+            return TrajectoryCompiler().compile(points, robot_pos['angle'], target['angle'])[0]
+        return self.__convert_points_to_instruction(points, robot_pos['angle'], target['angle'])
+
+    def warm_up(self):
+        """
+        Build the spatial index of the nodes and the route table of the graph
+        without obstacles, so that the first get_path of the match is fast.
+        """
+        self._index = {}
+        for n in self._graph.nodes():
+            cell = self.__index_cell(self._graph.node[n]['pos'])
+            self._index.setdefault(cell, []).append(n)
 
-        path = [START_NODE_ID] + path
-        path.append(END_NODE_ID)
+        self._routes = dict(nx.all_pairs_dijkstra_path(self._graph, weight='weight'))
+        self._route_lengths = dict(nx.all_pairs_dijkstra_path_length(self._graph, weight='weight'))
 
-        return self.__convert_nodelist_to_instruction(path, robot_pos['angle'], target['angle'])
+    def clear_plan_cache(self):
+        with self._plans_lock:
+            self._plans.clear()
+            self.plan_cache_stats = {'hits': 0, 'misses': 0}
 
     def add_obstacle(self, robot_pos, robot_dim, obstacle_dim, obstacle_position, obstacle_distance):
+        self._obstacles_active = True
+        self._obstacles_key = None
         obstacle_points = self.__create_obstacle_rectangle(robot_pos, robot_dim, obstacle_dim, obstacle_position,
                 obstacle_distance)
         (minx, miny, maxx, maxy) = GraphUtils.get_min_max_points(obstacle_points)
+        self._obstacles_boxes.append((minx, miny, maxx, maxy))
+        self.__remove_box(minx, miny, maxx, maxy)
 
+    def add_moving_obstacle(self, robot_pos, trajectory, radius, margin=1):
+        """
+        Add an obstacle of the given radius following trajectory, a list of
+        (t, (x, y)) predicted positions like OpponentTracker.predict gives.
+        The position at t = 0 is always an obstacle. A later position only
+        blocks the nodes and edges the robot would reach, going straight at
+        TrajectoryCompiler.SPEED, less than margin seconds away from t.
+        """
+        self._obstacles_active = True
+        self._obstacles_key = None
+        for t, p in trajectory:
+            box = (p[0] - radius, p[1] - radius, p[0] + radius, p[1] + radius)
+            if t == 0:
+                self._obstacles_boxes.append(box)
+                self.__remove_box(*box)
+                continue
+
+            def is_free(pos):
+                arrival = self.__distance_btw_points(robot_pos['point'], pos) / TrajectoryCompiler.SPEED
+                return abs(arrival - t) > margin
+            self.__remove_box(*box, is_free=is_free)
+
+    def __remove_box(self, minx, miny, maxx, maxy, is_free=None):
+        """
+        Remove the nodes in the box and the edges crossing it, except the
+        ones with is_free(position) true (the middle of the edges).
+        """
         for n in self._graph.nodes():
             p = self._graph.node[n]['pos']
             if GraphUtils.is_point_in_rectangle(minx, miny, maxx, maxy, p[0], p[1]):
+                if is_free is not None and is_free(p):
+                    continue
                 # Remove nodes and every edges in it.
                 self._obstacles_cache['nodes'].append({'id': n, 'attr': self._graph.node[n]})
 
@@ -80,12 +275,38 @@ class GraphMap:
             p2 = self._graph.node[edge[1]]['pos']
 
             if GraphUtils.is_line_cross_rectangle(minx, miny, maxx, maxy, p1[0], p1[1], p2[0], p2[1]):
+                if is_free is not None and is_free(((p1[0] + p2[0]) / 2, (p1[1] + p2[1]) / 2)):
+                    continue
                 # We can remove the edge.
                 self._obstacles_cache['edges'].append({'id': edge,
                     'attr': self._graph.edge[edge[0]][edge[1]]})
                 self._graph.remove_edge(edge[0], edge[1])
 
+    def apply_costmap(self, costmap):
+        """
+        Weight the edges with the highest cost along them in a
+        costmap.Costmap, sampled for all the edges at once.
+        """
+        edges = list(self._graph.edges())
+        costs = costmap.sample_segments([self._graph.node[a]['pos'] for a, b in edges],
+                                        [self._graph.node[b]['pos'] for a, b in edges])
+        self._obstacles_active = True
+        self._obstacles_key = None
+        self._costmap_key = (costs * self.PLAN_COST_STEPS).round().tobytes()
+        for (a, b), cost in zip(edges, costs.tolist()):
+            attr = self._graph.edge[a][b]
+            weight = attr.setdefault('base_weight', attr['weight'])
+            if cost >= self.COSTMAP_LETHAL:
+                self._obstacles_cache['edges'].append({'id': (a, b), 'attr': attr})
+                self._graph.remove_edge(a, b)
+            else:
+                attr['weight'] = weight * (1 + self.COSTMAP_WEIGHT * cost)
+
     def reset_obstacles(self):
+        self._obstacles_active = False
+        self._obstacles_boxes = []
+        self._obstacles_key = None
+        self._costmap_key = None
         # Add back the nodes.
         for node in self._obstacles_cache['nodes']:
             self._graph.add_node(node['id'], attr_dict=node['attr'])
@@ -93,6 +314,12 @@ class GraphMap:
         # Add back the edges.
         for edge in self._obstacles_cache['edges']:
             self._graph.add_edge(edge['id'][0], edge['id'][1], attr_dict=edge['attr'])
+        self._obstacles_cache = {'nodes': [], 'edges': []}
+
+        # Remove the costmap weights.
+        for a, b, attr in self._graph.edges(data=True):
+            if 'base_weight' in attr:
+                attr['weight'] = attr['base_weight']
 
     def display(self):
         """
@@ -109,6 +336,9 @@ class GraphMap:
                          node_color=node_color, ax=ax)
         plt.show()
 
+    def get_graph(self):
+        return self._graph
+
     def save(self):
         nx.write_gpickle(self._graph, self.CACHE_PATH)
 
@@ -117,26 +347,239 @@ class GraphMap:
 
     def get_neirest_node_pos(self, point, direction):
         """
-        Get the neirest node position according to the direction.
-        Takes 2 nodes ID and return another one.
+        Get the neirest node of a point.
+        """
+        nearest = self.__get_nearest_nodes(point, 1)
+        if not nearest:
+            raise nx.NetworkXNoPath('No node near {}'.format(point))
+        return nearest[0][1]
+
+    def __plan_key(self, robot_pos, target, arcs, fastest):
+        if self._obstacles_key is None:
+            nodes = frozenset(node['id'] for node in self._obstacles_cache['nodes'])
+            edges = frozenset(tuple(sorted(edge['id'])) for edge in self._obstacles_cache['edges'])
+            boxes = tuple(tuple(round(v / self.PLAN_POINT_RESOLUTION) for v in box)
+                          for box in self._obstacles_boxes)
+            # The values themselves and not their hash: a collision would
+            # return the plan of other obstacles.
+            self._obstacles_key = (nodes, edges, boxes, self._costmap_key)
+
+        point = robot_pos['point']
+        return (round(point[0] / self.PLAN_POINT_RESOLUTION),
+                round(point[1] / self.PLAN_POINT_RESOLUTION),
+                round(robot_pos['angle'] / self.PLAN_ANGLE_RESOLUTION) % (360 // self.PLAN_ANGLE_RESOLUTION),
+                tuple(target['point']), target['angle'], arcs, fastest, self._obstacles_key)
+
+    def __index_cell(self, pos):
+        return (int(pos[0] // self.INDEX_CELL_SIZE), int(pos[1] // self.INDEX_CELL_SIZE))
+
+    def __get_nearest_nodes(self, point, k):
         """
-        best_matches = {'dist_point': 100}
-        # Get the neirest points.
+        Return the (distance, node) of the k nearest nodes nearer than
+        MAX_NODE_DISTANCE, sorted by distance.
+        """
+        if self._index is not None:
+            return self.__get_nearest_nodes_from_index(point, k)
+
+        matches = []
         for node in self._graph.nodes():
+            if node in (self.START_NODE_ID, self.END_NODE_ID):
+                continue
+            dist_point = self.__distance_btw_points(point, self._graph.node[node]['pos'])
+            if dist_point < self.MAX_NODE_DISTANCE:
+                matches.append((dist_point, node))
+        return heapq.nsmallest(k, matches)
+
+    def __get_nearest_nodes_from_index(self, point, k):
+        """
+        Same as __get_nearest_nodes but only looks at the index cells around
+        the point, ring after ring, until no nearer node is possible.
+        """
+        matches = []
+        cx, cy = self.__index_cell(point)
+        rings = int(self.MAX_NODE_DISTANCE // self.INDEX_CELL_SIZE) + 1
+        for ring in range(rings + 1):
+            for dx in range(-ring, ring + 1):
+                for dy in range(-ring, ring + 1):
+                    if max(abs(dx), abs(dy)) != ring:
+                        continue
+                    for node in self._index.get((cx + dx, cy + dy), []):
+                        # The node could have been removed by an obstacle.
+                        if node not in self._graph:
+                            continue
+                        dist_point = self.__distance_btw_points(point, self._graph.node[node]['pos'])
+                        if dist_point < self.MAX_NODE_DISTANCE:
+                            matches.append((dist_point, node))
+            matches = heapq.nsmallest(k, matches)
+            # Nodes in the next rings are at least this distance away.
+            if len(matches) == k and matches[-1][0] <= ring * self.INDEX_CELL_SIZE:
+                break
+        return matches
+
+    def __get_candidates(self, pos, leaving):
+        """
+        Return a dict giving the cost of the virtual edge between pos and
+        each of its nearest visible nodes: the distance plus the heading
+        change. When leaving, the robot turns from its angle to the node
+        direction, else it turns from the node direction to the target angle.
+        """
+        candidates = {}
+        nearest = self.__get_nearest_nodes(pos['point'], self.CANDIDATES)
+        for dist, node in nearest:
+            node_pos = self._graph.node[node]['pos']
+            if dist > nearest[0][0] + self.CANDIDATES_MARGIN:
+                break
+            if not self.__is_visible(pos['point'], node_pos, from_start=leaving):
+                continue
+
+            heading_change = 0
+            # Too close to have a meaningful direction.
+            if dist > 1:
+                if leaving:
+                    heading = math.atan2(node_pos[1] - pos['point'][1], node_pos[0] - pos['point'][0])
+                else:
+                    heading = math.atan2(pos['point'][1] - node_pos[1], pos['point'][0] - node_pos[0])
+                heading_change = abs((math.degrees(heading) - pos['angle'] + 180) % 360 - 180)
+            candidates[node] = dist + self.HEADING_WEIGHT * heading_change
+        return candidates
+
+    def __is_visible(self, p1, p2, from_start=False):
+        """
+        Return True if the segment crosses no obstacle box. from_start: p1
+        is the robot, the boxes around it are ignored, as the box of an
+        obstacle seen at a diagonal heading contains the robot.
+        """
+        for (minx, miny, maxx, maxy) in self._obstacles_boxes:
+            if from_start and minx <= p1[0] <= maxx and miny <= p1[1] <= maxy:
+                continue
+            if GraphUtils.is_line_cross_rectangle(minx, miny, maxx, maxy, p1[0], p1[1], p2[0], p2[1]):
+                return False
+        return True
+
+    def __search(self, start, goal):
+        """
+        Dijkstra from all the start candidates at once, the target is reached
+        through the virtual edges of the goal candidates. Return the node path
+        without the start and the target.
+        """
+        visited = {}
+        order = itertools.count()
+        queue = [(cost, next(order), node, None) for node, cost in start.items()]
+        heapq.heapify(queue)
+        while queue:
+            cost, _, node, previous = heapq.heappop(queue)
+            if node in visited:
+                continue
+            visited[node] = previous
+            if node == self.TARGET:
+                path = []
+                node = previous
+                while node is not None:
+                    path.append(node)
+                    node = visited[node]
+                return path[::-1]
+
+            if node in goal:
+                heapq.heappush(queue, (cost + goal[node], next(order), self.TARGET, node))
+            for neighbor, attr in self._graph[node].items():
+                if neighbor not in visited:
+                    heapq.heappush(queue, (cost + attr['weight'], next(order), neighbor, node))
+        raise nx.NetworkXNoPath('No path between the start and the target')
+
+    def __search_fastest(self, robot_pos, target, start, goal, arcs):
+        """
+        Dijkstra on the time to reach (node, heading) states, with the
+        corners timed by TrajectoryCompiler.corner_time: a turn in place
+        costs its rotation and the restart of the motors, so a longer path
+        with less turns can be faster. With arcs the corners are timed as
+        the arcs the compiler fits in them, which depend on the length of
+        the segments around: the length of the segment reaching a state is
+        the one of its first (fastest) visit.
+        """
+        model = TrajectoryCompiler()
+        restart = model.SPEED / model.ACCELERATION + model.COMMAND_OVERHEAD
+        visited = {}
+        order = itertools.count()
+        queue = []
+        for node in start:
             node_pos = self._graph.node[node]['pos']
-            dist_point = self.__distance_btw_points(point, node_pos)
-
-            if dist_point < best_matches['dist_point']:
-                best_matches = { 'dist_point': dist_point, 'node': node }
-            #  dist_dest = self.__distance_btw_points(direction, node_pos)
-            #  if dist_point < 30:
-                #  best_matches.append({'dist_point': dist_point,
-                                     #  'dist_dest': dist_dest,
-                                     #  'node': node})
-        # Get the point which is the closest to the direction we need to go to.
-        #  pprint.pprint(best_matches)
-        #  return sorted(best_matches, key=operator.itemgetter('dist_dest'))[0]['node']
-        return best_matches['node']
+            heading = self.__get_heading(robot_pos['point'], node_pos, robot_pos['angle'])
+            # The first segment only has a corner at its end.
+            length = self.__distance_btw_points(robot_pos['point'], node_pos)
+            cost = model.turn_time((heading - robot_pos['angle'] + 180) % 360 - 180) + \
+                length / model.SPEED + restart
+            queue.append((cost, next(order), node, heading, length, None))
+        heapq.heapify(queue)
+
+        while queue:
+            cost, _, node, heading, available, previous = heapq.heappop(queue)
+            key = self.TARGET if node == self.TARGET else \
+                (node, int(round(heading / self.HEADING_RESOLUTION)))
+            if key in visited:
+                continue
+            visited[key] = previous
+            if key == self.TARGET:
+                path = []
+                key = previous
+                while key is not None:
+                    path.append(key[0])
+                    key = visited[key]
+                return path[::-1]
+
+            node_pos = self._graph.node[node]['pos']
+            if node in goal:
+                # The last segment only has a corner at its start, the last
+                # turn isn't followed by a move.
+                length = self.__distance_btw_points(node_pos, target['point'])
+                last_heading = self.__get_heading(node_pos, target['point'], heading)
+                total = cost + model.corner_time((last_heading - heading + 180) % 360 - 180,
+                                                 min(available, length), arcs) + \
+                    length / model.SPEED + \
+                    model.turn_time((target['angle'] - last_heading + 180) % 360 - 180)
+                heapq.heappush(queue, (total, next(order), self.TARGET, None, 0, key))
+            for neighbor, attr in self._graph[node].items():
+                neighbor_pos = self._graph.node[neighbor]['pos']
+                # A segment between two corners is shared by them.
+                length = self.__distance_btw_points(node_pos, neighbor_pos) / 2
+                next_heading = self.__get_heading(node_pos, neighbor_pos, heading)
+                total = cost + model.corner_time((next_heading - heading + 180) % 360 - 180,
+                                                 min(available, length), arcs) + \
+                    attr['weight'] / model.SPEED
+                heapq.heappush(queue, (total, next(order), neighbor, next_heading, length, key))
+        raise nx.NetworkXNoPath('No path between the start and the target')
+
+    def __get_heading(self, p1, p2, default):
+        """Counterclockwise angle of the p1 to p2 direction (default if too close)."""
+        if self.__distance_btw_points(p1, p2) < 1:
+            return default
+        return math.degrees(math.atan2(p2[1] - p1[1], p2[0] - p1[0]))
+
+    def __get_path_from_routes(self, start, goal):
+        """Same as __search with the route table, without obstacles."""
+        best = None
+        for s, start_cost in start.items():
+            lengths = self._route_lengths[s]
+            for g, goal_cost in goal.items():
+                if g not in lengths:
+                    continue
+                cost = start_cost + lengths[g] + goal_cost
+                if best is None or cost < best[0]:
+                    best = (cost, s, g)
+        if best is None:
+            raise nx.NetworkXNoPath('No path between the start and the target')
+        return self._routes[best[1]][best[2]]
+
+    def __color_path(self, path, robot_pos, target):
+        """Add the start and the target to the graph to display the path."""
+        for node in [self.START_NODE_ID, self.END_NODE_ID]:
+            if node in self._graph:
+                self._graph.remove_node(node)
+        self._graph.add_node(self.START_NODE_ID, pos=robot_pos['point'], color='green')
+        self._graph.add_node(self.END_NODE_ID, pos=target['point'], color='green')
+        self._graph.add_edge(self.START_NODE_ID, path[0], color='green')
+        self._graph.add_edge(path[-1], self.END_NODE_ID, color='green')
+        for i in range(len(path) - 1):
+            self._graph.edge[path[i]][path[i+1]]['color'] = 'green'
 
     def __simplify_turn_angle(self, angle):
         """
@@ -146,14 +589,15 @@ class GraphMap:
         if abs(angle) > 180:
             sign = 1 if angle > 0 else -1
             angle = -sign*(360 - abs(angle))
-        return round(angle)
+        return round(angle, 1)
 
-    def __convert_nodelist_to_instruction(self, path, robot_angle, target_angle):
+    def __convert_points_to_instruction(self, points, robot_angle, target_angle):
         """
-        Convert the node id list to instruction easily understandable for the robot control.
+        Convert the (x, y) positions list to instruction easily understandable for the robot control.
         Return a list of dict() with a key giving the movement ("move" or "turn") and a key giving
         a value (distance in cm for "move" or turning degrees for "turn"). The value can be positive
-        or negative.
+        or negative and is rounded to a tenth of unit. Segments are never split as the motors
+        wide protocol handles values up to 3276.7.
 
         value/movement|  "move"    |    "turn"
         ----------------------------------------
@@ -165,21 +609,21 @@ class GraphMap:
         actions = []
 
         # First turn is a bit specific so we don't do it in the for loop.
-        start_angle_constrain = self.__get_node_angle(path[1], path[0])
+        start_angle_constrain = self.__get_pos_angle(points[1], points[0])
         actions.append({'action': 'turn', 'value': self.__simplify_turn_angle(robot_angle
             - start_angle_constrain)})
 
-        for i in range(len(path) - 2):
+        for i in range(len(points) - 2):
             # Add the distance actions
             distance = self.__distance_btw_points(
-                    self._graph.node[path[i]]['pos'],
-                    self._graph.node[path[i+1]]['pos']
+                    points[i],
+                    points[i+1]
             )
             # Check if have 2 moves actions successively.
             if actions[-1]['action'] == 'move':
-                actions[-1]['value'] += distance
+                actions[-1]['value'] = round(actions[-1]['value'] + distance, 1)
             else:
-                actions.append({'action': 'move', 'value': round(distance)})
+                actions.append({'action': 'move', 'value': round(distance, 1)})
 
             # Try to simplify the actions by removing actions making a triangle.
             # A triangle means that the actions could be made by a straight line.
@@ -208,9 +652,9 @@ class GraphMap:
                             #  actions[-2] = {'action': 'turn', 'value': turn_angle}
 
             # Add the turn actions.
-            node_pos = self._graph.node[path[i]]['pos']
-            center_pos = self._graph.node[path[i+1]]['pos']
-            next_node_pos = self._graph.node[path[i+2]]['pos']
+            node_pos = points[i]
+            center_pos = points[i+1]
+            next_node_pos = points[i+2]
 
             turn_angle = self.__calculate_turn_angle(node_pos, center_pos, next_node_pos)
             if turn_angle != 0:
@@ -218,13 +662,13 @@ class GraphMap:
 
         # Finalize the last moving and turning.
         distance = self.__distance_btw_points(
-            self._graph.node[path[-2]]['pos'],
-            self._graph.node[path[-1]]['pos']
+            points[-2],
+            points[-1]
         )
-        actions.append({'action': 'move', 'value': int(distance)})
+        actions.append({'action': 'move', 'value': round(distance, 1)})
 
-        end_robot_angle = self.__simplify_turn_angle(self.__get_node_angle(path[-2], path[-1]))
-        print(end_robot_angle, target_angle)
+        end_robot_angle = self.__simplify_turn_angle(self.__get_pos_angle(points[-2], points[-1]))
+        telemetry.event(Event.PathEnd, end_robot_angle, target_angle)
         actions.append({'action': 'turn', 'value':
                         self.__simplify_turn_angle(end_robot_angle + target_angle)})
 
@@ -238,40 +682,72 @@ class GraphMap:
         angle2 = self.__get_pos_angle(center, next_node)
 
         angle = self.__simplify_turn_angle(angle2-angle1)
-        print(node, center, opposite_pos, angle, angle1, angle2)
+        telemetry.event(Event.PathTurn, angle, angle2)
         return angle
         #  return self.__simplify_turn_angle(angle2 - angle1)
 
-    def __build_graph_from_mesh(self, nodes, triangle_cells):
+    def __build_graph_from_mesh(self, nodes, triangle_cells, clearance=None):
         """
-        nodes: position of each nodes in the mesh.
-        triangle_cells: list of triangle cells list
-        A triangle cell is a 3 items lists with each items is a vertice
-        of a triangle.
+        nodes: position of each nodes in the mesh (Mesh.get_nodes() array).
+        triangle_cells: the 3 node indices of each triangle
+        (Mesh.get_connectivity_cells() array).
+        clearance: optional ClearanceField, see __set_clearance.
+
+        The sides shared by two triangles are only added once: the sides
+        are sorted and deduplicated, and their lengths computed at once.
+        The sides of a single triangle are the border of the mesh.
         """
-        graph = nx.Graph()
-        for i, n in enumerate(nodes):
-            graph.add_node(i, pos=n, color='red')
-
-        for conns in triangle_cells:
-            for i, c in enumerate(conns):
-                p1 = c
-                p2 = conns[(i+1) % 3]
+        # numpy is only needed to build the map, like the meshing stack.
+        import numpy as np
+
+        positions = np.asarray(nodes, dtype=float)[:, :2]
+        cells = np.asarray(triangle_cells, dtype=np.int64)
+        sides = np.concatenate([cells[:, [0, 1]], cells[:, [1, 2]], cells[:, [2, 0]]])
+        sides.sort(axis=1)
+        # A side as a single integer so the deduplication is a 1D sort.
+        keys, counts = np.unique(sides[:, 0] * len(positions) + sides[:, 1], return_counts=True)
+        first, second = np.divmod(keys, len(positions))
+        weights = np.hypot(*(positions[first] - positions[second]).T)
+        border = set(first[counts == 1].tolist()) | set(second[counts == 1].tolist())
 
-                weight = self.__distance_btw_points(
-                        graph.node[p1]['pos'],
-                        graph.node[p2]['pos']
-                )
-                graph.add_edge(p1, p2, weight=weight, color='black')
+        graph = nx.Graph()
+        graph.add_nodes_from((i, {'pos': tuple(p), 'color': 'red'})
+                             for i, p in enumerate(positions.tolist()))
+        graph.add_edges_from((a, b, {'weight': w, 'color': 'black'}) for a, b, w in
+                             zip(first.tolist(), second.tolist(), weights.tolist()))
+        for n in border:
+            graph.node[n]['color'] = 'blue'
+            graph.node[n]['mesh_edge'] = True
 
         self._graph = graph
-        # Not useful but could be.
-        self.__mark_nodes_as_border()
         print('Cleaning!')
         self.__clean()
+        if clearance is not None:
+            self.__set_clearance(clearance)
 
         self.save()
 
+    def __set_clearance(self, clearance):
+        """
+        Store the clearance of each node and edge (the lowest along it)
+        and weight the edges with it, see SAFE_CLEARANCE.
+        """
+        nodes = self._graph.nodes()
+        distances = clearance.distance([self._graph.node[n]['pos'] for n in nodes])
+        for n, distance in zip(nodes, distances.tolist()):
+            self._graph.node[n]['clearance'] = distance
+
+        edges = self._graph.edges()
+        distances = clearance.segment_distance([self._graph.node[a]['pos'] for a, b in edges],
+                                               [self._graph.node[b]['pos'] for a, b in edges])
+        for (a, b), distance in zip(edges, distances.tolist()):
+            attr = self._graph.edge[a][b]
+            attr['length'] = self.__distance_btw_points(self._graph.node[a]['pos'],
+                                                        self._graph.node[b]['pos'])
+            attr['clearance'] = distance
+            danger = max(0, 1 - distance / self.SAFE_CLEARANCE)
+            attr['weight'] = attr['length'] * (1 + self.CLEARANCE_WEIGHT * danger)
+
     def __distance_btw_points(self, p1, p2):
         x = (p1[0] - p2[0])**2
         y = (p1[1] - p2[1])**2
@@ -307,48 +783,11 @@ class GraphMap:
                 )
                 self._graph.add_edge(node, edge, weight=weight, color='black')
 
+        if self._graph.node[old_node].get('mesh_edge'):
+            self._graph.node[node]['color'] = 'blue'
+            self._graph.node[node]['mesh_edge'] = True
         self._graph.remove_node(old_node)
 
-    def __mark_nodes_as_border(self):
-        """
-        Flag nodes when they are in the borders.
-        Moslty works.
-
-        Works by checking the biggest opening angle between 2 triangles.
-        """
-        for node in self._graph.nodes():
-            out_edges = self._graph.neighbors(node)
-            if len(out_edges) == 2 or len(out_edges) == 1:
-                self._graph.node[node]['color'] = 'blue'
-                self._graph.node[node]['mesh_edge'] = True
-                continue
-
-            angles = sorted(self.__get_neighbors_angle(node),
-                            key=lambda k: k['angle'])
-
-            biggest_angle = 0
-            for i in range(len(angles)):
-                a1 = angles[i]['angle']
-                a2 = angles[(i+1) % len(angles)]['angle']
-
-                a_diff = (a2 - a1)
-                if a_diff < 0:
-                    a_diff += 360
-                if abs(a_diff) > biggest_angle:
-                    biggest_angle = abs(a_diff)
-            if biggest_angle > 105:
-                self._graph.node[node]['color'] = 'blue'
-                self._graph.node[node]['mesh_edge'] = True
-
-    def __get_neighbors_angle(self, node_id):
-        neighbors = self._graph.neighbors(node_id)
-
-        data = []
-        for i in neighbors:
-            data.append({'neighbor': i, 'angle': self.__get_node_angle(node_id, i)})
-
-        return data
-
     def __get_pos_angle(self, center, node, upper=(0, 0)):
         """
         Calculate an angle between 3 points using the law of cosine.
@@ -374,14 +813,6 @@ class GraphMap:
 
         return angle
 
-    def __get_node_angle(self, center, node):
-        """
-        The angle is the absolute angle relative to the X axis.
-        """
-        center_pos = self._graph.node[center]['pos']
-        point_pos = self._graph.node[node]['pos']
-        return self.__get_pos_angle(center_pos, point_pos)
-
     def __create_obstacle_rectangle(self, robot_pos, robot_dim, obstacle_dim, obstacle_pos, obstacle_distance):
         direction = 1
         if robot_pos['angle'] > 180:
@@ -403,3 +834,139 @@ class GraphMap:
                     robot_dim['length']/2, robot_dim['width']/2,
                     obstacle_distance+obstacle_dim, 1)
         return None
+
+
+class TestGraphMap(unittest.TestCase):
+
+    def build(self, positions, edges):
+        graph = nx.Graph()
+        for n, pos in enumerate(positions):
+            graph.add_node(n, pos=pos, color='red')
+        for a, b in edges:
+            graph.add_edge(a, b, weight=math.hypot(positions[a][0] - positions[b][0],
+                                                   positions[a][1] - positions[b][1]),
+                           color='black')
+        return GraphMap(None, None, graph=graph)
+
+    def test_candidates_margin(self):
+        # The node 1 is 40 cm away, beyond the margin of the nearest node 0:
+        # the virtual edge could go through a table border.
+        graph_map = self.build([(50, 50), (50, 90), (50, 130), (150, 50), (150, 130)],
+                               [(0, 3), (3, 4), (4, 2), (1, 2)])
+        route = graph_map.get_route({'point': (45, 50), 'angle': 90},
+                                    {'point': (50, 135), 'angle': 90})
+        self.assertEqual(route, [0, 3, 4, 2])
+
+    def test_start_on_node(self):
+        graph_map = self.build([(50, 50), (100, 50), (100, 100)], [(0, 1), (1, 2)])
+        instructions = graph_map.get_path({'point': (50, 50), 'angle': 0},
+                                          {'point': (100, 100), 'angle': 90})
+        # No move of zero length to the node under the robot nor to the target.
+        self.assertEqual([i['value'] for i in instructions if i['action'] == 'move'], [50, 50])
+        self.assertEqual(len(instructions), 5)
+
+
+    def test_fastest_with_arcs(self):
+        # Through the node 1 a single corner of 129 degrees, too sharp for
+        # an arc, through the nodes 0 and 2 two corners of 90 degrees.
+        graph_map = self.build([(60, 0), (80, 0), (60, 100), (0, 100)],
+                               [(0, 1), (0, 2), (2, 3), (1, 3)])
+        start = {'point': (0, 0), 'angle': 0}
+        target = {'point': (0, 100), 'angle': 180}
+        turns = graph_map.get_route(start, target, fastest=True)
+        arcs = graph_map.get_route(start, target, fastest=True, arcs=True)
+        self.assertEqual(turns, [0, 1, 3])
+        self.assertEqual(arcs, [0, 2, 3])
+
+        def duration(route):
+            instructions = graph_map.get_path_from_route(start, target, route, arcs=True)
+            return sum(instruction['duration'] for instruction in instructions)
+        self.assertLess(duration(arcs), duration(turns))
+
+    def test_clearance_weights(self):
+        from .clearance import ClearanceField
+
+        field = ClearanceField((0, 0), (300, 200))
+        field.add_circle((50, 60), 5)
+        graph = self.build([(20, 50), (80, 50), (20, 150), (80, 150)],
+                           [(0, 1), (2, 3)]).get_graph()
+        graph = GraphMap(None, None, graph=graph, clearance=field).get_graph()
+
+        # 5 cm from the circle: a third of SAFE_CLEARANCE.
+        self.assertAlmostEqual(graph.edge[0][1]['clearance'], 5, delta=0.1)
+        self.assertAlmostEqual(graph.edge[0][1]['weight'], 60 * (1 + 2 / 3), delta=1)
+        self.assertEqual(graph.edge[0][1]['length'], 60)
+        # Farther than SAFE_CLEARANCE from everything.
+        self.assertEqual(graph.edge[2][3]['weight'], 60)
+        self.assertEqual(graph.node[0]['clearance'], 20)
+
+    def test_border_detection(self):
+        import tempfile
+
+        class TemporaryGraphMap(GraphMap):
+            CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'graphmap.data')
+
+        # A square of 4 triangles around its center: the sides of a single
+        # triangle are the border.
+        nodes = [(0, 0), (40, 0), (40, 40), (0, 40), (20, 20)]
+        triangles = [(0, 1, 4), (1, 2, 4), (2, 3, 4), (3, 0, 4)]
+        graph = TemporaryGraphMap(nodes, triangles, cache=False).get_graph()
+        self.assertEqual(sorted(n for n in graph.nodes() if graph.node[n].get('mesh_edge')),
+                         [0, 1, 2, 3])
+        self.assertEqual(graph.number_of_edges(), 8)
+        self.assertEqual(graph.edge[0][1]['weight'], 40)
+        self.assertTrue(os.path.exists(TemporaryGraphMap.CACHE_PATH))
+
+    def test_diagonal_obstacle(self):
+        # 7 x 7 grid of nodes every 20 cm.
+        positions = [(20 + i % 7 * 20, 20 + i // 7 * 20) for i in range(49)]
+        edges = [(i, j) for i in range(49) for j in [i + 1, i + 7]
+                 if j < 49 and (j == i + 7 or i % 7 != 6)]
+        graph_map = self.build(positions, edges)
+        # The box of the obstacle contains the robot at these headings.
+        target = {'point': (140, 140), 'angle': 0}
+        for angle in [45, 135, 225, 315]:
+            start = {'point': (60, 60), 'angle': angle}
+            graph_map.add_obstacle(start, {'length': 30, 'width': 20}, 10, 'front', 15)
+            self.assertTrue(graph_map.get_path(start, target))
+            graph_map.reset_obstacles()
+
+    def test_plan_cache(self):
+        from .costmap import Costmap
+
+        # 5 x 5 grid of nodes every 20 cm.
+        positions = [(20 + i % 5 * 20, 20 + i // 5 * 20) for i in range(25)]
+        edges = [(i, j) for i in range(25) for j in [i + 1, i + 5]
+                 if j < 25 and (j == i + 5 or i % 5 != 4)]
+        graph_map = self.build(positions, edges)
+        start = {'point': (40, 40), 'angle': 0}
+        target = {'point': (100, 40), 'angle': 0}
+
+        def stats():
+            return (graph_map.plan_cache_stats['hits'], graph_map.plan_cache_stats['misses'])
+
+        plan = graph_map.get_path(start, target)
+        # Same pose once rounded.
+        self.assertEqual(graph_map.get_path({'point': (40.3, 39.8), 'angle': 0.4}, target), plan)
+        self.assertEqual(stats(), (1, 1))
+
+        graph_map.add_obstacle(start, {'length': 30, 'width': 20}, 10, 'front', 15)
+        blocked = graph_map.get_path(start, target)
+        self.assertEqual(stats(), (1, 2))
+        self.assertNotEqual(blocked, plan)
+
+        # Back to the plan without obstacles, not the blocked one.
+        graph_map.reset_obstacles()
+        self.assertEqual(graph_map.get_path(start, target), plan)
+        self.assertEqual(stats(), (2, 2))
+
+        costmap = Costmap(10)
+        for i in range(3):
+            costmap.update_rays([(40, 80)], [0], [30], 80)
+        graph_map.apply_costmap(costmap)
+        graph_map.get_path(start, target)
+        self.assertEqual(stats(), (2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
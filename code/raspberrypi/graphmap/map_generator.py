@@ -1,12 +1,15 @@
+import logging
 import os.path
 
-from .mesh import Mesh
 from .graphmap import GraphMap
 
+# Radius used to build the map around the obstacles.
+ROBOT_DIAGONAL = 17.8
+TABLE_DIMENSION = (300, 200)
 
-def build_mesh(robot_diagonal, removable=False, cache=True):
-    m = Mesh((300, 200), robot_diagonal)
 
+def add_obstacles(m, removable=False):
+    """Define the table elements on m, a Mesh or a clearance.MapObstacles."""
     # Define the start area.
     m.add_rectangle_obstacle((0, 36), (71, 38.2), mirror=True)
 
@@ -46,22 +49,69 @@ def build_mesh(robot_diagonal, removable=False, cache=True):
         m.add_circle_obstacle((90, 140), 6.3, mirror=True)
         m.add_circle_obstacle((80, 1850), 6.3, mirror=True)
 
+
+def build_mesh(robot_diagonal, removable=False, cache=True):
+    # dolfin and mshr are only needed to build the map, not to load it.
+    from .mesh import Mesh
+
+    m = Mesh(TABLE_DIMENSION, robot_diagonal)
+    add_obstacles(m, removable)
     m.build(cache=cache)
     return m
 
 
+def build_clearance(robot_radius, removable=False):
+    """
+    Return the ClearanceField of the table elements inflated by
+    robot_radius, without the meshing stack (numpy is needed).
+    """
+    from .clearance import MapObstacles
+
+    m = MapObstacles(TABLE_DIMENSION, robot_radius)
+    add_obstacles(m, removable)
+    return m.clearance
+
+
+def load_clearance(robot_radius):
+    """
+    Return build_clearance(robot_radius), or None when numpy is not
+    installed: the paths then ignore the clearance.
+    """
+    try:
+        return build_clearance(robot_radius)
+    except ImportError:
+        logging.warn('numpy is not installed, the paths ignore the clearance.')
+        return None
+
+
+def load_graph():
+    """
+    Runtime loading path: only reads the cached graph and never touches the
+    meshing stack. The cache is built with: python -m graphmap.map_generator
+
+    The clearance of the table elements is applied to the cached graph
+    when numpy is installed, the cache may have been built without it.
+    """
+    if not os.path.exists(GraphMap.CACHE_PATH):
+        raise Exception('No graph map cache at {}, build it with map_generator.'.format(
+            GraphMap.CACHE_PATH))
+    return GraphMap(None, None, clearance=load_clearance(ROBOT_DIAGONAL))
+
+
 def build_graph(robot_diagonal, cache=True):
+    # Same clearance as load_graph, the tools plan on the robot's graph.
     if os.path.exists(GraphMap.CACHE_PATH) and cache:
-        return GraphMap(None, None)
+        return GraphMap(None, None, clearance=load_clearance(robot_diagonal))
 
     mesh = build_mesh(robot_diagonal, removable=False, cache=False)
 
-    graph = GraphMap(mesh.get_nodes(), mesh.get_connectivity_cells(), cache=False)
+    graph = GraphMap(mesh.get_nodes(), mesh.get_connectivity_cells(), cache=False,
+                     clearance=mesh.clearance)
     return graph
 
 
 if __name__ == '__main__':
-    graph = build_graph(17.8, cache=False)
+    graph = build_graph(ROBOT_DIAGONAL, cache=False)
     #  graph = GraphMap(cache=True).build_graph_from_mesh(m.get_nodes(), m.get_connectivity_cells())
     #  graph.display()
     #  graph.add_obstacle({'point': (150, 100), 'angle': 90}, {'length': 30, 'width': 20}, 25, 'front', 10)
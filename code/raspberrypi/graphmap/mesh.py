@@ -1,10 +1,11 @@
-import math
 import os.path
 
 from dolfin import Point, plot, File
 from dolfin import Mesh as DolfinMesh
 import mshr
 
+from .clearance import ClearanceField, leaning_rectangles
+
 
 class Mesh():
     def __init__(self, dimension, robot_radius):
@@ -20,6 +21,8 @@ class Mesh():
         )
 
         self._mesh2d = None
+        # The same obstacles, to compute the clearance of the graph.
+        self.clearance = ClearanceField((robot_radius, robot_radius), self.dimension)
 
     def add_circle_obstacle(self, p, radius, mirror=False, accuracy=10):
         points = [Point(p[0], p[1])]
@@ -30,12 +33,13 @@ class Mesh():
 
         for point in points:
             self._map -= mshr.Circle(point, radius + self.robot_radius, accuracy)
+            self.clearance.add_circle((point.x(), point.y()), radius + self.robot_radius)
 
     def add_rectangle_obstacle(self, p1, p2, mirror=False):
-        self._map -= mshr.Rectangle(
-            self.__correct_point(Point(p1[0], p1[1]), inverse=-1),
-            self.__correct_point(Point(p2[0], p2[1]))
-        )
+        corner1 = self.__correct_point(Point(p1[0], p1[1]), inverse=-1)
+        corner2 = self.__correct_point(Point(p2[0], p2[1]))
+        self._map -= mshr.Rectangle(corner1, corner2)
+        self.clearance.add_rectangle((corner1.x(), corner1.y()), (corner2.x(), corner2.y()))
 
         # Replicate the data the other side of the map.
         if mirror:
@@ -49,6 +53,7 @@ class Mesh():
             )
 
             self._map -= mshr.Rectangle(p2bis, p1bis)
+            self.clearance.add_rectangle((p2bis.x(), p2bis.y()), (p1bis.x(), p1bis.y()))
 
     # As dolfin and mshr don't support leaning rectangle, we build the
     # rectangle giving him the point with the minimum y data,
@@ -58,26 +63,8 @@ class Mesh():
     # leaning rectangle.
     def add_leaning_rectangle_obstacle(self, p, height, width, angle,
                                        mirror=False, accuracy=10):
-        height_chunck_size = height / (accuracy)
-
-        radian_angle = math.radians(angle)
-        for chunck in range(accuracy):
-            pos = chunck * height_chunck_size + height_chunck_size / 2
-            # Get the center of the little rectangle.
-            center_point = (pos * math.cos(radian_angle),
-                            pos * math.sin(radian_angle))
-
-            self.__build_rectangle_by_center(p, center_point,
-                                             height_chunck_size,
-                                             width, mirror)
-
-    def __build_rectangle_by_center(self, base_point, p, height, width,
-                                    mirror=False):
-        p1 = (base_point[0] + p[0] + width / 2,
-              base_point[1] + p[1] + height / 2)
-        p2 = (base_point[0] + p[0] - width / 2,
-              base_point[1] + p[1] - height / 2)
-        self.add_rectangle_obstacle(p1, p2, mirror)
+        for p1, p2 in leaning_rectangles(p, height, width, angle, accuracy):
+            self.add_rectangle_obstacle(p1, p2, mirror)
 
     def __correct_point(self, p, inverse=1):
         return Point(p.x() + self.robot_radius*inverse,
@@ -0,0 +1,199 @@
+import math
+import unittest
+
+
+class TrajectoryCompiler:
+    """
+    Fit a node path with straight lines and arcs for the differential drive,
+    so that the robot keeps moving through the corners instead of stopping
+    to turn in place.
+
+    The angles are X-axis relative (counterclockwise) like the robot
+    position. The output uses the instruction format of GraphMap:
+        - {'action': 'turn', 'value': degrees (positive to the right)}
+        - {'action': 'move', 'value': cm (positive forward)}
+        - {'action': 'arc', 'straight': cm, 'length': cm, 'value': degrees}:
+          go straight then follow an arc of the given length and angle.
+    Every instruction has a "duration" key with its expected duration in
+    seconds, given by a trapezoidal speed profile.
+    """
+    SPEED = 30
+    ACCELERATION = 40
+    # Limits the speed in the arcs: v = sqrt(LATERAL_ACCELERATION * radius).
+    LATERAL_ACCELERATION = 30
+    ROTATION_SPEED = 120
+    ROTATION_ACCELERATION = 240
+    # Time needed by the regulation to settle at the end of a command.
+    COMMAND_OVERHEAD = 0.3
+
+    # Above the half-track of the robot (17.1 cm, see Motors.ANGLE_CORRECTION),
+    # so that the inner wheel of an arc never goes backward.
+    MIN_RADIUS = 20
+    MAX_RADIUS = 40
+    # Sharper corners are done with a turn in place.
+    MAX_ARC_ANGLE = 120
+    # Smaller direction changes are ignored.
+    MIN_TURN_ANGLE = 1
+
+    def compile(self, points, robot_angle, target_angle):
+        """
+        points: (x, y) positions of the path, from the robot to the target.
+        Return the list of instructions and the expected total duration.
+        """
+        segments = []
+        for p1, p2 in zip(points, points[1:]):
+            length = math.hypot(p2[0] - p1[0], p2[1] - p1[1])
+            if length > 1e-6:
+                heading = math.degrees(math.atan2(p2[1] - p1[1], p2[0] - p1[0]))
+                segments.append({'length': length, 'heading': heading})
+
+        actions = []
+        if not segments:
+            self.__add_turn(actions, self.__normalize(target_angle - robot_angle))
+            return actions, self.__total(actions)
+
+        corners = [self.__fit_corner(segments, i) for i in range(1, len(segments))]
+
+        self.__add_turn(actions, self.__normalize(segments[0]['heading'] - robot_angle))
+        straight = segments[0]['length']
+        for i, corner in enumerate(corners):
+            straight -= corner['tangent']
+            if corner['kind'] == 'arc':
+                self.__add_arc(actions, straight, corner)
+                straight = 0
+            elif corner['kind'] == 'turn':
+                self.__add_move(actions, straight)
+                self.__add_turn(actions, corner['delta'])
+                straight = 0
+            straight += segments[i + 1]['length'] - corner['tangent']
+        self.__add_move(actions, straight)
+        self.__add_turn(actions, self.__normalize(target_angle - segments[-1]['heading']))
+
+        return actions, self.__total(actions)
+
+    def turn_time(self, delta):
+        """Duration of a turn in place of delta degrees (0 if skipped)."""
+        if abs(delta) < self.MIN_TURN_ANGLE:
+            return 0
+        return self.__trapezoid(abs(delta), self.ROTATION_SPEED, self.ROTATION_ACCELERATION) + \
+            self.COMMAND_OVERHEAD
+
+    def corner_time(self, delta, available, arcs=True):
+        """
+        Time added by a heading change of delta degrees between two
+        segments, compared to going straight on, as compiled: an arc if
+        arcs and the segments leave room for it, else a turn in place.
+        Both stop the motors at the end of a command and restart them.
+
+        available: the length in cm of the shortest segment, halved when
+        the segment is shared with another corner.
+        """
+        corner = self.__fit(delta, available)
+        if corner['kind'] == 'straight':
+            return 0
+        restart = self.SPEED / self.ACCELERATION + self.COMMAND_OVERHEAD
+        if corner['kind'] == 'turn' or not arcs:
+            return self.turn_time(delta) + restart
+        length = corner['radius'] * math.radians(abs(delta))
+        arc_speed = min(self.SPEED, math.sqrt(self.LATERAL_ACCELERATION * corner['radius']))
+        return restart + length / arc_speed - 2 * corner['tangent'] / self.SPEED
+
+    def __fit_corner(self, segments, i):
+        """Choose how to go from the segment i-1 to the segment i."""
+        delta = self.__normalize(segments[i]['heading'] - segments[i - 1]['heading'])
+        # A segment is shared between 2 corners except the first and last ones.
+        available = min(
+            segments[i - 1]['length'] * (1 if i == 1 else 0.5),
+            segments[i]['length'] * (1 if i == len(segments) - 1 else 0.5),
+        )
+        return self.__fit(delta, available)
+
+    def __fit(self, delta, available):
+        if abs(delta) < self.MIN_TURN_ANGLE:
+            return {'kind': 'straight', 'delta': delta, 'tangent': 0}
+        if abs(delta) > self.MAX_ARC_ANGLE:
+            return {'kind': 'turn', 'delta': delta, 'tangent': 0}
+
+        half_tan = math.tan(math.radians(abs(delta)) / 2)
+        radius = min(self.MAX_RADIUS, available / half_tan)
+        if radius < self.MIN_RADIUS:
+            return {'kind': 'turn', 'delta': delta, 'tangent': 0}
+        return {'kind': 'arc', 'delta': delta, 'radius': radius,
+                'tangent': radius * half_tan}
+
+    def __add_move(self, actions, distance):
+        if distance < 0.05:
+            return
+        actions.append({'action': 'move', 'value': round(distance, 1),
+                        'duration': self.__trapezoid(distance, self.SPEED, self.ACCELERATION)
+                        + self.COMMAND_OVERHEAD})
+
+    def __add_turn(self, actions, delta):
+        if abs(delta) < 0.05:
+            return
+        duration = self.__trapezoid(abs(delta), self.ROTATION_SPEED, self.ROTATION_ACCELERATION)
+        # The heading change is counterclockwise, a turn is positive to the right.
+        actions.append({'action': 'turn', 'value': round(-delta, 1),
+                        'duration': duration + self.COMMAND_OVERHEAD})
+
+    def __add_arc(self, actions, straight, corner):
+        length = corner['radius'] * math.radians(abs(corner['delta']))
+        arc_speed = min(self.SPEED, math.sqrt(self.LATERAL_ACCELERATION * corner['radius']))
+        duration = self.__trapezoid(straight + length, self.SPEED, self.ACCELERATION) + \
+            length * (1 / arc_speed - 1 / self.SPEED)
+        actions.append({'action': 'arc', 'straight': round(max(straight, 0), 1),
+                        'length': round(length, 1), 'value': round(-corner['delta'], 1),
+                        'duration': duration + self.COMMAND_OVERHEAD})
+
+    def __trapezoid(self, distance, speed, acceleration):
+        """Duration of a move starting and ending at zero speed."""
+        if distance >= speed**2 / acceleration:
+            return distance / speed + speed / acceleration
+        return 2 * math.sqrt(distance / acceleration)
+
+    def __normalize(self, angle):
+        return (angle + 180) % 360 - 180
+
+    def __total(self, actions):
+        return sum(action['duration'] for action in actions)
+
+
+class TestTrajectoryCompiler(unittest.TestCase):
+
+    def test_arc_corner(self):
+        actions, duration = TrajectoryCompiler().compile(
+            [(0, 0), (100, 0), (100, 100)], 0, 90)
+        self.assertEqual([a['action'] for a in actions], ['arc', 'move'])
+        # Turning left is negative.
+        self.assertEqual(actions[0]['value'], -90)
+        self.assertAlmostEqual(actions[0]['straight'] + actions[1]['value'], 120, 0)
+        self.assertAlmostEqual(duration, sum(a['duration'] for a in actions))
+
+    def test_sharp_corner(self):
+        actions, _ = TrajectoryCompiler().compile(
+            [(0, 0), (100, 0), (0, 10)], 90, 0)
+        self.assertEqual([a['action'] for a in actions], ['turn', 'move', 'turn', 'move', 'turn'])
+        self.assertEqual(actions[0]['value'], 90)
+
+    def test_faster_than_turning_in_place(self):
+        compiler = TrajectoryCompiler()
+        _, arc_duration = compiler.compile([(0, 0), (100, 0), (100, 100)], 0, 90)
+        compiler.MAX_ARC_ANGLE = 0
+        _, turn_duration = compiler.compile([(0, 0), (100, 0), (100, 100)], 0, 90)
+        self.assertLess(arc_duration, turn_duration)
+
+
+    def test_corner_time(self):
+        compiler = TrajectoryCompiler()
+        points = [(0, 0), (100, 0), (100, 100)]
+        _, arc_duration = compiler.compile(points, 0, 90)
+        _, straight_duration = compiler.compile([(0, 0), (200, 0)], 0, 0)
+        self.assertAlmostEqual(arc_duration - straight_duration, compiler.corner_time(90, 100))
+        self.assertAlmostEqual(compiler.corner_time(90, 100, arcs=False),
+                               compiler.turn_time(90) + compiler.SPEED / compiler.ACCELERATION +
+                               compiler.COMMAND_OVERHEAD)
+        self.assertEqual(compiler.corner_time(0.5, 100), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,117 +1,76 @@
+import logging
+import os
+import subprocess
+import sys
+import threading
 import time
-import RPi.GPIO as GPIO
-import multiprocessing
+import unittest
 
+import i2c
+import periodic
+import tracing
+
+from mission import Mission, run_schedule
 from motors import Motors
 from range_sensors import RangeSensor
 from robot2 import Robot
+from scheduler import MatchScheduler
+from telemetry import open_sink, telemetry
+
+# The missions are written for the yellow side and mirrored for the blue one.
+GO_TO_DISTRIB = Mission([
+    {'drive': 'forward', 'value': 10},
+    {'drive': 'turn_right', 'value': 60},
+    {'drive': 'forward', 'value': 65},
+    {'drive': 'turn_right', 'value': 30},
+    {'drive': 'backward', 'value': {'yellow': 50, 'blue': 55}},
+    {'drive': 'forward', 'value': {'yellow': 12, 'blue': 29}},
+    {'drive': 'turn_right', 'value': {'yellow': 90, 'blue': 86}},
+    {'drive': 'forward', 'value': {'yellow': 5, 'blue': 9}},
+])
+
+GO_TO_EMPTY = Mission([
+    {'drive': 'backward', 'value': {'yellow': 10, 'blue': None}},
+    {'drive': 'turn_right', 'value': 135},
+    {'drive': 'forward', 'value': {'yellow': 79, 'blue': 78}},
+    {'drive': 'turn_right', 'value': 90, 'sensors': {'yellow': True, 'blue': False}},
+    {'drive': 'forward', 'value': {'yellow': 7, 'blue': None}},
+    {'servos': ['middle_clamp'], 'delay': 1.5},
+    {'drive': 'turn_right', 'value': 60, 'mirror': False},
+    {'servos': ['up_clamp']},
+    {'drive': 'turn_left', 'value': 60, 'mirror': False},
+    {'drive': 'forward', 'value': 12, 'timeout': 3},
+])
+
+GOALS = [
+    {'name': 'go_to_distrib', 'mission': GO_TO_DISTRIB},
+    {'name': 'take_modules', 'requires': ['go_to_distrib'], 'mission': Mission([
+        {'robot': 'take_modules', 'kwargs': {'number': 3}},
+    ])},
+    {'name': 'go_to_empty', 'requires': ['take_modules'], 'mission': GO_TO_EMPTY},
+    {'name': 'eject_modules', 'requires': ['go_to_empty'], 'mission': Mission([
+        {'robot': 'eject_modules', 'kwargs': {'number': 3}},
+    ])},
+]
+
+MATCH = Mission(GO_TO_DISTRIB.steps + [
+    {'robot': 'take_modules', 'kwargs': {'number': 3}},
+] + GO_TO_EMPTY.steps + [
+    {'robot': 'eject_modules', 'kwargs': {'number': 3}},
+])
+
 
 def yellow_go_to_distrib(r, m):
-    m.forward(10)
-    r.wait_motors()
-    m.turn_right(60)
-    r.wait_motors()
-    m.forward(65)
-    r.wait_motors()
-    m.turn_right(30)
-    r.wait_motors()
-    m.backward(50)
-    r.wait_motors()
-    m.forward(12)
-    r.wait_motors()
-    m.turn_right(90)
-    r.wait_motors()
-    m.forward(5)
-    r.wait_motors()
-
-    #  m.forward(23)
-    #  r.wait_motors()
-    #  m.turn_right(35)
-    #  r.wait_motors(enable=False)
-    #  m.forward(39)
-    #  r.wait_motors(enable=False)
-    #  m.turn_right(145)
-    #  r.wait_motors()
-    #  m.forward(6)
-    #  r.wait_motors()
+    run_schedule(r, GO_TO_DISTRIB.compile('yellow'))
 
 def yellow_go_to_empty(r, m, k):
-    m.backward(10)
-    r.wait_motors()
-    m.turn_right(135)
-    r.wait_motors()
-    m.forward(79)
-    r.wait_motors()
-    m.turn_right(90)
-    r.wait_motors()
-    m.forward(7)
-    r.wait_motors()
-    k.middle_clamp()
-    time.sleep(1.5)
-    m.turn_right(60)
-    r.wait_motors()
-    k.up_clamp()
-    m.turn_left(60)
-    r.wait_motors()
-    m.forward(12)
-    r.wait_motors(timeout=3)
+    run_schedule(r, GO_TO_EMPTY.compile('yellow'))
 
 def blue_go_to_distrib(r, m):
-    m.forward(10)
-    r.wait_motors()
-    m.turn_left(60)
-    r.wait_motors()
-    m.forward(65)
-    r.wait_motors()
-    m.turn_left(30)
-    r.wait_motors()
-    m.backward(55)
-    r.wait_motors()
-    m.forward(29)
-    r.wait_motors()
-    m.turn_left(86)
-    r.wait_motors()
-    m.forward(9)
-    r.wait_motors()
-    #  m.forward(10)
-    #  r.wait_motors()
-    #  m.turn_right(60)
-    #  r.wait_motors()
-    #  m.forward(65)
-    #  r.wait_motors()
-    #  m.turn_right(30)
-    #  r.wait_motors()
-    #  m.backward(70)
-    #  r.wait_motors()
-    #  m.forward(23)
-    #  r.wait_motors()
-    #  m.turn_left(45)
-    #  r.wait_motors()
-    #  m.forward(49)
-    #  r.wait_motors()
-    #  m.turn_left(135)
-    #  r.wait_motors()
-    #  m.forward(17)
-    #  r.wait_motors()
+    run_schedule(r, GO_TO_DISTRIB.compile('blue'))
 
 def blue_go_to_empty(r, m, k):
-    m.turn_left(135)
-    r.wait_motors()
-    m.forward(78)
-    r.wait_motors()
-    m.turn_left(90)
-    r.wait_motors(enable=False)
-    #  m.forward(13)
-    #  r.wait_motors(enable=False, timeout=4)
-    k.middle_clamp()
-    time.sleep(1.5)
-    m.turn_right(60)
-    r.wait_motors()
-    k.up_clamp()
-    m.turn_left(60)
-    r.wait_motors()
-    m.forward(12)
-    r.wait_motors(timeout=3)
+    run_schedule(r, GO_TO_EMPTY.compile('blue'))
 
 
 def launch_yellow():
@@ -119,22 +78,14 @@ def launch_yellow():
     r = Robot()
     #  r.reset_kinematics()
 
-    m = r.get_motors()
-    yellow_go_to_distrib(r, m)
-    r.take_modules(number=3)
-    yellow_go_to_empty(r, m, r.get_kin())
-    r.eject_modules(number=3)
+    run_schedule(r, MATCH.compile('yellow'))
 
 def launch_blue():
     print('blue')
     r = Robot()
     #  r.reset_kinematics()
 
-    m = r.get_motors()
-    blue_go_to_distrib(r, m)
-    r.take_modules(number=3)
-    blue_go_to_empty(r, m, r.get_kin())
-    r.eject_modules(number=3)
+    run_schedule(r, MATCH.compile('blue'))
 
 def test():
     r = Robot()
@@ -142,6 +93,27 @@ def test():
     r.eject_modules(number=3)
 
 
+class TestImportTime(unittest.TestCase):
+    """
+    The Pi is often power-cycled right before the match: importing the
+    entry points must stay fast and never load the heavy dependencies.
+    """
+    BUDGET = 0.5
+    HEAVY_MODULES = ['networkx', 'dolfin', 'mshr', 'matplotlib']
+
+    def test_import_time(self):
+        code = ('import sys, time; start = time.perf_counter(); import {}; '
+                'print(time.perf_counter() - start); print(" ".join(sys.modules))')
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for module in ['robot', 'robot2', 'hardcode']:
+            output = subprocess.check_output([sys.executable, '-c', code.format(module)],
+                                             cwd=directory, universal_newlines=True)
+            duration, modules = output.splitlines()[-2:]
+            self.assertLess(float(duration), self.BUDGET, module)
+            for heavy in self.HEAVY_MODULES:
+                self.assertNotIn(heavy, modules.split(), module)
+
+
 #  if __name__ == '__main__':
     #  m = Motors(5)
     #  r = Robot()
@@ -165,29 +137,60 @@ def test():
     #  r.wait_motors()
 
 if __name__ == '__main__':
+    import RPi.GPIO as GPIO
+
+    # Record the bus traffic of the match, see recorder.py to replay it.
+    recorder = None
+    if os.environ.get('ROBOT_RECORD'):
+        from recorder import Recorder
+        recorder = Recorder(os.environ['ROBOT_RECORD'])
+        i2c.set_recorder(recorder)
+
+    # Live telemetry, a file path or "udp:host:port" followed by
+    # "python telemetry.py --udp port".
+    if os.environ.get('ROBOT_TELEMETRY'):
+        telemetry.start(open_sink(os.environ['ROBOT_TELEMETRY']))
+
+    # Keep the polling loops on time, e.g. ROBOT_CPU=3 ROBOT_PRIORITY=50 on
+    # a CPU isolated with isolcpus=3.
+    cpu = os.environ.get('ROBOT_CPU')
+    priority = os.environ.get('ROBOT_PRIORITY')
+    periodic.set_realtime(int(cpu) if cpu else None, int(priority) if priority else None)
+
     GPIO.setmode(GPIO.BOARD)
     GPIO.setup(7, GPIO.IN)
     GPIO.setup(8, GPIO.IN)
     GPIO.setup(10, GPIO.IN)
 
+    # The warm-up runs while we wait for the start cord, so that everything
+    # is ready when it is pulled.
+    robot = Robot()
+    warm_up = threading.Thread(target=robot.warm_up)
+    warm_up.start()
+
     while GPIO.input(8) == 1:
         time.sleep(0.2)
-
-    action = None
-    if GPIO.input(7) == 1:
-        # blue
-        action = launch_blue
-    else:
-        action = launch_yellow
-
-    process = multiprocessing.Process(target=action)
-    process.start()
-    time.sleep(90)
-    process.terminate()
-    r = Robot()
-
-    r.finalize()
-    #  pool.map(run, args=(robot, assets))
+    warm_up.join()
+
+    side = 'blue' if GPIO.input(7) == 1 else 'yellow'
+
+    # The strategy runs in this process and gives back the control at the
+    # deadline between two I2C transactions, the same robot is finalized.
+    scheduler = MatchScheduler(robot, side)
+    scheduler.run(GOALS)
+
+    if recorder is not None:
+        recorder.close()
+    telemetry.stop()
+
+    # Timeline of the match, open it with https://ui.perfetto.dev
+    tracing.tracer.export_chrome_trace(os.environ.get('ROBOT_TRACE', 'trace.json'))
+    for name, histogram in sorted(tracing.tracer.histograms().items()):
+        logging.info('%s: %i calls, %.3f s total, p99 %.4f s', name, histogram['count'],
+                     histogram['total'], histogram['p99'])
+    for name, stats in sorted(periodic.loop_stats.tasks.items()):
+        logging.info('%s: %i periods, %i overruns, max jitter %.4f s', name, stats['count'],
+                     stats['overruns'], stats['max_jitter'])
 
     #  r.reset_kinematics()
     #  blue_go_to_distrib(m)
@@ -1,25 +1,67 @@
 import logging
-import smbus
+import os
 import time
 import unittest
 
+from tracing import span
+
+# Bus shared by every I2C module, see get_bus().
+_bus = None
+# Optional recorder.Recorder logging every transaction.
+_recorder = None
+
+
+def set_bus(bus):
+    """
+    Replace the bus backend used by every I2C module created afterwards.
+    A backend needs the write_byte and read_i2c_block_data methods of
+    smbus.SMBus (e.g. simulator.SimulatedBus).
+    """
+    global _bus
+    _bus = bus
+
+
+def get_bus():
+    """
+    Return the current bus backend. By default, connects to the I2C bus
+    using smbus, or to the simulator if the ROBOT_BUS environment variable
+    is set to "sim" (useful on a dev machine or the CI).
+    """
+    global _bus
+    if _bus is None:
+        if os.environ.get('ROBOT_BUS') == 'sim':
+            from simulator import build_bus
+            _bus = build_bus()
+        else:
+            import smbus
+            _bus = smbus.SMBus(1)
+    return _bus
+
+
+def set_recorder(recorder):
+    """Log every transaction of every I2C module in the recorder (or None)."""
+    global _recorder
+    _recorder = recorder
+
 
 class I2C:
     """
     I2C class used as parent class for modules communicating with I2C.
     This class stores the adress of the I2C module it represents and
-    connects to the I2C bus using smbus. It also provides a couple
-    of convenience methods.
+    connects to the I2C bus using the backend given by get_bus(). It also
+    provides a couple of convenience methods.
     """
 
-    def __init__(self, address):
+    def __init__(self, address, bus=None):
         """Takes the I2C adress of the module it represents"""
-        self.bus = smbus.SMBus(1)
+        self.bus = bus if bus is not None else get_bus()
         self.address = address
 
     # Can handle numbers aswell as lists
     def send(self, data):
         self.__execute_i2c(self.__send, data)
+        if _recorder is not None:
+            _recorder.record_send(self.address, data)
 
     def __send(self, data):
         """Send data to the module it represents"""
@@ -32,7 +74,10 @@ class I2C:
     # read_i2c_block_data can't process more than 32 bytes, so num_bytes should
     # not be greater than 32 !!
     def receive(self, num_bytes=1):
-        return self.__execute_i2c(self.__receive, num_bytes)
+        data = self.__execute_i2c(self.__receive, num_bytes)
+        if _recorder is not None:
+            _recorder.record_receive(self.address, data)
+        return data
 
     def __receive(self, num_bytes):
         """Receive a specific amount of data from the module it represents"""
@@ -42,6 +87,16 @@ class I2C:
         else:
             return data
 
+    def ping(self, samples=1):
+        """
+        Return the mean round-trip time in seconds of a one byte read from
+        the module it represents. Used as a self-test before the match.
+        """
+        start = time.perf_counter()
+        for _ in range(samples):
+            self.receive()
+        return (time.perf_counter() - start) / samples
+
     def __execute_i2c(self, callback, *args):
         """
         If we send I2C command when the bus is still busy, we get an OSError,
@@ -49,7 +104,8 @@ class I2C:
         """
         for _ in range(10):
             try:
-                return callback(args[0])
+                with span('i2c', {'address': self.address}):
+                    return callback(args[0])
             except OSError as e:
                 logging.info('Failed to send to I2C bus')
                 time.sleep(0.2)
@@ -71,6 +127,27 @@ class I2C:
         # to get a 16 bit value of the form: hhhh hhhh llll llll
         return (high & 0xFF) << 8 | (low & 0xFF)
 
+    def pack_wide(value):
+        """
+        Split a 16 bits signed value into 3 bytes of 2, 7 and 7 bits.
+        The MSB of each byte is set so that no byte is ever null, the
+        Arduinos use the null byte to indicate errors.
+        """
+        if not -0x8000 <= value <= 0x7FFF:
+            raise ValueError('{} does not fit in 16 bits.'.format(value))
+        value &= 0xFFFF
+        return [0x80 | (value >> 14),
+                0x80 | ((value >> 7) & 0x7F),
+                0x80 | (value & 0x7F)]
+
+    def unpack_wide(data):
+        """Inverse of pack_wide, takes 3 bytes and return a signed value"""
+        value = 0
+        for byte in data:
+            value = (value << 7) | (byte & 0x7F)
+        value &= 0xFFFF
+        return value - 0x10000 if value >> 15 == 1 else value
+
     def int(val):
         sign = -1 if val >> 7 == 1 else 1
         value = val & 0x7F
@@ -91,6 +168,15 @@ class TestPack(unittest.TestCase):
         self.assertEqual(I2C.pack16(0xF3, 0xAB), 0xF3AB)
         self.assertEqual(I2C.pack16(0x2, 0xFF), 0x02FF)
 
+    def test_pack_wide(self):
+        self.assertEqual(I2C.pack_wide(0), [0x80, 0x80, 0x80])
+        self.assertEqual(I2C.pack_wide(2700), [0x80, 0x95, 0x8C])
+        for value in [-32768, -2700, -1, 0, 1, 255, 2700, 32767]:
+            data = I2C.pack_wide(value)
+            self.assertNotIn(0, data)
+            self.assertEqual(I2C.unpack_wide(data), value)
+        self.assertRaises(ValueError, I2C.pack_wide, 32768)
+
 
 if __name__ == '__main__':
     unittest.main()
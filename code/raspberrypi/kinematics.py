@@ -1,9 +1,13 @@
+import logging
+import time
+
 from i2c import I2C
 from enum import IntEnum
 
 class Command(IntEnum) :
     MOVE_UP = 1
     MOVE_DOWN = 0
+    STATUS = 15
 
 class Adress(IntEnum) :
     SERVO_CLAMP = 0
@@ -11,6 +15,11 @@ class Adress(IntEnum) :
     SERVO_PUSH = 2
     SERVO_FUNNY = 3
 
+class Status(IntEnum) :
+    REACHED = 0
+    MOVING = 1
+    STALLED = 2
+
 
 class Kinematics(I2C) :
     """
@@ -24,11 +33,64 @@ class Kinematics(I2C) :
     totalling 8 bits together. The 4 first bits are for the servo address,
     and the 4 next is used for the action to do with it.
 
-    """
+    The STATUS action doesn't move the servo, the module answers the next
+    read with one byte: a Status of the servo. The register byte written by
+    that read is discarded, any other read would be taken as a command. The dynamixel gives its real
+    position, the other servos are estimated from their speed.
 
-    def __init__(self, address):
+    """
+    # Servo moved by each method, see wait().
+    SERVOS = {
+        'up_clamp': Adress.SERVO_DYNAMIXEL,
+        'down_clamp': Adress.SERVO_DYNAMIXEL,
+        'middle_clamp': Adress.SERVO_DYNAMIXEL,
+        'close_clamp': Adress.SERVO_CLAMP,
+        'open_clamp': Adress.SERVO_CLAMP,
+        'push_out': Adress.SERVO_PUSH,
+        'push_back': Adress.SERVO_PUSH,
+        'launch_funny': Adress.SERVO_FUNNY,
+        'reset_funny': Adress.SERVO_FUNNY,
+    }
+    WAIT_PERIOD = 0.05
+
+    def __init__(self, address, bus=None):
         """Constructor takes the adress of the I2C module"""
-        super(Kinematics, self).__init__(address)
+        super(Kinematics, self).__init__(address, bus)
+
+    def ping(self, samples=1):
+        """
+        Same as I2C.ping with a status request before each read: the module
+        would take the register byte of a bare read as open_clamp.
+        """
+        start = time.perf_counter()
+        for _ in range(samples):
+            self.status(Adress.SERVO_CLAMP)
+        return (time.perf_counter() - start) / samples
+
+    def status(self, servo):
+        self.send(I2C.pack8(servo, Command.STATUS))
+        return Status(self.receive())
+
+    def wait(self, servo, timeout, sleep=None):
+        """
+        Wait until the servo has reached its position, at most timeout
+        seconds. sleep is used between the requests (e.g. Robot.sleep to
+        stop at the match deadline). Return the last Status.
+        """
+        sleep = sleep or time.sleep
+        end = time.monotonic() + timeout
+        while True:
+            status = self.status(servo)
+            if status != Status.MOVING:
+                break
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            sleep(min(self.WAIT_PERIOD, remaining))
+
+        if status == Status.STALLED:
+            logging.warn('Servo %s not in position: %s', Adress(servo).name, status.name)
+        return status
 
     def up_clamp(self):
         cmd = I2C.pack8(Adress.SERVO_DYNAMIXEL, Command.MOVE_UP)
@@ -1,19 +1,20 @@
+import os
+import threading
 import time
-import RPi.GPIO as GPIO
-import multiprocessing
 
+import periodic
 from robot import Robot
 from map_points import Assets
+from scheduler import MatchScheduler, MatchOver
+from telemetry import open_sink, telemetry
 
 
 def run(robot, assets):
-    robot = Robot(assets.get_point('start'))
     robot.move_to(assets.get_point('rocket'))
     robot.take_modules(4,5)
     robot.move_to(assets.get_point('remove'))
     robot._motors.forward(40)
-    while not robot._motors.is_done(robot.__done_callback):
-        time.sleep(0.5)
+    robot.wait_motors()
     robot.move_to(assets.get_point('discharge'))
     robot.eject_modules(4)
     robot.move_to(assets.get_point('mono2'))
@@ -23,21 +24,39 @@ def run(robot, assets):
 
 
 if __name__ == '__main__':
+    import RPi.GPIO as GPIO
+
     GPIO.setup(11, GPIO.OUT)
     GPIO.setup(13, GPIO.OUT)
 
+    # A file path or "udp:host:port", see telemetry.py.
+    if os.environ.get('ROBOT_TELEMETRY'):
+        telemetry.start(open_sink(os.environ['ROBOT_TELEMETRY']))
+
+    # Keep the polling loops on time, e.g. ROBOT_CPU=3 ROBOT_PRIORITY=50 on
+    # a CPU isolated with isolcpus=3. The planner process of the robot runs
+    # on the other CPUs, so this is done before creating the robot.
+    cpu = os.environ.get('ROBOT_CPU')
+    priority = os.environ.get('ROBOT_PRIORITY')
+    periodic.set_realtime(int(cpu) if cpu else None, int(priority) if priority else None)
+
     assets = Assets('yellow')
     if GPIO.output(11) == 1:
         assets = Assets('blue')
     robot = Robot(assets.get_point('start'))
+    warm_up = threading.Thread(target=robot.warm_up)
+    warm_up.start()
 
     while GPIO.output(13) == 0:
         time.sleep(0.2)
-
-    pool = multiprocessing.Pool(processes=1)
-    pool.map(run, args=(robot, assets))
-
-    time.sleep(90)
-    pool.terminate()
-
-    robot.finalize()
+    warm_up.join()
+
+    scheduler = MatchScheduler(robot, assets.color)
+    scheduler.start()
+    try:
+        run(robot, assets)
+    except MatchOver:
+        pass
+    scheduler.finalize()
+    robot.close()
+    telemetry.stop()
@@ -0,0 +1,202 @@
+import time
+import unittest
+
+from kinematics import Kinematics
+
+
+class Mission:
+    """
+    Declarative match script compiled into a schedule for robot2.Robot.
+
+    A mission is a list of steps, each step is a dict with the keys:
+        - "drive": a Motors method name ("forward", "backward", "turn_left",
+          "turn_right") and "value" its argument.
+        - "servos": a list of Kinematics method names.
+        - "delay": longest time needed by the servos to reach their position,
+          the slot goes on as soon as they tell they have arrived.
+        - "robot": a robot2.Robot method name (e.g. "take_modules") and
+          "kwargs" its arguments.
+        - "timeout": given to Robot.wait_motors (0 means no timeout).
+        - "sensors": enable the US sensors while driving (default True).
+        - "mirror": swap the turns for the mirrored side (default True).
+        - "overlap": the servos can move during the next drive step. By
+          default, the steps moving only RESTING_SERVOS overlap.
+
+    Every value can be a dict {"yellow": ..., "blue": ...} when the sides
+    differ. A step with a None value is skipped for this side.
+    The mission is written for the REFERENCE side, the other one is mirrored.
+    """
+    SIDES = ('yellow', 'blue')
+    REFERENCE = 'yellow'
+    MIRRORED_DRIVE = {
+        'turn_left': 'turn_right',
+        'turn_right': 'turn_left',
+    }
+    # The servos going back to their rest position touch no table element,
+    # they don't depend on where the robot is during the drive.
+    RESTING_SERVOS = {'up_clamp', 'push_back', 'reset_funny'}
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def compile(self, side):
+        """
+        Return the schedule of the side: a list of slots being dicts with
+        the keys "drive" ((method, value) or None), "servos", "delay",
+        "robot" ((method, kwargs) or None), "timeout" and "sensors".
+
+        The overlapping servo steps are merged into the next drive slot,
+        unless a servo is moved twice: the moves of a servo stay in order.
+        """
+        schedule = []
+        # Servos waiting for the next drive slot.
+        pending = []
+        for step in self.steps:
+            step = {key: self.__resolve(value, side) for key, value in step.items()}
+            if 'value' in step and step['value'] is None:
+                continue
+
+            slot = {
+                'drive': None,
+                'servos': list(step.get('servos', [])),
+                'delay': step.get('delay', 0),
+                'robot': None,
+                'timeout': step.get('timeout', 0),
+                'sensors': step.get('sensors', True),
+            }
+            if 'drive' in step:
+                drive = step['drive']
+                if side != self.REFERENCE and step.get('mirror', True):
+                    drive = self.MIRRORED_DRIVE.get(drive, drive)
+                slot['drive'] = (drive, step['value'])
+            if 'robot' in step:
+                slot['robot'] = (step['robot'], step.get('kwargs', {}))
+
+            overlap = step.get('overlap')
+            if overlap is None:
+                overlap = bool(slot['servos']) and set(slot['servos']) <= self.RESTING_SERVOS
+            if pending and self.__actuators(slot) & self.__actuators(*pending):
+                schedule.extend(pending)
+                pending = []
+            if overlap and slot['drive'] is None and slot['robot'] is None:
+                pending.append(slot)
+                continue
+
+            if slot['drive'] is not None:
+                for servo_slot in reversed(pending):
+                    slot['servos'] = servo_slot['servos'] + slot['servos']
+                    slot['delay'] = max(slot['delay'], servo_slot['delay'])
+                pending = []
+            else:
+                schedule.extend(pending)
+                pending = []
+            schedule.append(slot)
+
+        schedule.extend(pending)
+        return schedule
+
+    def __actuators(self, *slots):
+        return {Kinematics.SERVOS[servo] for slot in slots for servo in slot['servos']}
+
+    def __resolve(self, value, side):
+        if isinstance(value, dict) and value and set(value) <= set(self.SIDES):
+            return value.get(side)
+        return value
+
+
+def run_slot(robot, slot):
+    """
+    Execute one slot of a schedule. The servos are moved first, then the
+    drive runs while they are moving and the slot ends when both the drive
+    and the servos are done (or the delay is over).
+    """
+    start = time.time()
+    for servo in slot['servos']:
+        getattr(robot.get_kin(), servo)()
+
+    if slot['drive'] is not None:
+        method, value = slot['drive']
+        getattr(robot.get_motors(), method)(value)
+        robot.wait_motors(enable=slot['sensors'], timeout=slot['timeout'])
+
+    if slot['robot'] is not None:
+        method, kwargs = slot['robot']
+        getattr(robot, method)(**kwargs)
+
+    remaining = slot['delay'] - (time.time() - start)
+    if not slot['servos'] and remaining > 0:
+        robot.sleep(remaining)
+    for servo in slot['servos']:
+        if remaining <= 0:
+            break
+        robot.get_kin().wait(Kinematics.SERVOS[servo], remaining, robot.sleep)
+        remaining = slot['delay'] - (time.time() - start)
+
+
+def run_schedule(robot, schedule):
+    """Execute a compiled schedule, see run_slot."""
+    for slot in schedule:
+        run_slot(robot, slot)
+
+
+class TestMission(unittest.TestCase):
+
+    def test_mirror(self):
+        mission = Mission([
+            {'drive': 'turn_right', 'value': 60},
+            {'drive': 'backward', 'value': {'yellow': 50, 'blue': 55}},
+            {'drive': 'turn_right', 'value': 60, 'mirror': False},
+            {'drive': 'backward', 'value': {'yellow': 10, 'blue': None}},
+        ])
+        yellow = [slot['drive'] for slot in mission.compile('yellow')]
+        blue = [slot['drive'] for slot in mission.compile('blue')]
+        self.assertEqual(yellow, [('turn_right', 60), ('backward', 50),
+                                  ('turn_right', 60), ('backward', 10)])
+        self.assertEqual(blue, [('turn_left', 60), ('backward', 55),
+                                ('turn_right', 60)])
+
+    def test_overlap(self):
+        mission = Mission([
+            {'servos': ['middle_clamp'], 'delay': 1.5},
+            {'drive': 'turn_right', 'value': 60},
+            {'servos': ['up_clamp'], 'delay': 1, 'overlap': True},
+            {'drive': 'turn_left', 'value': 60},
+        ])
+        schedule = mission.compile('yellow')
+        self.assertEqual(len(schedule), 3)
+        self.assertEqual(schedule[0]['servos'], ['middle_clamp'])
+        self.assertIsNone(schedule[0]['drive'])
+        self.assertEqual(schedule[2]['servos'], ['up_clamp'])
+        self.assertEqual(schedule[2]['drive'], ('turn_left', 60))
+        self.assertEqual(schedule[2]['delay'], 1)
+
+    def test_resting_servos(self):
+        mission = Mission([
+            {'servos': ['push_back'], 'delay': 1},
+            {'servos': ['up_clamp'], 'delay': 2},
+            {'drive': 'forward', 'value': 10},
+            {'servos': ['close_clamp']},
+            {'drive': 'forward', 'value': 10},
+            {'servos': ['up_clamp']},
+            {'servos': ['down_clamp'], 'overlap': True},
+            {'drive': 'forward', 'value': 10},
+            {'servos': ['push_back'], 'overlap': False},
+            {'drive': 'forward', 'value': 10},
+        ])
+        schedule = [(slot['drive'] is not None, slot['servos']) for slot in mission.compile('yellow')]
+        self.assertEqual(schedule, [
+            (True, ['push_back', 'up_clamp']),
+            # The clamp holds the modules at the robot position.
+            (False, ['close_clamp']),
+            (True, []),
+            # Two moves of the dynamixel.
+            (False, ['up_clamp']),
+            (True, ['down_clamp']),
+            (False, ['push_back']),
+            (True, []),
+        ])
+        self.assertEqual(mission.compile('yellow')[0]['delay'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
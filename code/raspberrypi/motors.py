@@ -1,7 +1,10 @@
+import collections
 import time
 
 from enum import IntEnum
 from i2c import I2C
+from periodic import PeriodicExecutor
+from telemetry import telemetry
 
 
 class Command(IntEnum):
@@ -15,56 +18,225 @@ class Command(IntEnum):
     IsDone = 8
     IsStopped = 9
     Restart = 10
+    Arc = 11
+    Status = 12
+
+
+class Protocol(IntEnum):
+    Legacy = 1
+    Wide = 2
+
+
+class MotorsStatus:
+    """
+    Answer of the Status command: the regulation flags, the distance
+    travelled by each wheel since the last Status or DistanceTravelled
+    request and the regulation errors in encoder impulses.
+    """
+    __slots__ = ('done', 'stopped', 'left', 'right', 'lead_error', 'rotation_error')
+
+    def __init__(self, data):
+        self.done = bool(data[0] & 0x01)
+        self.stopped = bool(data[0] & 0x02)
+        self.left = I2C.int(data[1])
+        self.right = I2C.int(data[2])
+        self.lead_error = MotorsStatus.__int16(data[3], data[4])
+        self.rotation_error = MotorsStatus.__int16(data[5], data[6])
+
+    def __int16(high, low):
+        value = I2C.pack16(high, low)
+        return value - 0x10000 if value >> 15 == 1 else value
+
+
+class StallDetector:
+    """
+    Watch the progress of the wheels over a sliding window: the move is
+    stalled when the wheels went less than MIN_PROGRESS during the last
+    WINDOW seconds, e.g. when the robot pushes against the distributor.
+
+    The regulation slows down at the end of the move, the wheels then go
+    less than MIN_PROGRESS by window: the last FINAL_DISTANCE cm of the
+    move distance are never stalled.
+    """
+    WINDOW = 0.5
+    MIN_PROGRESS = 1
+    FINAL_DISTANCE = 5
+
+    def __init__(self, window=WINDOW, min_progress=MIN_PROGRESS, distance=None):
+        """distance: the distance in cm the wheels go in the move, if known."""
+        self.window = window
+        self.min_progress = min_progress
+        self.distance = distance
+        self._samples = collections.deque()
+        self._start = None
+        self._travelled = 0
+
+    def reset(self):
+        """Restart the window, the distance travelled is kept."""
+        self._samples.clear()
+        self._start = None
+
+    def update(self, timestamp, left, right):
+        """Add the wheels distance since the last update, return True if stalled."""
+        if self._start is None:
+            self._start = timestamp
+        progress = (abs(left) + abs(right)) / 2
+        self._travelled += progress
+        self._samples.append((timestamp, progress))
+        while self._samples and self._samples[0][0] < timestamp - self.window:
+            self._samples.popleft()
+
+        # The motors need some time to start.
+        if timestamp - self._start < self.window:
+            return False
+        if self.distance is not None and self._travelled >= self.distance - self.FINAL_DISTANCE:
+            return False
+        return sum(progress for _, progress in self._samples) < self.min_progress
 
 
 class Motors(I2C):
+    """
+    This class is an abstraction around the I2C communication with
+    the motors-arduino module.
+
+    Details of the "protocol" used:
+
+    The Raspberry Pi sends a command byte, eventually followed by the value
+    of the command (distance in cm or angle in degrees).
+
+    1. Legacy: [command, value]
+       The value is an unsigned byte so we can't go further than 255 cm
+       or turn more than 255 degrees in one command.
+
+    2. Wide: [command | WIDE_FLAG, b2, b1, b0]
+       The value is a 16 bits signed value in tenth of unit, packed with
+       I2C.pack_wide into 3 non-null bytes. Commands without the
+       WIDE_FLAG are still decoded as legacy commands by the Arduino.
+
+    The Arc command is only available in the wide protocol and takes 3
+    values: a straight distance, then the length and the angle of an arc
+    (positive to the right) following it without stopping.
+
+    The Status command answers 7 bytes read in a single transaction, see
+    MotorsStatus: [flags, left, right, lead error (2), rotation error (2)].
+
+    """
+    STATUS_SIZE = 7
     ANGLE_CORRECTION = 107.5 / 360
+    WIDE_FLAG = 0x40
+    WIDE_RESOLUTION = 10
 
-    def __init__(self, address):
-        super(Motors, self).__init__(address)
+    def __init__(self, address, protocol=Protocol.Wide, bus=None):
+        super(Motors, self).__init__(address, bus)
+        self.protocol = protocol
 
-    def move_with_instructions(self, path, move_callback, done_callback):
+    def move_with_instructions(self, path, move_callback, done_callback, segment_callback=None):
+        """
+        Follow the instructions of GraphMap.get_path, segment_callback is
+        called with each instruction once it is sent.
+        """
         for action in path:
-            val = int(action['value'])
+            val = action['value']
+            # Distance of the wheels for the stall detector.
+            distance = None
             if action['action'] == 'move':
                 if val > 0:
                     self.forward(val)
                 else:
                     self.backward(abs(val))
+                distance = abs(val)
             elif action['action'] == 'turn':
                 if val > 0:
                     self.turn_right(val)
                 else:
                     self.turn_left(abs(val))
-
+                distance = abs(val) * self.ANGLE_CORRECTION
+            elif action['action'] == 'arc':
+                self.arc(action['straight'], action['length'], val)
+                distance = action['straight'] + action['length']
+            if segment_callback is not None:
+                segment_callback(action)
 
             # Wait before action is done.
-            while not self.is_done(done_callback):
-                if move_callback() == 'obstacle':
-                    done_callback(self.get_distance_travelled(), 'obstacle')
-                    return
-                time.sleep(0.1)
+            result, _ = self.wait(done_callback, move_callback=move_callback,
+                                  stall_detector=StallDetector(distance=distance))
+            if result != 'ok':
+                return result
 
-        done_callback(self.get_distance_travelled())
         return 'ok'
 
+    def wait(self, done_callback=None, sleep=None, period=0.1, move_callback=None,
+             stall_detector=None):
+        """
+        Poll the Status until the regulation is done and return the result
+        ('ok', 'obstacle' or 'stalled') and the distance travelled by the
+        wheels. done_callback gets the distance at the end, with the result
+        when it isn't 'ok'.
+
+        The move is stopped when move_callback returns 'obstacle' or when
+        the stall_detector sees no progress of the wheels. The status and
+        move_callback are run every period by a PeriodicExecutor.
+        """
+        travelled = {'left': 0, 'right': 0}
+
+        def finish(result):
+            # Distance travelled until the stop.
+            status = self.status()
+            travelled['left'] += status.left
+            travelled['right'] += status.right
+            if done_callback is not None:
+                done_callback(travelled, result)
+            return result
+
+        def poll_status():
+            status = self.status()
+            travelled['left'] += status.left
+            travelled['right'] += status.right
+            if status.done:
+                if done_callback is not None:
+                    done_callback(travelled)
+                return 'ok'
+            if stall_detector is not None and not status.stopped and \
+                    stall_detector.update(time.monotonic(), status.left, status.right):
+                self.stop()
+                return finish('stalled')
+
+        def check_obstacle():
+            if move_callback() == 'obstacle':
+                return finish('obstacle')
+
+        executor = PeriodicExecutor(sleep)
+        executor.add('motors.status', period, poll_status)
+        if move_callback is not None:
+            executor.add('motors.obstacle', period, check_obstacle)
+        return executor.run(), travelled
+
     def forward(self, distance):
-        self.send([Command.Forward, distance])
+        self.__send_value(Command.Forward, distance)
 
     def backward(self, distance):
-        self.send([Command.Backward, distance])
+        self.__send_value(Command.Backward, distance)
 
     def turn_left(self, angle):
-        self.send([Command.TurnLeft, angle])
+        self.__send_value(Command.TurnLeft, angle)
 
     def turn_right(self, angle):
-        self.send([Command.TurnRight, angle])
+        self.__send_value(Command.TurnRight, angle)
+
+    def arc(self, straight, length, angle):
+        if self.protocol == Protocol.Legacy:
+            raise ValueError('The arc command needs the wide protocol.')
+        data = [Command.Arc | self.WIDE_FLAG]
+        for value in [straight, length, angle]:
+            data += I2C.pack_wide(int(round(value * self.WIDE_RESOLUTION)))
+        self.send(data)
 
     def set_speed(self, speed):
         self.send([Command.SetSpeed, speed])
 
     def stop(self):
         self.send(Command.Stop)
+        telemetry.command(self.address, Command.Stop)
 
     def get_distance_travelled(self):
         self.send(Command.DistanceTravelled)
@@ -81,9 +253,24 @@ class Motors(I2C):
             callback(self.get_distance_travelled())
         return is_done
 
+    def status(self):
+        self.send(Command.Status)
+        return MotorsStatus(self.receive(self.STATUS_SIZE))
+
     def is_stopped(self):
         self.send(Command.IsStopped)
         return self.receive()
 
     def restart(self):
         self.send(Command.Restart)
+
+    def __send_value(self, command, value):
+        if self.protocol == Protocol.Legacy:
+            value = int(round(value))
+            if not 0 <= value <= 0xFF:
+                raise ValueError('{} does not fit in a legacy command.'.format(value))
+            self.send([command, value])
+        else:
+            value = int(round(value * self.WIDE_RESOLUTION))
+            self.send([command | self.WIDE_FLAG] + I2C.pack_wide(value))
+        telemetry.command(self.address, command, value)
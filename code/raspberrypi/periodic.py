@@ -0,0 +1,162 @@
+import logging
+import os
+import time
+import unittest
+
+
+class LoopStats:
+    """
+    Lateness (jitter) histograms and overruns count of the periodic tasks.
+    A task overruns when it ends after its next deadline, the missed
+    periods are then skipped.
+    """
+    # Upper bounds of the jitter buckets in seconds.
+    BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1]
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, jitter, overrun):
+        task = self.tasks.get(name)
+        if task is None:
+            task = {'count': 0, 'overruns': 0, 'max_jitter': 0,
+                    'buckets': [0] * (len(self.BUCKETS) + 1)}
+            self.tasks[name] = task
+        task['count'] += 1
+        task['overruns'] += int(overrun)
+        task['max_jitter'] = max(task['max_jitter'], jitter)
+        i = 0
+        while i < len(self.BUCKETS) and jitter > self.BUCKETS[i]:
+            i += 1
+        task['buckets'][i] += 1
+
+    def clear(self):
+        self.tasks = {}
+
+
+# Stats shared by the executors of the robot modules.
+loop_stats = LoopStats()
+
+
+class _Task:
+    __slots__ = ('name', 'period', 'callback', 'deadline')
+
+    def __init__(self, name, period, callback):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.deadline = 0
+
+
+class PeriodicExecutor:
+    """
+    Run tasks at fixed rates. The deadlines are absolute on the monotonic
+    clock so the period doesn't drift with the duration of the tasks (I2C
+    latency, logs...). A task returns None to go on, any other value stops
+    the executor and is returned by run().
+    """
+
+    def __init__(self, sleep=None, stats=None):
+        """sleep: used to wait for the next deadline (e.g. Robot.sleep)."""
+        self._sleep = sleep
+        self._stats = stats if stats is not None else loop_stats
+        self._tasks = []
+
+    def add(self, name, period, callback):
+        self._tasks.append(_Task(name, period, callback))
+
+    def run(self):
+        sleep = self._sleep or time.sleep
+        now = time.monotonic()
+        for task in self._tasks:
+            task.deadline = now
+
+        while True:
+            # The first added task runs first when the deadlines are equal.
+            task = min(self._tasks, key=lambda t: t.deadline)
+            delay = task.deadline - time.monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            jitter = time.monotonic() - task.deadline
+            result = task.callback()
+
+            task.deadline += task.period
+            end = time.monotonic()
+            overrun = end > task.deadline
+            if overrun:
+                # Skip the missed periods instead of running late in a burst.
+                task.deadline += ((end - task.deadline) // task.period + 1) * task.period
+            self._stats.add(task.name, jitter, overrun)
+            if result is not None:
+                return result
+
+
+def set_realtime(cpu=None, priority=None):
+    """
+    Pin the process on a CPU and use the SCHED_FIFO real-time scheduling
+    with the given priority (Linux only, the priority needs root).
+    Return True if everything was applied.
+    """
+    applied = True
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            logging.warn('Could not pin the process on the CPU %s: %s', cpu, e)
+            applied = False
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            logging.warn('Could not set the real-time priority %s: %s', priority, e)
+            applied = False
+    return applied
+
+
+class TestPeriodicExecutor(unittest.TestCase):
+
+    def setUp(self):
+        import sys
+        from simulator import SimulatedClock
+
+        self.clock = SimulatedClock()
+        self.clock.install(sys.modules[__name__])
+
+    def tearDown(self):
+        import sys
+        sys.modules[__name__].time = time
+
+    def test_fixed_rate(self):
+        stats = LoopStats()
+        executor = PeriodicExecutor(self.clock.sleep, stats)
+        starts = []
+
+        def fast():
+            starts.append(self.clock.monotonic())
+            # Takes some time, the period must not drift.
+            self.clock.sleep(0.03)
+            if len(starts) == 10:
+                return 'done'
+
+        def slow():
+            # Overruns once.
+            self.clock.sleep(0.3 if stats.tasks.get('slow', {}).get('count', 0) == 1 else 0)
+
+        executor.add('fast', 0.1, fast)
+        executor.add('slow', 0.25, slow)
+        self.assertEqual(executor.run(), 'done')
+
+        self.assertEqual(stats.tasks['fast']['count'], 10)
+        self.assertEqual(stats.tasks['slow']['overruns'], 1)
+        # Absolute deadlines: still on the 0.1 grid after the late runs.
+        self.assertAlmostEqual(round(starts[-1] / 0.1) * 0.1, starts[-1])
+        self.assertGreater(stats.tasks['fast']['max_jitter'], 0.2)
+
+    def test_realtime(self):
+        # Nothing asked, nothing to fail.
+        self.assertTrue(set_realtime())
+
+
+if __name__ == '__main__':
+    unittest.main()
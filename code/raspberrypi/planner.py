@@ -0,0 +1,378 @@
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import unittest
+
+from multiprocessing import shared_memory
+
+from periodic import PeriodicExecutor
+from telemetry import CaptureSink, telemetry
+from tracing import tracer
+
+
+class SharedGraph:
+    """
+    Nodes and edges of a graph map packed in a shared memory block, so the
+    planner process builds its graph without the cache file or pickling.
+    It is a one-time copy, not a live view: the planner owns its graph
+    once built and every change goes through the PlannerService calls.
+    The control process frees the block as soon as the planner is ready.
+
+    Layout: the HEADER (nodes count, edges count), the NODE records (id,
+    x, y, mesh_edge flag, clearance) then the EDGE records (node ids,
+    weight, length, clearance). An unknown clearance is infinite.
+    """
+    HEADER = struct.Struct('<II')
+    NODE = struct.Struct('<iddBd')
+    EDGE = struct.Struct('<iiddd')
+
+    def __init__(self, name=None, graph_map=None):
+        """Pack graph_map in a new block, or attach to the block name."""
+        if graph_map is None:
+            self.memory = shared_memory.SharedMemory(name)
+            return
+
+        graph = graph_map.get_graph()
+        nodes = graph.nodes()
+        edges = graph.edges()
+        self.memory = shared_memory.SharedMemory(create=True, size=self.HEADER.size +
+                                                 len(nodes) * self.NODE.size +
+                                                 len(edges) * self.EDGE.size)
+        buffer = self.memory.buf
+        self.HEADER.pack_into(buffer, 0, len(nodes), len(edges))
+        offset = self.HEADER.size
+        for n in nodes:
+            attr = graph.node[n]
+            self.NODE.pack_into(buffer, offset, n, attr['pos'][0], attr['pos'][1],
+                                attr.get('mesh_edge', False), attr.get('clearance', math.inf))
+            offset += self.NODE.size
+        for a, b in edges:
+            attr = graph.edge[a][b]
+            self.EDGE.pack_into(buffer, offset, a, b, attr['weight'],
+                                attr.get('length', attr['weight']), attr.get('clearance', math.inf))
+            offset += self.EDGE.size
+
+    def build_graph(self):
+        """Return the networkx graph, with the attributes of GraphMap."""
+        import networkx as nx
+
+        buffer = self.memory.buf
+        nodes, edges = self.HEADER.unpack_from(buffer, 0)
+        start = self.HEADER.size
+        middle = start + nodes * self.NODE.size
+        end = middle + edges * self.EDGE.size
+
+        def node(n, x, y, mesh_edge, clearance):
+            attr = {'pos': (x, y), 'color': 'blue' if mesh_edge else 'red'}
+            if mesh_edge:
+                attr['mesh_edge'] = True
+            if clearance != math.inf:
+                attr['clearance'] = clearance
+            return n, attr
+
+        def edge(a, b, weight, length, clearance):
+            attr = {'weight': weight, 'color': 'black'}
+            if clearance != math.inf:
+                attr.update(length=length, clearance=clearance)
+            return a, b, attr
+
+        # The records are added in bulk, the copy doesn't outlive the call.
+        graph = nx.Graph()
+        graph.add_nodes_from(node(*record) for record in
+                             self.NODE.iter_unpack(bytes(buffer[start:middle])))
+        graph.add_edges_from(edge(*record) for record in
+                             self.EDGE.iter_unpack(bytes(buffer[middle:end])))
+        return graph
+
+    def close(self):
+        self.memory.close()
+
+
+def _serve(connection, graph_name, costmap_spec, detours_args, cpus):
+    """Main function of the planner process."""
+    from graphmap.detours import DetourSpeculator
+    from graphmap.graphmap import GraphMap
+
+    # The control process may be pinned with a real-time priority, the
+    # planner runs beside it with the normal scheduling.
+    try:
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+    except (AttributeError, OSError) as e:
+        logging.warn('Could not set the planner scheduling: %s', e)
+
+    # The telemetry records and the tracing spans go back to the control
+    # process with the responses.
+    capture = CaptureSink()
+    telemetry.start(capture)
+
+    shared_graph = SharedGraph(graph_name)
+    graph_map = GraphMap(None, None, graph=shared_graph.build_graph())
+    shared_graph.close()
+    # The response without id tells that the shared graph can be freed.
+    connection.send((None, True, None, capture.take(), tracer.take()))
+
+    costmap = None
+    costmap_memory = None
+    if costmap_spec is not None:
+        from graphmap.costmap import Costmap
+
+        name, robot_radius, dimension, resolution = costmap_spec
+        costmap_memory = shared_memory.SharedMemory(name)
+        costmap = Costmap(robot_radius, dimension, resolution, buffer=costmap_memory.buf)
+
+    objects = {
+        'graph': graph_map,
+        'detours': DetourSpeculator(graph_map, *detours_args) if detours_args else None,
+    }
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        request_id, target, method, args, kwargs = request
+        try:
+            if method == 'apply_costmap':
+                costmap.invalidate()
+                args = (costmap,)
+            result = getattr(objects[target], method)(*args, **kwargs)
+            response = (request_id, True, result)
+        except Exception as e:
+            if request_id is None:
+                logging.warn('Planner %s.%s failed: %s', target, method, e)
+                continue
+            response = (request_id, False, e)
+        if request_id is not None:
+            telemetry.flush()
+            connection.send(response + (capture.take(), tracer.take()))
+
+    # The views on the memory must be released before closing it.
+    costmap = None
+    if costmap_memory is not None:
+        costmap_memory.close()
+
+
+class _Remote:
+    """Calls the methods of an object of the planner process."""
+
+    def __init__(self, service, target, one_way):
+        self._service = service
+        self._target = target
+        self._one_way = one_way
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self._service.call(self._target, method, args, kwargs,
+                                      wait=method not in self._one_way)
+        return call
+
+
+class PlannerService:
+    """
+    Host the graph map in a planner process, so a long search doesn't stop
+    the control loop: the planner has its own GIL and can run on another
+    CPU.
+
+    The graph is given to the planner through a SharedGraph and the
+    costmap grid lives in a shared memory, written by the control process
+    and read by the planner when the costmap is applied. The calls go
+    through a pipe: the obstacles calls (see ONE_WAY) don't wait, the
+    others wait for their result while the idle callback keeps running
+    every IDLE_PERIOD (e.g. Robot.check_deadline). A caller with more to
+    do while waiting submits the call and polls its result instead, see
+    Robot.move_to. The telemetry records
+    and the tracing spans of the planner come with the results and are
+    added to the ones of the control process.
+
+    graph and detours have the methods of the GraphMap and of the
+    DetourSpeculator of the planner, except the attributes.
+    """
+    ONE_WAY = {
+        'graph': {'add_obstacle', 'add_moving_obstacle', 'apply_costmap', 'reset_obstacles'},
+        'detours': {'start', 'cancel'},
+    }
+    POLL_PERIOD = 0.002
+    IDLE_PERIOD = 0.05
+
+    def __init__(self, graph_map, costmap=None, detours_args=None, idle=None, sleep=None):
+        """
+        detours_args: the arguments of the DetourSpeculator after the graph
+        map, no speculator if None.
+        """
+        self._idle = idle
+        self._sleep = sleep
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        # Ids of the requests waiting for a result, and the results received.
+        self._pending = set()
+        self._results = {}
+
+        self._shared_graph = SharedGraph(graph_map=graph_map)
+        self._costmap_memory = None
+        costmap_spec = None
+        if costmap is not None:
+            self._costmap_memory = shared_memory.SharedMemory(create=True, size=costmap.size())
+            costmap.share(self._costmap_memory.buf)
+            costmap_spec = (self._costmap_memory.name, costmap.robot_radius,
+                            costmap.dimension, costmap.resolution)
+
+        # The CPUs the control process is not pinned on.
+        cpus = None
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = set(range(os.cpu_count())) - os.sched_getaffinity(0)
+
+        # Spawn instead of fork: the control process has threads.
+        context = multiprocessing.get_context('spawn')
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=_serve, name='planner', daemon=True, args=(
+            child, self._shared_graph.memory.name, costmap_spec, detours_args, cpus))
+        self._process.start()
+        child.close()
+
+        self.graph = _Remote(self, 'graph', self.ONE_WAY['graph'])
+        self.detours = _Remote(self, 'detours', self.ONE_WAY['detours'])
+
+    def submit(self, target, method, args=(), kwargs=None):
+        """
+        Send a call to the planner without waiting, return its request id:
+        poll() tells when its result() is there.
+        """
+        if method == 'apply_costmap':
+            # The planner reads the shared grid.
+            args = ()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending.add(request_id)
+            self._connection.send((request_id, target, method, args, kwargs or {}))
+        return request_id
+
+    def poll(self, request_id):
+        """Read the responses already received, return True if request_id is done."""
+        with self._lock:
+            while self._connection.poll():
+                response_id, ok, result, records, spans = self._connection.recv()
+                telemetry.put(records)
+                tracer.put(spans)
+                if response_id is None:
+                    self.__release_graph()
+                # The responses of the cancelled requests are dropped.
+                elif response_id in self._pending:
+                    self._results[response_id] = (ok, result)
+            return request_id in self._results
+
+    def result(self, request_id):
+        """Return the result of a polled request, or raise its exception."""
+        self._pending.discard(request_id)
+        ok, result = self._results.pop(request_id)
+        if not ok:
+            raise result
+        return result
+
+    def cancel(self, request_id):
+        """Forget a request, its result is dropped when it comes."""
+        self._pending.discard(request_id)
+        self._results.pop(request_id, None)
+
+    def call(self, target, method, args=(), kwargs=None, wait=True):
+        """
+        Call a method in the planner, return its result if wait. The idle
+        callback runs while waiting, the request is cancelled if it raises.
+        """
+        if not wait:
+            if method == 'apply_costmap':
+                args = ()
+            with self._lock:
+                self._connection.send((None, target, method, args, kwargs or {}))
+            return None
+
+        request_id = self.submit(target, method, args, kwargs)
+        executor = PeriodicExecutor(self._sleep)
+        executor.add('planner.result', self.POLL_PERIOD,
+                     lambda: self.poll(request_id) or None)
+        if self._idle is not None:
+            executor.add('planner.idle', self.IDLE_PERIOD, self._idle)
+        try:
+            executor.run()
+        except BaseException:
+            self.cancel(request_id)
+            raise
+        return self.result(request_id)
+
+    def __release_graph(self):
+        if self._shared_graph is not None:
+            self._shared_graph.close()
+            self._shared_graph.memory.unlink()
+            self._shared_graph = None
+
+    def close(self):
+        if self._process.is_alive():
+            self._connection.send(None)
+            self._process.join(1)
+        self._connection.close()
+        self.__release_graph()
+        if self._costmap_memory is not None:
+            # The costmap keeps a view on the memory, only the name is removed.
+            self._costmap_memory.unlink()
+
+
+class TestPlannerService(unittest.TestCase):
+
+    def test_planner(self):
+        import networkx as nx
+
+        from graphmap.graphmap import GraphMap
+
+        # 5 x 5 grid of nodes every 20 cm.
+        graph = nx.Graph()
+        for i in range(25):
+            graph.add_node(i, pos=(20 + i % 5 * 20, 20 + i // 5 * 20), color='red')
+        for i in range(25):
+            for j in [i + 1, i + 5]:
+                if j < 25 and (j == i + 5 or i % 5 != 4):
+                    graph.add_edge(i, j, weight=20, color='black')
+        graph_map = GraphMap(None, None, graph=graph)
+
+        idle_calls = []
+        service = PlannerService(graph_map, idle=lambda: idle_calls.append(1))
+        try:
+            start = {'point': (20, 20), 'angle': 0}
+            target = {'point': (100, 20), 'angle': 0}
+            self.assertEqual(service.graph.get_path(start, target),
+                             graph_map.get_path(start, target))
+
+            service.graph.add_obstacle(start, {'length': 30, 'width': 20}, 10, 'front', 15)
+            graph_map.add_obstacle(start, {'length': 30, 'width': 20}, 10, 'front', 15)
+            self.assertEqual(service.graph.get_route(start, target),
+                             graph_map.get_route(start, target))
+
+            far = {'point': (1000, 1000), 'angle': 0}
+            self.assertRaises(nx.NetworkXNoPath, service.graph.get_path, far, target)
+            self.assertTrue(idle_calls)
+
+            # The spans of the planner are added to the ones of this process.
+            tracer.clear()
+            service.graph.get_path(start, {'point': (100, 100), 'angle': 0})
+            self.assertEqual(tracer.histograms()['graphmap.get_path']['count'], 1)
+            # The planner copied the graph, the shared block is freed.
+            self.assertIsNone(service._shared_graph)
+
+            # A submitted call is polled, a cancelled one is dropped.
+            cancelled = service.submit('graph', 'get_path', (start, target))
+            service.cancel(cancelled)
+            request = service.submit('graph', 'get_path', (start, far))
+            while not service.poll(request):
+                time.sleep(service.POLL_PERIOD)
+            self.assertRaises(nx.NetworkXNoPath, service.result, request)
+            self.assertEqual(service._results, {})
+        finally:
+            service.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,9 +39,9 @@ class RangeSensor(I2C):
 
     """
 
-    def __init__(self, address):
+    def __init__(self, address, bus=None):
         """Constructor takes the adress of the I2C module"""
-        super(RangeSensor, self).__init__(address)
+        super(RangeSensor, self).__init__(address, bus)
         self.n = self.get_number_of_sensors()
 
     def get_range(self, sensor):
@@ -0,0 +1,251 @@
+import collections
+import struct
+import threading
+import time
+import unittest
+
+from simulator import SimulatedClock
+
+
+class Recorder:
+    """
+    Binary log of every I2C transaction, hooked with i2c.set_recorder().
+
+    File format: the MAGIC header followed by records made of a RECORD
+    header (monotonic timestamp in seconds, kind, address, payload length)
+    and the payload bytes. The control loop only packs the records and
+    queues them, a writer thread writes them to the file every FLUSH_PERIOD
+    seconds, or as soon as FLUSH_SIZE bytes are queued, so the disk never
+    blocks the loop being recorded.
+    """
+    MAGIC = b'I2CR\x01'
+    RECORD = struct.Struct('<dBBB')
+    SEND = 0
+    RECEIVE = 1
+    FLUSH_SIZE = 4096
+    FLUSH_PERIOD = 1
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(self.MAGIC)
+        self._queue = collections.deque()
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self.__writer, name='recorder', daemon=True)
+        self._thread.start()
+
+    def record_send(self, address, data):
+        self.__record(self.SEND, address, data)
+
+    def record_receive(self, address, data):
+        self.__record(self.RECEIVE, address, data)
+
+    def flush(self):
+        """Write the queued records now, from the calling thread."""
+        # Drained under the lock so the records are written in order.
+        with self._lock:
+            records = []
+            while self._queue:
+                records.append(self._queue.popleft())
+            self._queued = 0
+            self._file.write(b''.join(records))
+            self._file.flush()
+
+    def close(self):
+        """Stop the writer thread, write the remaining records and close the file."""
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+    def __record(self, kind, address, data):
+        if isinstance(data, int):
+            data = [data]
+        record = self.RECORD.pack(time.monotonic(), kind, address, len(data)) + bytes(data)
+        self._queue.append(record)
+        self._queued += len(record)
+        if self._queued > self.FLUSH_SIZE:
+            self._wake.set()
+
+    def __writer(self):
+        while not self._closed:
+            self._wake.wait(self.FLUSH_PERIOD)
+            self._wake.clear()
+            self.flush()
+
+
+def read_records(path):
+    """Return the list of (timestamp, kind, address, payload) of a recording."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if not content.startswith(Recorder.MAGIC):
+        raise Exception('{} is not an I2C recording.'.format(path))
+
+    records = []
+    offset = len(Recorder.MAGIC)
+    while offset < len(content):
+        timestamp, kind, address, length = Recorder.RECORD.unpack_from(content, offset)
+        offset += Recorder.RECORD.size
+        records.append((timestamp, kind, address, list(content[offset:offset + length])))
+        offset += length
+    return records
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayBus:
+    """
+    Bus backend feeding a recording back to the robot modules. Every byte
+    sent must match the recording and the reads return the recorded bytes.
+    The clock is set to the recorded timestamp (relative to the first
+    record) at each transaction, so that timeouts expire at the same place.
+    """
+
+    def __init__(self, records, clock=None):
+        self.clock = clock if clock is not None else SimulatedClock()
+        self._records = records
+        self._start = records[0][0] if records else 0
+        self._index = 0
+        # Position in the payload of the current send record.
+        self._sent = 0
+
+    def is_finished(self):
+        return self._index >= len(self._records)
+
+    def write_byte(self, address, byte):
+        record = self.__next(Recorder.SEND, address)
+        if record[3][self._sent] != byte:
+            raise ReplayError('Record {}: sent {} instead of {}.'.format(
+                self._index, byte, record[3][self._sent]))
+        self._sent += 1
+        if self._sent == len(record[3]):
+            self._sent = 0
+            self._index += 1
+
+    def read_i2c_block_data(self, address, cmd, num_bytes):
+        record = self.__next(Recorder.RECEIVE, address)
+        if len(record[3]) != num_bytes:
+            raise ReplayError('Record {}: read {} bytes instead of {}.'.format(
+                self._index, num_bytes, len(record[3])))
+        self._index += 1
+        return record[3]
+
+    def __next(self, kind, address):
+        if self.is_finished():
+            raise ReplayError('The recording is finished.')
+        record = self._records[self._index]
+        if record[1] != kind or record[2] != address:
+            raise ReplayError('Record {}: unexpected transaction with {}.'.format(
+                self._index, address))
+        self.clock.set_time(record[0] - self._start)
+        return record
+
+
+class TestRecorder(unittest.TestCase):
+
+    def test_record_and_replay(self):
+        import os
+        import tempfile
+
+        import i2c
+        from motors import Motors
+        from simulator import build_bus
+
+        path = os.path.join(tempfile.mkdtemp(), 'match.rec')
+        clock = SimulatedClock()
+        recorder = Recorder(path)
+        i2c.set_recorder(recorder)
+        try:
+            motors = Motors(5, bus=build_bus(clock))
+            motors.forward(300)
+            clock.sleep(20)
+            motors.is_done()
+            expected = motors.get_distance_travelled()
+        finally:
+            i2c.set_recorder(None)
+            recorder.close()
+
+        bus = ReplayBus(read_records(path))
+        motors = Motors(5, bus=bus)
+        motors.forward(300)
+        motors.is_done()
+        self.assertEqual(motors.get_distance_travelled(), expected)
+        self.assertTrue(bus.is_finished())
+        self.assertRaises(ReplayError, motors.stop)
+
+    def test_replay_move_to(self):
+        import math
+        import os
+        import tempfile
+
+        import i2c
+        import motors
+        import periodic
+        import robot
+        import scheduler
+        from simulator import build_bus
+
+        class TestRobot(robot.Robot):
+            PLANNER_PROCESS = False
+            SPECULATE_DETOURS = False
+
+        def move(bus, clock):
+            clock.install(motors, periodic, robot, scheduler)
+            i2c.set_bus(bus)
+            test_robot = TestRobot({'point': [30, 30], 'angle': 0})
+            test_robot.move_to({'point': (100, 100), 'angle': 90})
+            return test_robot._position
+
+        # The graph map cache is next to this module.
+        directory = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        path = os.path.join(tempfile.mkdtemp(), 'match.rec')
+        recorder = Recorder(path)
+        i2c.set_recorder(recorder)
+        try:
+            clock = SimulatedClock()
+            expected = move(build_bus(clock, position={'point': [30, 30], 'angle': 0}), clock)
+            self.assertGreater(math.hypot(expected['point'][0] - 30, expected['point'][1] - 30), 80)
+            i2c.set_recorder(None)
+            recorder.close()
+
+            bus = ReplayBus(read_records(path))
+            self.assertEqual(move(bus, bus.clock), expected)
+            self.assertTrue(bus.is_finished())
+        finally:
+            i2c.set_recorder(None)
+            i2c.set_bus(None)
+            for module in [motors, periodic, robot, scheduler]:
+                module.time = time
+            os.chdir(directory)
+
+
+if __name__ == '__main__':
+    # Replay a recording through a hardcode script:
+    #   python recorder.py match.rec launch_yellow
+    # or dump it without script.
+    import sys
+
+    import i2c
+    import mission
+    import motors
+    import robot2
+    import scheduler
+    import hardcode
+
+    records = read_records(sys.argv[1])
+    if len(sys.argv) < 3:
+        for timestamp, kind, address, payload in records:
+            print('{:.4f} {} {} {}'.format(timestamp, 'send' if kind == Recorder.SEND
+                                           else 'recv', address, payload))
+    else:
+        bus = ReplayBus(records)
+        bus.clock.install(i2c, mission, motors, robot2, scheduler, hardcode)
+        i2c.set_bus(bus)
+        getattr(hardcode, sys.argv[2])()
+        print('Replayed {} records.'.format(len(records)))
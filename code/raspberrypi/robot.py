@@ -1,16 +1,20 @@
 import logging
 import math
 import time
+import unittest
 
-from graphmap.map_generator import build_graph
-from kinematics import Kinematics
-from motors import Motors
+from kinematics import Adress, Kinematics
+from motors import Motors, StallDetector
+from periodic import PeriodicExecutor
 from range_sensors import RangeSensor
+from scheduler import Deadline
+from telemetry import telemetry
+from tracing import traced
+from tracker import OpponentTracker
 
 
-
-class Robot:
-    _DELAY_OPEN_ClOSE_CLAMP = 0.7
+class Robot(Deadline):
+    _DELAY_OPEN_CLOSE_CLAMP = 0.7
     _DELAY_UP_DOWN_CLAMP = 2.5
     _DELAY_IN_OUT_BLOCK = 3
 
@@ -31,6 +35,28 @@ class Robot:
     # Take in count the obstacle dimension (assuming another robot)
     # + the robot size.
     OBSTACLES_DIMENSION = 50
+    # Radius of the opponents used by the tracker.
+    OPPONENT_RADIUS = 15
+    # Time in seconds the opponents trajectory is predicted for.
+    PREDICTION_HORIZON = 3
+    # Range in cm up to which a zero range means a free space.
+    US_MAX_RANGE = 150
+
+    # Difference in cm between the wheels above which a lead is an arc.
+    ARC_THRESHOLD = 1
+    # Follow the paths with arcs instead of stopping to turn in the corners.
+    USE_ARCS = False
+    # Look for the fastest path instead of the shortest one.
+    FASTEST_PATH = False
+    # Look for the detours of the obstacles while driving, see DetourSpeculator.
+    SPECULATE_DETOURS = False
+    # Host the graph map in a planner process, see PlannerService.
+    PLANNER_PROCESS = False
+    # Number of replans around a stall before move_to gives up.
+    MAX_STALLS = 2
+    # Period in seconds of the motors status and the US sensors polls while
+    # the planner process computes a path.
+    STATUS_PERIOD = 0.1
 
     def __init__(self, position):
         """
@@ -44,75 +70,222 @@ class Robot:
         self._motors = Motors(5)
         self._kinematic = Kinematics(6)
 
-        logging.info('Building the graph map.')
-        robot_diagonal = math.sqrt(self.DIMENSION['length'] + self.DIMENSION['width']**2)
-        self._graph = build_graph(robot_diagonal)
-        logging.info('Finished to build the graph map.')
+        # networkx is only imported when a robot is created, so that
+        # importing this module stays fast.
+        from graphmap.detours import DetourSpeculator
+        from graphmap.map_generator import ROBOT_DIAGONAL, build_clearance, load_graph
+
+        logging.info('Loading the graph map.')
+        self._graph = load_graph()
+        logging.info('Finished to load the graph map.')
+        directions = {}
+        for us_data in self.US_SENSORS:
+            directions[self.__direction(us_data['name'])] = us_data['trigger_limit']
+        detours_args = (self.DIMENSION, self.OBSTACLES_DIMENSION, sorted(directions.items()))
+        self._move_target = None
+        self._obstacle_direction = None
+        self._current_action = None
+
+        # The hits on the table elements don't start opponent tracks.
+        static_map = None
+        try:
+            static_map = build_clearance(0)
+        except ImportError:
+            logging.warn('numpy is not installed, the table elements are tracked.')
+        self._tracker = OpponentTracker(self.DIMENSION, self.OPPONENT_RADIUS, static_map)
 
+        # numpy is optional, without it only the obstacles boxes are used.
+        try:
+            from graphmap.costmap import Costmap
+            self._costmap = Costmap(ROBOT_DIAGONAL)
+        except ImportError:
+            logging.warn('numpy is not installed, the costmap is disabled.')
+            self._costmap = None
+
+        # The planner process gets the graph map and the costmap grid, the
+        # robot uses it through the same methods.
+        self._planner = None
+        if self.PLANNER_PROCESS:
+            from planner import PlannerService
+            self._planner = PlannerService(self._graph, self._costmap, detours_args,
+                                           idle=self.check_deadline, sleep=self.sleep)
+            self._graph = self._planner.graph
+            self._detours = self._planner.detours
+        else:
+            self._detours = DetourSpeculator(self._graph, *detours_args)
+
+    def warm_up(self):
+        """
+        Prepare everything needed by the match before the start cord is
+        pulled: the graph map index and routes, and a self-test of the bus.
+        """
+        self._graph.warm_up()
+        self.self_test()
+
+    def self_test(self, samples=5):
+        """Log and return the round-trip latency of each Arduino."""
+        latencies = {}
+        for name, module in [('motors', self._motors), ('kinematics', self._kinematic)]:
+            latencies[name] = module.ping(samples)
+            logging.info('%s round-trip: %.2f ms', name, latencies[name] * 1000)
+        return latencies
+
+    @traced('robot.take_modules')
     def take_modules(self, number=1, distance=0):
         for i in range(number):
             self._kinematic.down_clamp()
-            time.sleep(self._DELAY_UP_DOWN_CLAMP)
+            self.__wait_servo(Adress.SERVO_DYNAMIXEL, self._DELAY_UP_DOWN_CLAMP)
             self._motors.forward(distance)
-            while not self._motors.is_done(self.__done_callback):
-                time.sleep(0.5)
+            self.wait_motors()
             self._kinematic.close_clamp()
-            time.sleep(self._DELAY_OPEN_CLOSE_CLAMP)
+            self.__wait_servo(Adress.SERVO_CLAMP, self._DELAY_OPEN_CLOSE_CLAMP)
             self._motors.backward(distance)
-            while not self._motors.is_done(self.__done_callback):
-                time.sleep(0.5)
+            self.wait_motors()
 
             #SEULEMENT SI ON DECIDE DE RECULER POUR MIEUX PRENDRE LE MODULE ---
             self._kinematic.open_clamp()
-            time.sleep(self._DELAY_OPEN_CLOSE_CLAMP)
+            self.__wait_servo(Adress.SERVO_CLAMP, self._DELAY_OPEN_CLOSE_CLAMP)
             self._motors.forward(2.5)
-            while not self._motors.is_done(self.__done_callback):
-                time.sleep(0.5)
+            self.wait_motors()
             self._kinematic.close_clamp()
-            time.sleep(self._DELAY_OPEN_CLOSE_CLAMP)
+            self.__wait_servo(Adress.SERVO_CLAMP, self._DELAY_OPEN_CLOSE_CLAMP)
             #---
 
             self._kinematic.up_clamp()
-            time.sleep(self._DELAY_UP_DOWN_CLAMP)
+            self.__wait_servo(Adress.SERVO_DYNAMIXEL, self._DELAY_UP_DOWN_CLAMP)
             self._kinematic.open_clamp()
 
+    def wait_motors(self):
+        """
+        Wait for the end of the regulation or until the robot is blocked,
+        update the position and return 'ok' or 'stalled'.
+        """
+        result, _ = self._motors.wait(self.__done_callback, self.sleep, 0.5,
+                                      stall_detector=StallDetector(window=1))
+        return result
+
     def eject_modules(self, number=1):
         for i in range(number):
             self._kinematic.push_out()
-            time.sleep(self._DELAY_IN_OUT_BLOCK)
+            self.__wait_servo(Adress.SERVO_PUSH, self._DELAY_IN_OUT_BLOCK)
             if number == 4 and i == 2:
                 self._kinematic.open_clamp()
-                time.sleep(self._DELAY_OPEN_CLOSE_CLAMP)
+                self.__wait_servo(Adress.SERVO_CLAMP, self._DELAY_OPEN_CLOSE_CLAMP)
             self._kinematic.push_back()
-            time.sleep(self._DELAY_IN_OUT_BLOCK)
+            self.__wait_servo(Adress.SERVO_PUSH, self._DELAY_IN_OUT_BLOCK)
 
+    @traced('robot.move_to')
     def move_to(self, target):
         """
         target: a dict with keys:
             - "angle": a X-axis relative constrain target angle.
             - "point": position of the target.
+
+        Return 'ok', or 'stalled' when the robot is still blocked after
+        MAX_STALLS replans around the side it was pushing.
         """
+        self._move_target = target
+        instructions = None
+        stalls = 0
         while True:
-            instructions = self._graph.get_path(self._position, target)
+            if instructions is None:
+                instructions = self.__get_path(target)
             status = self._motors.move_with_instructions(instructions, self.__move_callback,
-                    self.__done_callback)
+                    self.__done_callback, self.__segment_callback)
             if status == 'ok':
                 break
+            instructions = None
+            if status == 'stalled':
+                stalls += 1
+                if stalls > self.MAX_STALLS:
+                    logging.warn('Still stalled after %i replans, giving up', self.MAX_STALLS)
+                    break
+                self.__add_stall_obstacle()
+            elif status == 'obstacle' and self.SPECULATE_DETOURS:
+                # Ready if the obstacle is where it was expected.
+                instructions = self._detours.get(self._obstacle_direction, self._position,
+                                                 target, arcs=self.USE_ARCS)
+        self._detours.cancel()
+        self._move_target = None
+        return status
 
     def finalize(self):
         self._motors.stop()
 
         self._kinematic.launch_funny()
-        time.sleep(1)
+        self._kinematic.wait(Adress.SERVO_FUNNY, 1)
         self._kinematic.reset_funny()
 
+    def close(self):
+        """Stop the planner process."""
+        if self._planner is not None:
+            self._planner.close()
+
+    def __wait_servo(self, servo, timeout):
+        """Wait for a servo, at most timeout seconds, until the match deadline."""
+        return self._kinematic.wait(servo, timeout, self.sleep)
+
+    def __get_path(self, target):
+        """
+        Return the instructions of the graph map from the current position
+        to target. The planner process computes them while the motors status
+        and the US sensors are still polled: the robot may slide after a
+        stop and the opponents keep moving.
+        """
+        args = (self._position, target)
+        kwargs = {'arcs': self.USE_ARCS, 'fastest': self.FASTEST_PATH}
+        if self._planner is None:
+            return self._graph.get_path(*args, **kwargs)
+
+        request = self._planner.submit('graph', 'get_path', args, kwargs)
+        executor = PeriodicExecutor(self.sleep)
+        executor.add('robot.plan', self._planner.POLL_PERIOD,
+                     lambda: self._planner.poll(request) or None)
+        executor.add('robot.status', self.STATUS_PERIOD, self.__poll_status)
+        # Only fed: the robot is stopped, the next move checks the ranges.
+        executor.add('robot.sensors', self.STATUS_PERIOD, lambda: self.__update_sensors() and None)
+        try:
+            executor.run()
+        except BaseException:
+            self._planner.cancel(request)
+            raise
+        return self._planner.result(request)
+
+    def __poll_status(self):
+        """Add the wheels distance since the last status to the position."""
+        status = self._motors.status()
+        if status.left or status.right:
+            self.__update_robot_position({'left': status.left, 'right': status.right})
+
+    def __update_sensors(self):
+        """
+        Read the US sensors, feed every sensor once to the tracker and the
+        costmap (the front sensors are shared) and return the ranges with
+        their time.
+        """
+        self.check_deadline()
+        #  ranges = self._us_sensors.get_ranges()
+        ranges = [20, 20, 20, 20, 20]
+        now = time.monotonic()
+
+        rays = {}
+        for us_data in self.US_SENSORS:
+            for sensor in us_data['sensors']:
+                if sensor not in rays:
+                    rays[sensor] = self.__sensor_ray(us_data['name'])
+                    if ranges[sensor] != 0:
+                        self._tracker.update(self._position, us_data['name'], ranges[sensor], now)
+        if self._costmap is not None:
+            self._costmap.update_rays([rays[s][0] for s in rays], [rays[s][1] for s in rays],
+                                      [ranges[s] for s in rays], self.US_MAX_RANGE)
+        return ranges, now
+
     def __move_callback(self):
         """
         Return a string giving the state if we need to stop or not the regulation because of
         an obstacle.
         """
-        #  ranges = self._us_sensors.get_ranges()
-        ranges = [20, 20, 20, 20, 20]
+        ranges, now = self.__update_sensors()
 
         for us_data in self.US_SENSORS:
             for i, sensor in enumerate(us_data['sensors']):
@@ -123,50 +296,146 @@ class Robot:
                     logging.warn('Motors stopped becauce of the %s%i US sensors at %i cm',
                                  us_data['name'], i, ranges[sensor])
                     self._motors.stop()
-                    # TODO: avoid recalculation if we have the near same position.
+                    # The graph map is modified.
+                    self._detours.cancel()
+                    self._obstacle_direction = self.__direction(us_data['name'])
+                    # The same obstacles from the near same position reuse the
+                    # plan cached by get_path.
                     self._graph.reset_obstacles()
                     self._graph.add_obstacle(
                         self._position,
                         self.DIMENSION,
                         self.OBSTACLES_DIMENSION,
-                        us_data['name'],
+                        self._obstacle_direction,
                         ranges[sensor]
                     )
+                    # Avoid where the opponents are going too.
+                    for trajectory in self._tracker.predict(now, self.PREDICTION_HORIZON):
+                        self._graph.add_moving_obstacle(self._position, trajectory,
+                                                        self.OPPONENT_RADIUS + self.DIMENSION['length'] / 2)
+                    if self._costmap is not None:
+                        self._graph.apply_costmap(self._costmap)
                     return 'obstacle'
         return 'continue'
 
+    def __add_stall_obstacle(self):
+        """
+        The robot pushes against something the US sensors don't see (e.g. a
+        table element): block the side it was going to.
+        """
+        self._detours.cancel()
+        action = self._current_action
+        direction = 'front'
+        if action is not None and action['action'] == 'move' and action['value'] < 0:
+            direction = 'back'
+        self._graph.reset_obstacles()
+        self._graph.add_obstacle(self._position, self.DIMENSION, self.OBSTACLES_DIMENSION,
+                                 direction, 0)
+
+    def __segment_callback(self, action):
+        self._current_action = action
+        if self.SPECULATE_DETOURS and self._move_target is not None:
+            self._detours.start(self._position, action, self._move_target, self.FASTEST_PATH,
+                                self.USE_ARCS)
+
+    def __direction(self, name):
+        """Direction of a US sensor for GraphMap.add_obstacle."""
+        return 'front' if name.startswith('front') else name
+
+    def __sensor_ray(self, name):
+        """Return the position and the X-axis relative angle of a US sensor."""
+        name = self.__direction(name)
+        if name in ['front', 'back']:
+            offset = self.DIMENSION['length'] / 2
+        else:
+            offset = self.DIMENSION['width'] / 2
+        angle = self._position['angle'] + OpponentTracker.DIRECTIONS[name]
+        return ((self._position['point'][0] + offset * math.cos(math.radians(angle)),
+                 self._position['point'][1] + offset * math.sin(math.radians(angle))), angle)
+
     def __done_callback(self, distance_travelled, status='ok'):
         """
         Update the position and angle informations of the robots.
         """
-        self._move_target = None
-
         logging.info('Regulation is done!')
         self.__update_robot_position(distance_travelled)
-        print(self._position)
+        telemetry.pose(self._position)
 
         return status
 
     def __update_robot_position(self, distance_travelled):
-        left = distance_travelled['left']
-        right = distance_travelled['right']
-
-        if self.__is_opposite_sign(left, right):
-            # We finished a rotation regulation.
-            angle = ((right - left) / 2) / Motors.ANGLE_CORRECTION
-            self._position['angle'] += angle
-            logging.info('Robot turned with an angle of %i', angle)
-        else:
-            # We finished a lead regulation.
-            angle = self._position['angle']
-            distance = (left + right) / 2
-
-            self._position['point'][0] += distance * math.cos(math.radians(angle))
-            self._position['point'][1] += distance * math.sin(math.radians(angle))
-
-    def __is_opposite_sign(self, n, m):
-        if n > 0 and m > 0:
-            return False
-        elif n < 0 and m < 0:
-            return False
-        return True
+        update_position(self._position, distance_travelled['left'],
+                        distance_travelled['right'], self.ARC_THRESHOLD)
+
+
+def update_position(position, left, right, arc_threshold=Robot.ARC_THRESHOLD):
+    """
+    Update the position dict with the distances travelled by the wheels
+    during a regulation.
+
+    The wheels have different distances in an arc and the inner one goes
+    backward when the radius is below the half-track, so a rotation is
+    only told apart by the wheels going the same distance in opposite
+    directions.
+    """
+    angle = ((right - left) / 2) / Motors.ANGLE_CORRECTION
+    distance = (left + right) / 2
+
+    if abs(right - left) <= arc_threshold:
+        # We finished a lead regulation.
+        heading = position['angle']
+    elif abs(left + right) <= arc_threshold:
+        # We finished a rotation regulation.
+        position['angle'] += angle
+        logging.info('Robot turned with an angle of %i', angle)
+        return
+    else:
+        # Assume a constant curvature, the straight part of the arc command
+        # is thus approximated.
+        distance = 2 * distance / math.radians(angle) * math.sin(math.radians(angle) / 2)
+        heading = position['angle'] + angle / 2
+        position['angle'] += angle
+
+    position['point'][0] += distance * math.cos(math.radians(heading))
+    position['point'][1] += distance * math.sin(math.radians(heading))
+
+
+class TestOdometry(unittest.TestCase):
+
+    def drive(self, command, *values):
+        """Return the position of the odometry and of the simulated robot."""
+        from simulator import SimulatedClock, build_bus
+
+        clock = SimulatedClock()
+        bus = build_bus(clock)
+        motors = Motors(5, bus=bus)
+        getattr(motors, command)(*values)
+        clock.sleep(10)
+        status = motors.status()
+        position = {'point': [0, 0], 'angle': 0}
+        update_position(position, status.left, status.right)
+        return position, bus.model.position
+
+    def assertSamePosition(self, position, expected):
+        # The wheel distances are whole cm: 1 cm is 3.3 degrees of rotation.
+        self.assertAlmostEqual(position['point'][0], expected['point'][0], delta=2)
+        self.assertAlmostEqual(position['point'][1], expected['point'][1], delta=2)
+        self.assertAlmostEqual((position['angle'] - expected['angle'] + 180) % 360 - 180, 0,
+                               delta=4)
+
+    def test_moves(self):
+        self.assertSamePosition(*self.drive('forward', 50))
+        self.assertSamePosition(*self.drive('turn_left', 90))
+
+    def test_tight_arc(self):
+        # Radius 10 cm: the inner wheel goes backward.
+        position, expected = self.drive('arc', 2, 15.7, -90)
+        self.assertAlmostEqual(expected['angle'], 90)
+        self.assertSamePosition(position, expected)
+
+    def test_wide_arc(self):
+        self.assertSamePosition(*self.drive('arc', 0, 62.8, 90))
+
+
+if __name__ == '__main__':
+    unittest.main()
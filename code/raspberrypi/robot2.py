@@ -2,15 +2,19 @@ import time
 import logging
 import math
 
-from motors import Motors
-from kinematics import Kinematics
+from motors import Motors, StallDetector
+from periodic import PeriodicExecutor
+from kinematics import Adress, Kinematics
 from range_sensors import RangeSensor
+from scheduler import Deadline
+from telemetry import Event, telemetry
+from tracing import traced
 
 DELAY_OPEN_ClOSE_CLAMP = 0.7
 DELAY_UP_DOWN_CLAMP = 2.5
 DELAY_IN_OUT_BLOCK = 3
 
-class Robot:
+class Robot(Deadline):
     # US sensors constants.
     US_SENSORS = [
         {'name': 'front_bottom', 'trigger_limit': 8, 'sensors': 0},
@@ -40,52 +44,99 @@ class Robot:
         logging.info('Finished to build the graph map.')
         self._blocking_servo = -1
 
+    def warm_up(self):
+        """
+        Prepare everything needed by the match before the start cord is
+        pulled. There is no graph map so this is only a self-test of the bus.
+        """
+        self.self_test()
+
+    def self_test(self, samples=5):
+        """Log and return the round-trip latency of each Arduino."""
+        latencies = {}
+        for name, module in [('motors', self._motors), ('kinematics', self._kinematic),
+                             ('range_sensors', self._us)]:
+            latencies[name] = module.ping(samples)
+            logging.info('%s round-trip: %.2f ms', name, latencies[name] * 1000)
+        return latencies
+
     def reset_kinematics(self):
         self._kinematic.up_clamp()
-        time.sleep(0.2)
+        self._kinematic.wait(Adress.SERVO_DYNAMIXEL, 0.2)
         self._kinematic.open_clamp()
-        time.sleep(0.2)
+        self._kinematic.wait(Adress.SERVO_CLAMP, 0.2)
         self._kinematic.reset_funny()
-        time.sleep(0.2)
+        self._kinematic.wait(Adress.SERVO_FUNNY, 0.2)
         self._kinematic.push_back()
-        time.sleep(1)
+        self._kinematic.wait(Adress.SERVO_PUSH, 1)
 
+    @traced('robot.wait_motors')
     def wait_motors(self, enable=True, timeout=0):
+        """
+        Wait for the end of the regulation and return 'ok', or 'stalled' as
+        soon as the wheels stop progressing (the move is then stopped), or
+        'timeout'.
+        """
         first_time = time.time()
-        while not self._motors.is_done():
-            if enable:
-                if self._blocking_servo != -1:
-                    i = self._blocking_servo
-                    test = self._us.get_range(i)
-                    print(test)
-                    if test > self.US_SENSORS[i]['trigger_limit']:
-                        self._motors.restart()
-                        self._blocking_servo = -1
-                    else:
-                        continue
-                us_sensors = self._us.get_ranges()
-                print(us_sensors)
-                for i, us in enumerate(us_sensors):
-                    if 'front' in self.US_SENSORS[i]['name'] or 'back' in self.US_SENSORS[i]['name']:
-                            if us < self.US_SENSORS[i]['trigger_limit']:
-                                self._motors.stop()
-                                self._blocking_servo = i
-                                break
+        stall_detector = StallDetector()
+        travelled = [0]
+
+        def poll_motors():
+            status = self._motors.status()
+            if status.done:
+                return 'ok'
+            self.check_deadline()
+
+            travelled[0] += (status.left + status.right) / 2
+            # Stopped by the sensors, it's not a stall.
+            if status.stopped:
+                stall_detector.reset()
+            elif stall_detector.update(time.monotonic(), status.left, status.right):
+                self._motors.stop()
+                logging.warn('Motors stalled after %.1f', travelled[0])
+                telemetry.event(Event.Stalled, travelled[0])
+                return 'stalled'
             if (time.time() - first_time) > timeout and timeout != 0:
-                break
-            time.sleep(0.1)
-
-
+                return 'timeout'
+
+        def poll_sensors():
+            if self._blocking_servo != -1:
+                i = self._blocking_servo
+                test = self._us.get_range(i)
+                if test > self.US_SENSORS[i]['trigger_limit']:
+                    self._motors.restart()
+                    self._blocking_servo = -1
+                    telemetry.event(Event.SensorCleared, i, test)
+                else:
+                    return
+            us_sensors = self._us.get_ranges()
+            telemetry.ranges(us_sensors)
+            for i, us in enumerate(us_sensors):
+                if 'front' in self.US_SENSORS[i]['name'] or 'back' in self.US_SENSORS[i]['name']:
+                        if us < self.US_SENSORS[i]['trigger_limit']:
+                            self._motors.stop()
+                            self._blocking_servo = i
+                            telemetry.event(Event.SensorBlocked, i, us)
+                            break
+
+        executor = PeriodicExecutor(self.sleep)
+        executor.add('motors.status', 0.1, poll_motors)
+        if enable:
+            executor.add('robot.sensors', 0.1, poll_sensors)
+        return executor.run()
+
+
+    @traced('robot.take_modules')
     def take_modules(self, number=1):
         for i in range(number):
             self._kinematic.open_clamp()
             self._kinematic.down_clamp()
-            time.sleep(DELAY_UP_DOWN_CLAMP)
+            self.__wait_servo(Adress.SERVO_DYNAMIXEL, DELAY_UP_DOWN_CLAMP)
             self._motors.forward(9)
             self.wait_motors(enable=False, timeout=2)
 
             self._kinematic.close_clamp()
-            time.sleep(1)
+            self.__wait_servo(Adress.SERVO_CLAMP, 1)
             #  self._motors.set_speed(40)
             self._motors.backward(7)
             if number == 1:
@@ -99,29 +150,29 @@ class Robot:
 
             #SEULEMENT SI ON DECIDE DE RECULER POUR MIEUX PRENDRE LE MODULE ---
             self._kinematic.open_clamp()
-            time.sleep(0.5)
+            self.__wait_servo(Adress.SERVO_CLAMP, 0.5)
             self._motors.forward(3)
             self.wait_motors(enable=False, timeout=2)
             self._kinematic.close_clamp()
-            time.sleep(1)
+            self.__wait_servo(Adress.SERVO_CLAMP, 1)
             #---
 
             self._motors.forward(3)
             self._kinematic.up_clamp()
             self.wait_motors(enable=False, timeout=3)
-            time.sleep(0.5)
+            self.__wait_servo(Adress.SERVO_DYNAMIXEL, 0.5)
             self._kinematic.open_clamp()
-            time.sleep(1)
+            self.__wait_servo(Adress.SERVO_CLAMP, 1)
         self._kinematic.down_clamp()
-        time.sleep(0.5)
+        self.__wait_servo(Adress.SERVO_DYNAMIXEL, 0.5)
         self._kinematic.up_clamp()
 
     def eject_modules(self, number=1):
         for i in range(number):
             self._kinematic.push_out()
-            time.sleep(1.5)
+            self.__wait_servo(Adress.SERVO_PUSH, 1.5)
             self._kinematic.push_back()
-            time.sleep(1.5)
+            self.__wait_servo(Adress.SERVO_PUSH, 1.5)
         self._motors.forward(2)
         self.wait_motors(timeout=2)
         self._motors.backward(8)
@@ -138,5 +189,9 @@ class Robot:
         self._motors.stop()
 
         self._kinematic.launch_funny()
-        time.sleep(0.8)
+        self.__wait_servo(Adress.SERVO_FUNNY, 0.8)
         self._kinematic.reset_funny()
+
+    def __wait_servo(self, servo, timeout):
+        """Wait for a servo, at most timeout seconds, until the match deadline."""
+        return self._kinematic.wait(servo, timeout, self.sleep)
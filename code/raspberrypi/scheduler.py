@@ -0,0 +1,212 @@
+import json
+import logging
+import os.path
+import time
+import unittest
+
+from tracing import span
+
+
+class MatchOver(Exception):
+    """Raised by the robot when the match deadline is reached."""
+    pass
+
+
+class Deadline:
+    """
+    Parent class of the robots giving them a match deadline. The waiting
+    loops call check_deadline() and sleep() so that the robot gives back
+    the control as soon as the deadline is reached, always between two
+    I2C transactions.
+    """
+    _deadline = None
+
+    def set_deadline(self, deadline):
+        """Takes a time.monotonic() deadline or None to disable it."""
+        self._deadline = deadline
+
+    def check_deadline(self):
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            raise MatchOver()
+
+    def sleep(self, seconds):
+        with span('robot.sleep'):
+            if self._deadline is not None:
+                remaining = self._deadline - time.monotonic()
+                if remaining < seconds:
+                    time.sleep(max(remaining, 0))
+                    raise MatchOver()
+            time.sleep(seconds)
+
+
+class MatchScheduler:
+    """
+    Run the goals of a match in the same process as the robot and stop
+    them at the deadline. Before starting a goal, its duration is estimated
+    from the timings of the previous matches (or from a simple model the
+    first time). A goal which can't finish before the deadline is skipped
+    and the next possible goal is tried instead.
+
+    A goal is a dict with the keys:
+        - "name": used in the logs and the timings history.
+        - "mission": a mission.Mission.
+        - "requires": names of the goals which must be done before.
+    """
+    MATCH_DURATION = 90
+    # The motors must be stopped before the buzzer: the deadline is
+    # STOP_LATENCY seconds before the end of the match.
+    STOP_LATENCY = 0.3
+    HISTORY_PATH = 'timings.json'
+    # Weight of the last timing in the history average.
+    HISTORY_WEIGHT = 0.3
+
+    # Model used when a slot has no history.
+    SPEED = 20
+    ROTATION_SPEED = 60
+    COMMAND_OVERHEAD = 0.5
+    ROBOT_ACTIONS = {
+        'take_modules': 10,
+        'eject_modules': 3.5,
+    }
+
+    def __init__(self, robot, side, duration=MATCH_DURATION, history_path=HISTORY_PATH):
+        self._robot = robot
+        self._side = side
+        self._duration = duration
+        self._history_path = history_path
+        self._history = {}
+        if history_path and os.path.exists(history_path):
+            with open(history_path) as f:
+                self._history = json.load(f)
+        self._start = None
+        self.done = []
+        self.skipped = []
+
+    def start(self):
+        self._start = time.monotonic()
+        self._robot.set_deadline(self._start + self._duration - self.STOP_LATENCY)
+
+    def remaining(self):
+        return self._start + self._duration - self.STOP_LATENCY - time.monotonic()
+
+    def estimate(self, schedule):
+        return sum(self.__estimate_slot(slot) for slot in schedule)
+
+    def run(self, goals):
+        """Run the goals until they are all done or the match is over."""
+        from mission import run_slot
+
+        if self._start is None:
+            self.start()
+
+        pending = list(goals)
+        try:
+            while pending:
+                goal = self.__next_goal(pending)
+                if goal is None:
+                    break
+                pending.remove(goal)
+
+                logging.info('Starting the goal %s', goal['name'])
+                for slot in goal['mission'].compile(self._side):
+                    start = time.monotonic()
+                    run_slot(self._robot, slot)
+                    self.__update_history(slot, time.monotonic() - start)
+                self.done.append(goal['name'])
+        except MatchOver:
+            logging.info('The match is over during the goal %s.', goal['name'])
+            self.skipped.append(goal['name'])
+        finally:
+            self.skipped += [goal['name'] for goal in pending]
+            self.finalize()
+
+    def finalize(self):
+        self._robot.set_deadline(None)
+        self._robot.finalize()
+        if self._history_path:
+            with open(self._history_path, 'w') as f:
+                json.dump(self._history, f, indent=4, sort_keys=True)
+
+    def __next_goal(self, pending):
+        """Return the first goal which can be done and finished in time."""
+        for goal in list(pending):
+            if any(name not in self.done for name in goal.get('requires', [])):
+                if any(name in self.skipped for name in goal.get('requires', [])):
+                    pending.remove(goal)
+                    self.skipped.append(goal['name'])
+                continue
+
+            estimate = self.estimate(goal['mission'].compile(self._side))
+            if estimate <= self.remaining():
+                return goal
+
+            logging.warn('Skipping the goal %s (%.1f s needed, %.1f s remaining)',
+                         goal['name'], estimate, self.remaining())
+            pending.remove(goal)
+            self.skipped.append(goal['name'])
+        return None
+
+    def __slot_key(self, slot):
+        key = []
+        if slot['drive'] is not None:
+            key.append('{}:{}'.format(*slot['drive']))
+        if slot['robot'] is not None:
+            key.append('{}:{}'.format(slot['robot'][0], sorted(slot['robot'][1].items())))
+        key += slot['servos']
+        return ','.join(key)
+
+    def __estimate_slot(self, slot):
+        key = self.__slot_key(slot)
+        if key in self._history:
+            return self._history[key]
+
+        duration = 0
+        if slot['drive'] is not None:
+            method, value = slot['drive']
+            speed = self.ROTATION_SPEED if method.startswith('turn') else self.SPEED
+            duration += abs(value) / speed + self.COMMAND_OVERHEAD
+        if slot['robot'] is not None:
+            method, kwargs = slot['robot']
+            duration += self.ROBOT_ACTIONS.get(method, 0) * kwargs.get('number', 1)
+        return max(duration, slot['delay'])
+
+    def __update_history(self, slot, duration):
+        key = self.__slot_key(slot)
+        if key in self._history:
+            duration = (1 - self.HISTORY_WEIGHT) * self._history[key] + \
+                self.HISTORY_WEIGHT * duration
+        self._history[key] = duration
+
+
+class TestMatchScheduler(unittest.TestCase):
+
+    class FakeRobot(Deadline):
+        def __init__(self):
+            self.finalized = False
+
+        def finalize(self):
+            self.finalized = True
+
+    def test_skip_goals(self):
+        from mission import Mission
+
+        robot = self.FakeRobot()
+        scheduler = MatchScheduler(robot, 'yellow', duration=10, history_path=None)
+        scheduler.run([
+            {'name': 'too_long', 'mission': Mission([{'drive': 'forward', 'value': 1000}])},
+            {'name': 'after', 'mission': Mission([]), 'requires': ['too_long']},
+            {'name': 'short', 'mission': Mission([])},
+        ])
+        self.assertEqual(scheduler.done, ['short'])
+        self.assertEqual(scheduler.skipped, ['too_long', 'after'])
+        self.assertTrue(robot.finalized)
+
+    def test_deadline(self):
+        robot = self.FakeRobot()
+        robot.set_deadline(time.monotonic())
+        self.assertRaises(MatchOver, robot.sleep, 10)
+        self.assertRaises(MatchOver, robot.check_deadline)
+
+
+if __name__ == '__main__':
+    unittest.main()
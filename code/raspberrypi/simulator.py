@@ -0,0 +1,547 @@
+import errno
+import math
+import random
+import time
+import unittest
+
+from i2c import I2C
+from motors import Command as MotorsCommand, Motors, StallDetector
+from kinematics import Command as KinematicsCommand, Adress, Kinematics, Status
+from range_sensors import Command as RangeSensorCommand
+
+
+class SimulatedClock:
+    """
+    Virtual clock replacing the time module in the robot modules so that
+    a whole match script can run faster than real time.
+    Every sleep only moves the clock forward.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def perf_counter(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._now += seconds
+
+    def set_time(self, now):
+        self._now = now
+
+    def install(self, *modules):
+        """Replace the time module used by the given modules."""
+        for module in modules:
+            module.time = self
+
+
+class RobotModel:
+    """
+    Simple kinematic model of the robot. The pose uses the same dict as
+    robot.Robot: "point" in cm and "angle" in degrees relative to the X axis.
+    """
+
+    def __init__(self, position=None, speed=30, rotation_speed=120):
+        if position is None:
+            position = {'point': [0, 0], 'angle': 0}
+        self.position = {'point': list(position['point']), 'angle': position['angle']}
+        # cm/s and degrees/s.
+        self.speed = speed
+        self.rotation_speed = rotation_speed
+
+    def move(self, distance):
+        angle = math.radians(self.position['angle'])
+        self.position['point'][0] += distance * math.cos(angle)
+        self.position['point'][1] += distance * math.sin(angle)
+
+    def turn(self, angle):
+        """Positive angle turns right (clockwise)."""
+        self.position['angle'] = (self.position['angle'] - angle) % 360
+
+
+class SimulatedDevice:
+    """
+    Base class of the simulated Arduinos. The bus calls write() for every
+    byte sent and read() when the Raspberry Pi requests some bytes. Like on
+    the real bus, a read first writes its register byte.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def write(self, byte):
+        raise NotImplementedError
+
+    def read(self, num_bytes):
+        raise NotImplementedError
+
+
+class SimulatedMotors(SimulatedDevice):
+    """
+    Follows the protocol of motors.Command, with both the legacy and the
+    wide encoding of the values. When "blocked", the wheels don't move, like
+    when the robot pushes against an obstacle.
+    """
+
+    def __init__(self, clock, model):
+        super(SimulatedMotors, self).__init__(clock)
+        self.model = model
+        self._command = None
+        self._wide = False
+        self._data = []
+        self._response = [0]
+
+        self._motion = None
+        self._target = 0
+        self._progress = 0
+        self._sign = 1
+        self._arc = (0, 0, 0)
+        self._stopped = False
+        self._last_update = clock.time()
+        self._reported = [0, 0]
+        self.blocked = False
+
+    def write(self, byte):
+        if byte == 0:
+            return
+        if self._command is None:
+            self._command = byte & ~Motors.WIDE_FLAG
+            self._wide = bool(byte & Motors.WIDE_FLAG)
+            self._data = []
+        else:
+            self._data.append(byte)
+
+        needed = 0
+        if self._command in (MotorsCommand.Forward, MotorsCommand.Backward,
+                             MotorsCommand.TurnLeft, MotorsCommand.TurnRight,
+                             MotorsCommand.SetSpeed):
+            needed = 3 if self._wide else 1
+        elif self._command == MotorsCommand.Arc:
+            needed = 9
+        if len(self._data) == needed:
+            self.__execute()
+
+    def read(self, num_bytes):
+        return (self._response + [0] * num_bytes)[:num_bytes]
+
+    def is_done(self):
+        self.update()
+        return self._motion is None or self._progress >= self._target
+
+    def get_wheels_distance(self):
+        """Return the (left, right) distance in cm since the last command."""
+        self.update()
+        if self._motion == 'move':
+            return (self._progress, self._progress)
+        elif self._motion == 'arc':
+            wheel = self.__arc_rotation(self._progress) * Motors.ANGLE_CORRECTION
+            return (self._progress + wheel, self._progress - wheel)
+        elif self._motion == 'turn':
+            wheel = self._progress * Motors.ANGLE_CORRECTION
+            return (wheel, -wheel)
+        return (0, 0)
+
+    def update(self):
+        """Move the robot model forward up to the current time."""
+        now = self.clock.time()
+        elapsed = now - self._last_update
+        self._last_update = now
+        if self._motion is None or self._stopped or self.blocked:
+            return
+
+        speed = self.model.rotation_speed if self._motion == 'turn' else self.model.speed
+        step = min(speed * elapsed, self._target - self._progress)
+        if step <= 0:
+            return
+        if self._motion == 'move':
+            self.model.move(step * self._sign)
+        elif self._motion == 'arc':
+            # Integrate by 1 cm chunks.
+            done = 0
+            while done < step:
+                chunk = min(1, step - done)
+                rotation = self.__arc_rotation(self._progress + done + chunk) - \
+                    self.__arc_rotation(self._progress + done)
+                self.model.turn(rotation / 2)
+                self.model.move(chunk)
+                self.model.turn(rotation / 2)
+                done += chunk
+        else:
+            self.model.turn(step * self._sign)
+        self._progress += step
+
+    def __execute(self):
+        command = self._command
+        value = self.__decode_value()
+        self._command = None
+        self.update()
+
+        if command in (MotorsCommand.Forward, MotorsCommand.Backward):
+            self.__start('move', value, 1 if command == MotorsCommand.Forward else -1)
+        elif command in (MotorsCommand.TurnRight, MotorsCommand.TurnLeft):
+            self.__start('turn', value, 1 if command == MotorsCommand.TurnRight else -1)
+        elif command == MotorsCommand.Arc:
+            straight, length, angle = [I2C.unpack_wide(self._data[i:i + 3]) / Motors.WIDE_RESOLUTION
+                                       for i in range(0, 9, 3)]
+            self.__start('arc', straight + length, 1)
+            self._arc = (straight, length, angle)
+        elif command == MotorsCommand.SetSpeed:
+            pass
+        elif command == MotorsCommand.Stop:
+            self._stopped = True
+        elif command == MotorsCommand.Restart:
+            self._stopped = False
+        elif command == MotorsCommand.IsDone:
+            self._response = [int(self.is_done())]
+        elif command == MotorsCommand.IsStopped:
+            self._response = [int(self._stopped)]
+        elif command == MotorsCommand.DistanceTravelled:
+            self._response = self.__distance_response()
+        elif command == MotorsCommand.Status:
+            self._response = self.__status_response()
+
+    def __decode_value(self):
+        if not self._data:
+            return 0
+        if self._wide:
+            return I2C.unpack_wide(self._data) / Motors.WIDE_RESOLUTION
+        return self._data[0]
+
+    def __arc_rotation(self, progress):
+        """Rotation done by an arc command after progress cm."""
+        straight, length, angle = self._arc
+        if length <= 0:
+            return angle if progress >= straight else 0
+        return angle * min(max((progress - straight) / length, 0), 1)
+
+    def __start(self, motion, value, sign):
+        self._motion = motion
+        self._target = value
+        self._sign = sign
+        self._progress = 0
+        self._stopped = False
+        self._reported = [0, 0]
+
+    def __status_response(self):
+        """Same layout as motors.MotorsStatus, the errors are in cm or degrees."""
+        flags = int(self.is_done()) | int(self._stopped) << 1
+        remaining = 0 if self._motion is None else int(round((self._target - self._progress) * self._sign))
+        lead_error = 0 if self._motion == 'turn' else remaining
+        rotation_error = remaining if self._motion == 'turn' else 0
+        response = [flags] + self.__distance_response()
+        for error in [lead_error, rotation_error]:
+            error &= 0xFFFF
+            response += [error >> 8, error & 0xFF]
+        return response
+
+    def __distance_response(self):
+        """Same as the Arduino: signed bytes since the last request."""
+        response = []
+        for i, distance in enumerate(self.get_wheels_distance()):
+            delta = int(distance * self._sign) - self._reported[i]
+            delta = max(min(delta, 127), -128)
+            self._reported[i] += delta
+            response.append(delta & 0xFF)
+        return response
+
+
+class SimulatedKinematics(SimulatedDevice):
+    """
+    Follows the protocol of kinematics.Command and kinematics.Adress,
+    the servo position is the last action received. A servo takes
+    TRAVEL_TIMES seconds to move, the servos in "stalled" never arrive.
+    As the Arduino, the byte received between a STATUS command and its
+    read is the register byte and is discarded, the others are commands.
+    """
+    TRAVEL_TIMES = {
+        Adress.SERVO_CLAMP: 0.5,
+        Adress.SERVO_DYNAMIXEL: 1.5,
+        Adress.SERVO_PUSH: 1,
+        Adress.SERVO_FUNNY: 0.5,
+    }
+
+    def __init__(self, clock):
+        super(SimulatedKinematics, self).__init__(clock)
+        # Default positions set by the Arduino setup().
+        self.servos = {
+            Adress.SERVO_CLAMP: KinematicsCommand.MOVE_DOWN,
+            Adress.SERVO_DYNAMIXEL: KinematicsCommand.MOVE_UP,
+            Adress.SERVO_PUSH: KinematicsCommand.MOVE_DOWN,
+            Adress.SERVO_FUNNY: KinematicsCommand.MOVE_DOWN,
+        }
+        self.stalled = set()
+        self._moving_until = {servo: 0 for servo in self.servos}
+        self._status_servo = None
+
+    def write(self, byte):
+        if self._status_servo is not None:
+            return
+        servo = byte >> 4
+        action = byte & 0x0F
+        if servo not in self.servos:
+            return
+        servo = Adress(servo)
+        if action == KinematicsCommand.STATUS:
+            self._status_servo = servo
+        elif self.servos[servo] != action:
+            self.servos[servo] = action
+            self._moving_until[servo] = self.clock.monotonic() + self.TRAVEL_TIMES[servo]
+
+    def get_status(self, servo):
+        if self.clock.monotonic() < self._moving_until[servo]:
+            return Status.MOVING
+        if servo in self.stalled:
+            return Status.STALLED
+        return Status.REACHED
+
+    def read(self, num_bytes):
+        if self._status_servo is not None:
+            status = self.get_status(self._status_servo)
+            self._status_servo = None
+            return [int(status)] + [0] * (num_bytes - 1)
+        return [0] * num_bytes
+
+
+class SimulatedRangeSensor(SimulatedDevice):
+    """
+    Follows the protocol of range_sensors.Command. Each sensor looks in a
+    direction relative to the robot and sees the nearest obstacle point in
+    a cone in front of it.
+    """
+    # Angle of each sensor relative to the robot front, same order as
+    # robot2.Robot.US_SENSORS.
+    DIRECTIONS = [0, 0, 90, -90, 180]
+    CONE = 15
+    MAX_RANGE = 255
+
+    def __init__(self, clock, model, obstacles=None):
+        super(SimulatedRangeSensor, self).__init__(clock)
+        self.model = model
+        # Obstacles are (x, y) points, e.g. the opponent robot.
+        self.obstacles = obstacles if obstacles is not None else []
+        # Fixed value forced for a sensor, mostly useful for tests.
+        self.forced = {}
+        self._response = [0]
+
+    def get_range(self, sensor):
+        if sensor in self.forced:
+            return self.forced[sensor]
+
+        best = self.MAX_RANGE
+        pos = self.model.position
+        direction = pos['angle'] + self.DIRECTIONS[sensor]
+        for x, y in self.obstacles:
+            dx = x - pos['point'][0]
+            dy = y - pos['point'][1]
+            angle = math.degrees(math.atan2(dy, dx)) - direction
+            angle = (angle + 180) % 360 - 180
+            if abs(angle) <= self.CONE:
+                best = min(best, int(math.sqrt(dx**2 + dy**2)))
+        return best
+
+    def write(self, byte):
+        command = byte >> 4
+        sensor = byte & 0x0F
+        if command == RangeSensorCommand.MeasureOne:
+            if sensor >= len(self.DIRECTIONS):
+                self._response = [0]
+            else:
+                self._response = self.__pack(self.get_range(sensor))
+        elif command == RangeSensorCommand.MeasureAll:
+            self._response = []
+            for i in range(len(self.DIRECTIONS)):
+                self._response += self.__pack(self.get_range(i))
+        elif command == RangeSensorCommand.Count:
+            self._response = [len(self.DIRECTIONS)]
+
+    def read(self, num_bytes):
+        return (self._response + [0] * num_bytes)[:num_bytes]
+
+    def __pack(self, value):
+        # Little endian as the Arduino sends it.
+        return [value & 0xFF, (value >> 8) & 0xFF]
+
+
+class SimulatedBus:
+    """
+    In-process replacement of smbus.SMBus dispatching the bytes to
+    simulated devices. Every transaction takes "latency" seconds on the
+    clock and fails with an OSError with a "error_rate" probability.
+    """
+
+    def __init__(self, clock=None, latency=0.0005, error_rate=0, seed=0):
+        self.clock = clock if clock is not None else time
+        self.latency = latency
+        self.error_rate = error_rate
+        self.transactions = 0
+        self.errors = 0
+        self.model = None
+        self._random = random.Random(seed)
+        self._devices = {}
+
+    def add_device(self, address, device):
+        self._devices[address] = device
+
+    def get_device(self, address):
+        return self._devices[address]
+
+    def write_byte(self, address, byte):
+        self.__transaction(address).write(byte)
+
+    def read_i2c_block_data(self, address, cmd, num_bytes):
+        device = self.__transaction(address)
+        device.write(cmd)
+        return device.read(num_bytes)
+
+    def __transaction(self, address):
+        self.clock.sleep(self.latency)
+        self.transactions += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            raise OSError(errno.EIO, 'Simulated I2C error')
+        if address not in self._devices:
+            raise OSError(errno.EREMOTEIO, 'No device at address {}'.format(address))
+        return self._devices[address]
+
+
+def build_bus(clock=None, position=None, **kwargs):
+    """
+    Create a bus with the motors, kinematics and range-sensor Arduinos
+    at the addresses used by robot.Robot and robot2.Robot.
+    """
+    if clock is None:
+        clock = time
+    model = RobotModel(position)
+    bus = SimulatedBus(clock, **kwargs)
+    bus.model = model
+    bus.add_device(5, SimulatedMotors(clock, model))
+    bus.add_device(6, SimulatedKinematics(clock))
+    bus.add_device(4, SimulatedRangeSensor(clock, model))
+    return bus
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = SimulatedClock()
+        self.bus = build_bus(self.clock)
+
+    def test_wide_forward(self):
+        motors = Motors(5, bus=self.bus)
+        motors.forward(300)
+        self.assertFalse(motors.is_done())
+        self.clock.sleep(20)
+        self.assertTrue(motors.is_done())
+        self.assertAlmostEqual(self.bus.model.position['point'][0], 300)
+
+    def test_turn_right(self):
+        motors = Motors(5, bus=self.bus)
+        motors.turn_right(270)
+        self.clock.sleep(10)
+        self.assertTrue(motors.is_done())
+        self.assertAlmostEqual(self.bus.model.position['angle'], 90)
+
+    def test_arc(self):
+        motors = Motors(5, bus=self.bus)
+        motors.arc(60, 62.8, -90)
+        self.clock.sleep(10)
+        self.assertTrue(motors.is_done())
+        self.assertAlmostEqual(self.bus.model.position['point'][0], 100, 0)
+        self.assertAlmostEqual(self.bus.model.position['point'][1], 40, 0)
+        self.assertAlmostEqual(self.bus.model.position['angle'], 90)
+
+    def test_stall(self):
+        import motors as motors_module
+        import periodic
+
+        self.clock.install(motors_module, periodic)
+        try:
+            motors = Motors(5, bus=self.bus)
+            motors.forward(100)
+            self.clock.sleep(1)
+            device = self.bus.get_device(5)
+            device.update()
+            device.blocked = True
+            result, travelled = motors.wait(sleep=self.clock.sleep, stall_detector=StallDetector())
+            self.assertEqual(result, 'stalled')
+            self.assertAlmostEqual(travelled['left'], 30, delta=1)
+            self.assertLess(self.clock.time(), 2)
+            self.assertTrue(motors.status().stopped)
+        finally:
+            motors_module.time = time
+            periodic.time = time
+
+    def test_stall_final_distance(self):
+        # 8 cm of a 10 cm move, then the slow convergence on the target.
+        deltas = [2, 2, 2, 2] + [0] * 10
+        detector = StallDetector(distance=10)
+        self.assertFalse(any(detector.update(i * 0.1, d, d) for i, d in enumerate(deltas)))
+        detector = StallDetector(distance=30)
+        self.assertTrue(any(detector.update(i * 0.1, d, d) for i, d in enumerate(deltas)))
+        detector = StallDetector()
+        self.assertTrue(any(detector.update(i * 0.1, d, d) for i, d in enumerate(deltas)))
+
+    def test_kinematics_wait(self):
+        import kinematics
+
+        self.clock.install(kinematics)
+        try:
+            servos = Kinematics(6, bus=self.bus)
+            servos.down_clamp()
+            self.assertEqual(servos.wait(Adress.SERVO_DYNAMIXEL, 5, self.clock.sleep), Status.REACHED)
+            self.assertLess(self.clock.time(), 2)
+
+            servos.close_clamp()
+            self.assertEqual(servos.wait(Adress.SERVO_CLAMP, 0.1, self.clock.sleep), Status.MOVING)
+            # The register byte of the reads isn't taken as open_clamp.
+            self.assertEqual(servos.wait(Adress.SERVO_CLAMP, 5, self.clock.sleep), Status.REACHED)
+            servos.ping(3)
+            self.assertEqual(self.bus.get_device(6).servos[Adress.SERVO_CLAMP],
+                             KinematicsCommand.MOVE_UP)
+
+            self.bus.get_device(6).stalled.add(Adress.SERVO_PUSH)
+            servos.push_out()
+            self.assertEqual(servos.wait(Adress.SERVO_PUSH, 5, self.clock.sleep), Status.STALLED)
+        finally:
+            kinematics.time = time
+
+    def test_error_injection(self):
+        bus = build_bus(self.clock, error_rate=1)
+        self.assertRaises(OSError, bus.write_byte, 5, MotorsCommand.Stop)
+        self.assertEqual(bus.errors, 1)
+
+
+if __name__ == '__main__':
+    # Run a whole match script faster than real time.
+    import sys
+
+    import i2c
+    import kinematics
+    import mission
+    import motors
+    import periodic
+    import robot2
+    import scheduler
+    import telemetry
+    import hardcode
+
+    clock = SimulatedClock()
+    clock.install(i2c, kinematics, mission, motors, periodic, robot2, scheduler, telemetry,
+                  hardcode)
+    bus = build_bus(clock, position={'point': [9.5, 16], 'angle': 0})
+    i2c.set_bus(bus)
+
+    script = sys.argv[1] if len(sys.argv) > 1 else 'launch_yellow'
+    start = time.perf_counter()
+    getattr(hardcode, script)()
+    wall = time.perf_counter() - start
+
+    print('{}: {:.1f} s simulated in {:.3f} s, {} I2C transactions'.format(
+        script, clock.time(), wall, bus.transactions))
@@ -0,0 +1,369 @@
+import collections
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from enum import IntEnum
+
+
+class Kind(IntEnum):
+    Pose = 0
+    Ranges = 1
+    Command = 2
+    Event = 3
+
+
+class Event(IntEnum):
+    # value: the turn angle, extra: the direction of the next segment.
+    PathTurn = 0
+    # value: the robot angle at the end of the path, extra: the target angle.
+    PathEnd = 1
+    # value: the sensor index, extra: its range.
+    SensorBlocked = 2
+    SensorCleared = 3
+    # value: the distance travelled before the stall.
+    Stalled = 4
+
+
+class Telemetry:
+    """
+    Compact binary log of the match, cheap enough for the control loop.
+
+    A record is the RECORD header (monotonic timestamp, kind) followed by
+    the fixed-layout payload of its kind, see LAYOUTS. The control loop only
+    packs the record and appends it to a bounded queue, a writer thread
+    drains the queue every FLUSH_PERIOD seconds to the sink (a RotatingFile
+    or a UdpSink) so a slow disk or viewer never blocks the control. When
+    the queue is full the oldest records are dropped and counted.
+
+    Without sink (the default) every call returns immediately.
+    """
+    MAGIC = b'TLM\x01'
+    RECORD = struct.Struct('<dB')
+    LAYOUTS = {
+        # x, y in cm and angle in degrees.
+        Kind.Pose: struct.Struct('<fff'),
+        # Number of ranges and the ranges in cm.
+        Kind.Ranges: struct.Struct('<B8B'),
+        # I2C address, command and value.
+        Kind.Command: struct.Struct('<BBh'),
+        # Event, value and extra.
+        Kind.Event: struct.Struct('<Bff'),
+    }
+    MAX_RANGES = 8
+    QUEUE_SIZE = 10000
+    FLUSH_PERIOD = 0.2
+
+    def __init__(self):
+        self._sink = None
+        self._queue = collections.deque()
+        self._wake = threading.Event()
+        self._thread = None
+        self.dropped = 0
+
+    def start(self, sink):
+        """Write the records to the sink from a background thread."""
+        self.stop()
+        self._sink = sink
+        self._sink.start(self.MAGIC)
+        self._wake.clear()
+        self._thread = threading.Thread(target=self.__writer, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write the remaining records and close the sink."""
+        if self._thread is None:
+            return
+        sink = self._sink
+        self._sink = None
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.__drain(sink)
+        sink.close()
+
+    def flush(self):
+        """Write the queued records now, from the calling thread."""
+        if self._sink is not None:
+            self.__drain(self._sink)
+
+    def pose(self, position):
+        if self._sink is not None:
+            point = position['point']
+            self.__push(Kind.Pose, point[0], point[1], position['angle'])
+
+    def ranges(self, values):
+        if self._sink is not None:
+            values = [min(max(int(v), 0), 255) for v in values[:self.MAX_RANGES]]
+            padding = [0] * (self.MAX_RANGES - len(values))
+            self.__push(Kind.Ranges, len(values), *(values + padding))
+
+    def command(self, address, command, value=0):
+        if self._sink is not None:
+            self.__push(Kind.Command, address, command, value)
+
+    def event(self, event, value=0, extra=0):
+        if self._sink is not None:
+            self.__push(Kind.Event, event, value, extra)
+
+    def put(self, records):
+        """
+        Queue the records of another Telemetry, e.g. the ones of the planner
+        process (the monotonic clock is the same for all the processes).
+        """
+        if self._sink is not None:
+            for record in records:
+                self.__append(record)
+
+    def __push(self, kind, *values):
+        self.__append(self.RECORD.pack(time.monotonic(), kind) + self.LAYOUTS[kind].pack(*values))
+
+    def __append(self, record):
+        if len(self._queue) >= self.QUEUE_SIZE:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(record)
+
+    def __writer(self):
+        while self._sink is not None:
+            self._wake.wait(self.FLUSH_PERIOD)
+            sink = self._sink
+            if sink is not None:
+                self.__drain(sink)
+
+    def __drain(self, sink):
+        records = []
+        while self._queue:
+            records.append(self._queue.popleft())
+        if records:
+            try:
+                sink.write(records)
+            except OSError as e:
+                logging.warn('Telemetry lost %i records: %s', len(records), e)
+
+
+class RotatingFile:
+    """Telemetry sink writing to path, moved to path.1, path.2... when full."""
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._file = open(path, 'wb')
+        self._header = b''
+
+    def start(self, header):
+        # Each file starts with the header to be readable alone.
+        self._header = header
+        self._file.write(header)
+
+    def write(self, records):
+        for record in records:
+            if self._file.tell() + len(record) > self._max_bytes:
+                self.__rotate()
+            self._file.write(record)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __rotate(self):
+        self._file.close()
+        for i in range(self._backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self._path, i)):
+                os.replace('{}.{}'.format(self._path, i), '{}.{}'.format(self._path, i + 1))
+        os.replace(self._path, '{}.1'.format(self._path))
+        self._file = open(self._path, 'wb')
+        self._file.write(self._header)
+
+
+class UdpSink:
+    """Telemetry sink sending the records to a viewer, MTU sized datagrams."""
+    DATAGRAM_SIZE = 1400
+
+    def __init__(self, host='127.0.0.1', port=9999):
+        self._address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def start(self, header):
+        # The viewer can join at any time, the header is not sent.
+        pass
+
+    def write(self, records):
+        # Records are never split between two datagrams.
+        datagram = bytearray()
+        for record in records:
+            if len(datagram) + len(record) > self.DATAGRAM_SIZE:
+                self._socket.sendto(datagram, self._address)
+                datagram = bytearray()
+            datagram += record
+        if datagram:
+            self._socket.sendto(datagram, self._address)
+
+    def close(self):
+        self._socket.close()
+
+
+class CaptureSink:
+    """Telemetry sink keeping the records until take(), to send them elsewhere."""
+
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+
+    def start(self, header):
+        pass
+
+    def write(self, records):
+        with self._lock:
+            self._records.extend(records)
+
+    def take(self):
+        """Return and forget the records written so far."""
+        with self._lock:
+            records, self._records = self._records, []
+        return records
+
+    def close(self):
+        pass
+
+
+def open_sink(target):
+    """Return the sink of "udp:host:port" or of a file path."""
+    if target.startswith('udp:'):
+        _, host, port = target.split(':')
+        return UdpSink(host, int(port))
+    return RotatingFile(target)
+
+
+def parse_records(data):
+    """Return the list of (timestamp, kind, values) of the records in data."""
+    records = []
+    offset = 0
+    while offset < len(data):
+        timestamp, kind = Telemetry.RECORD.unpack_from(data, offset)
+        offset += Telemetry.RECORD.size
+        layout = Telemetry.LAYOUTS[kind]
+        records.append((timestamp, Kind(kind), layout.unpack_from(data, offset)))
+        offset += layout.size
+    return records
+
+
+def read_records(path):
+    """Return the records of a telemetry file, see parse_records."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if not content.startswith(Telemetry.MAGIC):
+        raise Exception('{} is not a telemetry file.'.format(path))
+    return parse_records(content[len(Telemetry.MAGIC):])
+
+
+def format_record(timestamp, kind, values):
+    if kind == Kind.Ranges:
+        values = values[1:1 + values[0]]
+    elif kind == Kind.Event:
+        values = (Event(values[0]).name,) + values[1:]
+    return '{:.3f} {:8} {}'.format(timestamp, kind.name, ' '.join(str(v) for v in values))
+
+
+# Telemetry of the robot modules, started by the match script.
+telemetry = Telemetry()
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_file(self):
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), 'match.tlm')
+        t = Telemetry()
+        # Nothing is queued without sink.
+        t.pose({'point': [1, 2], 'angle': 3})
+        self.assertEqual(len(t._queue), 0)
+
+        t.start(RotatingFile(path))
+        t.pose({'point': [10, 20.5], 'angle': 90})
+        t.ranges([12, 300, 0])
+        t.command(5, 2, -90)
+        t.event(Event.PathTurn, 45, 3)
+        t.stop()
+
+        records = read_records(path)
+        self.assertEqual([r[1] for r in records],
+                         [Kind.Pose, Kind.Ranges, Kind.Command, Kind.Event])
+        self.assertEqual(records[0][2], (10, 20.5, 90))
+        self.assertEqual(records[1][2][:4], (3, 12, 255, 0))
+        self.assertEqual(records[2][2], (5, 2, -90))
+        self.assertEqual(records[3][2], (Event.PathTurn, 45, 3))
+
+    def test_rotation_and_drop(self):
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), 'match.tlm')
+        t = Telemetry()
+        t.QUEUE_SIZE = 10
+        t.FLUSH_PERIOD = 10
+        t.start(RotatingFile(path, max_bytes=100, backups=2))
+        # The writer waits FLUSH_PERIOD, the queue is full.
+        for i in range(15):
+            t.event(Event.Stalled, i)
+        self.assertEqual(t.dropped, 5)
+        t.flush()
+        t.stop()
+
+        self.assertTrue(os.path.exists(path + '.1'))
+        self.assertFalse(os.path.exists(path + '.3'))
+        self.assertEqual(read_records(path + '.1')[0][2][1], 5)
+
+    def test_udp(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        t = Telemetry()
+        t.start(UdpSink(*receiver.getsockname()))
+        t.event(Event.Stalled, 12)
+        t.stop()
+        records = parse_records(receiver.recv(UdpSink.DATAGRAM_SIZE))
+        receiver.close()
+        self.assertEqual(records[0][2][:2], (Event.Stalled, 12))
+
+    def test_capture(self):
+        capture = CaptureSink()
+        source = Telemetry()
+        source.start(capture)
+        source.event(Event.PathEnd, 90, 180)
+        source.flush()
+        records = capture.take()
+        self.assertEqual(capture.take(), [])
+
+        t = Telemetry()
+        t.put(records)
+        self.assertEqual(len(t._queue), 0)
+        t.start(capture)
+        t.put(records)
+        t.flush()
+        self.assertEqual(parse_records(b''.join(capture.take()))[0][2][:2], (Event.PathEnd, 90))
+        t.stop()
+        source.stop()
+
+
+if __name__ == '__main__':
+    # Dump a telemetry file:
+    #   python telemetry.py match.tlm
+    # or follow the match live:
+    #   python telemetry.py --udp 9999
+    import sys
+
+    if sys.argv[1] == '--udp':
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('0.0.0.0', int(sys.argv[2])))
+        while True:
+            for record in parse_records(receiver.recv(UdpSink.DATAGRAM_SIZE)):
+                print(format_record(*record))
+    else:
+        for record in read_records(sys.argv[1]):
+            print(format_record(*record))
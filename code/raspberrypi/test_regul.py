@@ -1,49 +1,175 @@
+import argparse
+import json
+import sys
 import time
-import timeit
 
-from motors import Motors
+import i2c
+from motors import Command, Motors
+
+# Motion patterns as lists of (Motors method, value).
+PATTERNS = {
+    'square': [('forward', 50), ('turn_left', 90)] * 3 +
+              [('forward', 50), ('turn_right', 270)],
+    'straight': [('forward', 250), ('backward', 250)],
+    'spin': [('turn_right', 360), ('turn_left', 360)],
+}
+
+# Start and target of the zig-zag pattern given by GraphMap.get_path.
+ZIGZAG = ({'point': [211.5, 25.75], 'angle': 180},
+          {'point': (221.35, 103.9), 'angle': 135})
+
+
+class TransactionCounter:
+    """
+    Recorder counting the I2C transactions, see i2c.set_recorder: count is
+    every byte written and every read, as each of them is a transaction
+    (a one byte request and its answer are 2, a wide command 4), polls the
+    requests of the regulation state (IsDone or Status), one per iteration
+    of the wait loop whatever the number of commands it needs.
+    """
+    POLL_COMMANDS = {Command.IsDone, Command.Status}
+
+    def __init__(self):
+        self.count = 0
+        self.polls = 0
+
+    def record_send(self, address, data):
+        # I2C.send writes a list byte by byte.
+        self.count += len(data) if isinstance(data, list) else 1
+        command = data[0] if isinstance(data, list) else data
+        if command in self.POLL_COMMANDS:
+            self.polls += 1
+
+    def record_receive(self, address, data):
+        self.count += 1
+
+
+def zigzag_pattern():
+    from graphmap.map_generator import build_graph
+
+    graph = build_graph(17.8, cache=True)
+    pattern = []
+    for action in graph.get_path(*ZIGZAG):
+        value = action['value']
+        if value == 0:
+            continue
+        if action['action'] == 'move':
+            pattern.append(('forward' if value > 0 else 'backward', abs(value)))
+        else:
+            pattern.append(('turn_right' if value > 0 else 'turn_left', abs(value)))
+    return pattern
+
 
 def wait_motors(motors):
-    while not motors.is_done():
-        time.sleep(0.1)
+    """
+    Wait for the end of the regulation and return the (left, right)
+    distance travelled. The distance is read with the status while moving
+    because the Arduino sends it on a signed byte.
+    """
+    _, distance = motors.wait()
+    return distance['left'], distance['right']
+
+
+def run_segment(motors, counter, method, value):
+    transactions = counter.count
+    polls = counter.polls
+    start = time.time()
+    getattr(motors, method)(value)
+    left, right = wait_motors(motors)
+    settle_time = time.time() - start
+
+    if method.startswith('turn'):
+        measured = abs((left - right) / 2) / Motors.ANGLE_CORRECTION
+    else:
+        measured = abs(left + right) / 2
+
+    return {
+        'command': method,
+        'value': value,
+        'settle_time': settle_time,
+        'round_trips': counter.count - transactions,
+        'polls': counter.polls - polls,
+        'error': measured - value,
+    }
+
+
+def run_pattern(motors, pattern):
+    counter = TransactionCounter()
+    i2c.set_recorder(counter)
+    try:
+        start = time.time()
+        segments = [run_segment(motors, counter, method, value) for method, value in pattern]
+        duration = time.time() - start
+    finally:
+        i2c.set_recorder(None)
+
+    return {
+        'segments': segments,
+        'duration': duration,
+        'round_trips': counter.count,
+        'polls': counter.polls,
+        'max_error': max(abs(s['error']) for s in segments),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the difference with the baseline and return the regressions."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ['duration', 'round_trips', 'polls', 'max_error']:
+            # Baselines saved before the polls metric.
+            if metric not in baseline[name]:
+                continue
+            old = baseline[name][metric]
+            new = result[metric]
+            print('{:10} {:12} {:10.2f} -> {:10.2f}'.format(name, metric, old, new))
+            if new > old * (1 + tolerance) and new - old > 1e-6:
+                regressions.append((name, metric))
+    return regressions
+
 
 def test_regul():
     """
     Make a square with the robot and at the end make it turn the
     other direction  (just for fun).
     """
-    DISTANCE = 50
-    ANGLE = 90
-
-    motors = Motors(5)
-    motors.forward(DISTANCE)
-    wait_motors(motors)
-    motors.turn_left(ANGLE)
-    wait_motors(motors)
-    motors.forward(DISTANCE)
-    wait_motors(motors)
-    motors.turn_left(ANGLE)
-    wait_motors(motors)
-    motors.forward(DISTANCE)
-    wait_motors(motors)
-    motors.turn_left(ANGLE)
-    wait_motors(motors)
-    motors.forward(DISTANCE)
-    wait_motors(motors)
-    # We can't turn more than 255 degrees because
-    # the data send to the Arduino is a 8bits value.
-    motors.turn_right(180)
-    wait_motors(motors)
-    motors.turn_right(90)
-    wait_motors(motors)
+    return run_pattern(Motors(5), PATTERNS['square'])
 
 
 if __name__ == '__main__':
-    # Display the time that the regulation has taken.
-    # Could be used to improve the regulation parameter.
-    t = timeit.timeit('test_regul()', setup='from __main__ import test_regul')
+    parser = argparse.ArgumentParser(description='Benchmark the motors regulation.')
+    parser.add_argument('patterns', nargs='*', default=sorted(PATTERNS) + ['zigzag'])
+    parser.add_argument('--sim', action='store_true', help='use the simulated Arduinos')
+    parser.add_argument('--output', default='regul_results.json')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.sim:
+        import motors
+        import periodic
+        import simulator
+        clock = simulator.SimulatedClock()
+        clock.install(sys.modules[__name__], motors, periodic)
+        i2c.set_bus(simulator.build_bus(clock))
+
+    motors = Motors(5)
+    results = {}
+    for name in args.patterns:
+        pattern = zigzag_pattern() if name == 'zigzag' else PATTERNS[name]
+        results[name] = run_pattern(motors, pattern)
+        print('{:10} {:8.2f} s {:6} round trips, {:5} polls, max error {:.1f}'.format(
+            name, results[name]['duration'], results[name]['round_trips'],
+            results[name]['polls'], results[name]['max_error']))
 
-    # Cleaner but this API is only valid for > python3.5
-    # t = timeit.timeit('test_regul()', globals=globals(), number=1)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
 
-    print(t)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions: {}'.format(regressions))
+            sys.exit(1)
@@ -0,0 +1,172 @@
+import collections
+import functools
+import json
+import threading
+import time
+import unittest
+
+
+class Tracer:
+    """
+    Lightweight span recorder for the control loop. A span costs two
+    perf_counter calls and a deque append, the last "size" spans are kept
+    in a ring buffer so it can stay enabled during the matches.
+    """
+    # Upper bounds of the histograms buckets in seconds.
+    BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+    def __init__(self, size=100000, enabled=True):
+        self.enabled = enabled
+        self._spans = collections.deque(maxlen=size)
+        self._origin = time.perf_counter()
+
+    def span(self, name, args=None):
+        """Context manager measuring the duration of its block."""
+        return _Span(self, name, args)
+
+    def traced(self, name=None):
+        """Decorator measuring every call of the function."""
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, start, duration, args=None):
+        if self.enabled:
+            self._spans.append((name, start, duration, threading.get_ident(), args))
+
+    def clear(self):
+        self._spans.clear()
+
+    def take(self):
+        """Return and forget the spans, e.g. to send them to another process."""
+        spans = []
+        while self._spans:
+            spans.append(self._spans.popleft())
+        return spans
+
+    def put(self, spans):
+        """
+        Add the spans taken from another Tracer, e.g. the one of the planner
+        process (perf_counter is the same clock for all the processes on
+        Linux).
+        """
+        if self.enabled:
+            self._spans.extend(spans)
+
+    def histograms(self):
+        """
+        Return a dict giving for each span name the count, total, p50,
+        p99 and max durations and the number of spans in each BUCKETS.
+        """
+        durations = collections.defaultdict(list)
+        for name, _, duration, _, _ in list(self._spans):
+            durations[name].append(duration)
+
+        result = {}
+        for name, values in durations.items():
+            values.sort()
+            buckets = [0] * (len(self.BUCKETS) + 1)
+            for value in values:
+                i = 0
+                while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+                    i += 1
+                buckets[i] += 1
+            result[name] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': values[len(values) // 2],
+                'p99': values[min(int(len(values) * 0.99), len(values) - 1)],
+                'max': values[-1],
+                'buckets': buckets,
+            }
+        return result
+
+    def export_chrome_trace(self, path):
+        """Write the spans as a Chrome trace, readable by Perfetto."""
+        events = []
+        for name, start, duration, thread, args in list(self._spans):
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': duration * 1e6,
+                'pid': 0,
+                'tid': thread,
+            }
+            if args is not None:
+                event['args'] = args
+            events.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+
+class _Span:
+    __slots__ = ('_tracer', '_name', '_args', '_start')
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._tracer.add(self._name, self._start, time.perf_counter() - self._start, self._args)
+        return False
+
+
+# Tracer shared by the robot modules.
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_spans(self):
+        t = Tracer(size=3)
+
+        @t.traced('work')
+        def work():
+            return 42
+
+        self.assertEqual(work(), 42)
+        with t.span('sleep', {'address': 5}):
+            pass
+        with t.span('sleep'):
+            pass
+        histograms = t.histograms()
+        self.assertEqual(histograms['work']['count'], 1)
+        self.assertEqual(histograms['sleep']['count'], 2)
+        self.assertEqual(sum(histograms['sleep']['buckets']), 2)
+
+        # Ring buffer.
+        work()
+        self.assertEqual(t.histograms()['work']['count'], 1)
+
+    def test_take(self):
+        source = Tracer()
+        with source.span('planner'):
+            pass
+        t = Tracer()
+        t.put(source.take())
+        self.assertEqual(source.histograms(), {})
+        self.assertEqual(t.histograms()['planner']['count'], 1)
+
+    def test_disabled(self):
+        t = Tracer(enabled=False)
+        with t.span('nothing'):
+            pass
+        self.assertEqual(t.histograms(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
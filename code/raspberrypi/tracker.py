@@ -0,0 +1,244 @@
+import math
+import unittest
+
+
+class _Axis:
+    """
+    Constant velocity Kalman filter on one axis: the state is the position
+    and the speed, only the position is measured.
+    """
+    __slots__ = ('position', 'speed', 'p', 'pv', 'v')
+
+    def __init__(self, position, variance, speed_variance):
+        self.position = position
+        self.speed = 0
+        # Covariance matrix [[p, pv], [pv, v]].
+        self.p = variance
+        self.pv = 0
+        self.v = speed_variance
+
+    def predict(self, dt, noise):
+        self.position += self.speed * dt
+        # Random acceleration of variance noise.
+        self.p += 2 * dt * self.pv + dt**2 * self.v + noise * dt**4 / 4
+        self.pv += dt * self.v + noise * dt**3 / 2
+        self.v += noise * dt**2
+
+    def update(self, measure, variance):
+        s = self.p + variance
+        k_position = self.p / s
+        k_speed = self.pv / s
+        innovation = measure - self.position
+        self.position += k_position * innovation
+        self.speed += k_speed * innovation
+        self.v -= k_speed * self.pv
+        self.pv *= 1 - k_position
+        self.p *= 1 - k_position
+
+
+class Track:
+    """Position and speed estimate of one opponent."""
+
+    def __init__(self, point, variance, speed_variance, timestamp):
+        self.x = _Axis(point[0], variance, speed_variance)
+        self.y = _Axis(point[1], variance, speed_variance)
+        # Time of the filter state, moved forward by predict.
+        self.timestamp = timestamp
+        # Time of the last measure.
+        self.last_hit = timestamp
+        self.hits = 1
+
+    def point(self):
+        return (self.x.position, self.y.position)
+
+    def speed(self):
+        return (self.x.speed, self.y.speed)
+
+    def predict(self, timestamp, noise):
+        dt = timestamp - self.timestamp
+        if dt > 0:
+            self.x.predict(dt, noise)
+            self.y.predict(dt, noise)
+            self.timestamp = timestamp
+
+    def update(self, point, variance, timestamp):
+        self.x.update(point[0], variance)
+        self.y.update(point[1], variance)
+        self.last_hit = timestamp
+        self.hits += 1
+
+    def trajectory(self, horizon, step):
+        """Return the (t, (x, y)) predicted positions for t in [0; horizon]."""
+        result = []
+        t = 0
+        while t <= horizon + 1e-9:
+            result.append((t, (self.x.position + self.x.speed * t,
+                               self.y.position + self.y.speed * t)))
+            t += step
+        return result
+
+
+class OpponentTracker:
+    """
+    Fuse the ultrasonic hits and the robot position into opponent tracks
+    with a constant velocity Kalman filter, to know where the opponents
+    will be and not only where they were.
+
+    A hit is given with the same direction names as GraphMap.add_obstacle
+    ("front", "left", "right", "back", the front sensors names starting
+    with "front" are accepted). The angles are X-axis relative
+    (counterclockwise) like the robot position.
+    """
+    DIRECTIONS = {'front': 0, 'left': 90, 'right': -90, 'back': 180}
+    # Opening angle of the ultrasonic sensors cone in degrees.
+    SENSOR_CONE = 15
+    # Standard deviation in cm of a range measure.
+    SENSOR_NOISE = 3
+    # Variance of the opponents acceleration in (cm/s^2)^2.
+    ACCELERATION_NOISE = 50**2
+    # Initial standard deviation of the speed in cm/s.
+    INITIAL_SPEED = 50
+    # A hit farther than this distance in cm of a track starts a new track.
+    GATE = 40
+    # Tracks without a hit for this time in seconds are removed.
+    TRACK_TIMEOUT = 2
+    # A hit nearer than this number of standard deviations of a table
+    # element or border is the table, it doesn't start a track.
+    STATIC_SIGMAS = 2
+
+    def __init__(self, robot_dimension, opponent_radius, static_map=None):
+        """
+        robot_dimension: dict with the "length" and "width" of our robot.
+        opponent_radius: distance between the opponent center and its
+        border seen by the sensors.
+        static_map: distance to the table elements, with the distance method
+        of graphmap.clearance.ClearanceField (see map_generator.build_clearance
+        with a zero radius), or None to track every hit.
+        """
+        self._robot_dimension = robot_dimension
+        self._opponent_radius = opponent_radius
+        self._static_map = static_map
+        self.tracks = []
+
+    def update(self, robot_pos, direction, distance, timestamp):
+        """
+        Add a hit at distance cm of the given sensor, return its track. A
+        hit on the table elements only updates a track already there (an
+        opponent along a border), else it returns None.
+        """
+        point, surface, variance = self.__hit_to_point(robot_pos, direction, distance)
+
+        self.__remove_old_tracks(timestamp)
+        best = None
+        for track in self.tracks:
+            track.predict(timestamp, self.ACCELERATION_NOISE)
+            dist = math.hypot(point[0] - track.x.position, point[1] - track.y.position)
+            if dist < self.GATE and (best is None or dist < best[0]):
+                best = (dist, track)
+
+        if best is None:
+            if self.__is_static(surface, variance):
+                return None
+            track = Track(point, variance, self.INITIAL_SPEED**2, timestamp)
+            self.tracks.append(track)
+            return track
+        best[1].update(point, variance, timestamp)
+        return best[1]
+
+    def predict(self, timestamp, horizon, step=0.5):
+        """Return the predicted trajectory of each track, see Track.trajectory."""
+        self.__remove_old_tracks(timestamp)
+        trajectories = []
+        for track in self.tracks:
+            track.predict(timestamp, self.ACCELERATION_NOISE)
+            trajectories.append(track.trajectory(horizon, step))
+        return trajectories
+
+    def __remove_old_tracks(self, timestamp):
+        # predict() moves the timestamp of every track, only the hits count.
+        self.tracks = [t for t in self.tracks if timestamp - t.last_hit < self.TRACK_TIMEOUT]
+
+    def __is_static(self, surface, variance):
+        if self._static_map is None:
+            return False
+        return self._static_map.distance([surface])[0] < self.STATIC_SIGMAS * math.sqrt(variance)
+
+    def __hit_to_point(self, robot_pos, direction, distance):
+        """
+        Return the position of the opponent center, of the surface seen by
+        the sensor and the variance of the measure: the sensor noise plus
+        the width of the cone at the distance.
+        """
+        name = 'front' if direction.startswith('front') else direction
+        if name in ['front', 'back']:
+            offset = self._robot_dimension['length'] / 2
+        else:
+            offset = self._robot_dimension['width'] / 2
+
+        angle = math.radians(robot_pos['angle'] + self.DIRECTIONS[name])
+        center = offset + distance + self._opponent_radius
+        point = (robot_pos['point'][0] + center * math.cos(angle),
+                 robot_pos['point'][1] + center * math.sin(angle))
+        surface = (robot_pos['point'][0] + (offset + distance) * math.cos(angle),
+                   robot_pos['point'][1] + (offset + distance) * math.sin(angle))
+
+        lateral = distance * math.tan(math.radians(self.SENSOR_CONE / 2))
+        return point, surface, self.SENSOR_NOISE**2 + lateral**2
+
+
+class TestOpponentTracker(unittest.TestCase):
+
+    def test_constant_speed(self):
+        tracker = OpponentTracker({'length': 30, 'width': 20}, 10)
+        robot = {'point': [0, 0], 'angle': 0}
+        # The opponent goes away from our front at 20 cm/s.
+        for i in range(20):
+            t = i * 0.1
+            track = tracker.update(robot, 'front_bottom', 30 + 20 * t, t)
+        self.assertEqual(len(tracker.tracks), 1)
+        self.assertAlmostEqual(track.speed()[0], 20, delta=3)
+        self.assertAlmostEqual(track.speed()[1], 0, delta=1)
+
+        trajectory = tracker.predict(1.9, 1)[0]
+        self.assertEqual(trajectory[0][0], 0)
+        self.assertAlmostEqual(trajectory[-1][1][0], 15 + 30 + 38 + 10 + 20, delta=5)
+
+    def test_tracks(self):
+        tracker = OpponentTracker({'length': 30, 'width': 20}, 10)
+        robot = {'point': [100, 100], 'angle': 90}
+        front = tracker.update(robot, 'front', 20, 0)
+        back = tracker.update(robot, 'back', 20, 0.1)
+        self.assertIsNot(front, back)
+        self.assertAlmostEqual(front.point()[1], 100 + 15 + 20 + 10)
+        self.assertAlmostEqual(back.point()[1], 100 - 15 - 20 - 10)
+
+        tracker.predict(0.1 + OpponentTracker.TRACK_TIMEOUT, 1)
+        self.assertEqual(tracker.tracks, [])
+
+    def test_timeout_without_hits(self):
+        tracker = OpponentTracker({'length': 30, 'width': 20}, 10)
+        robot = {'point': [100, 100], 'angle': 90}
+        front = tracker.update(robot, 'front', 20, 0)
+        # Only the back sensor sees something: the front track expires.
+        for i in range(1, 100):
+            back = tracker.update(robot, 'back', 20, i * 0.1)
+        self.assertEqual(tracker.tracks, [back])
+        self.assertNotIn(front, tracker.predict(10, 1))
+
+    def test_static_map(self):
+        class Table:
+            """Distance to the borders of a 300 x 200 table."""
+
+            def distance(self, points):
+                return [min(x, y, 300 - x, 200 - y) for x, y in points]
+
+        tracker = OpponentTracker({'length': 30, 'width': 20}, 10, Table())
+        # The border is 35 cm in front of the robot center.
+        robot = {'point': [100, 165], 'angle': 90}
+        self.assertIsNone(tracker.update(robot, 'front', 20, 0))
+        self.assertIsNotNone(tracker.update(robot, 'back', 20, 0))
+        self.assertEqual(len(tracker.tracks), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()